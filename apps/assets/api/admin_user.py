@@ -26,6 +26,7 @@ from ..hands import IsOrgAdmin
 from ..models import AdminUser, Asset
 from .. import serializers
 from ..tasks import test_admin_user_connectivity_manual
+from .asset import AssetConnectivityMixin
 
 
 logger = get_logger(__file__)
@@ -95,7 +96,7 @@ class AdminUserTestConnectiveApi(generics.RetrieveAPIView):
         return Response({"task": task.id})
 
 
-class AdminUserAssetsListView(generics.ListAPIView):
+class AdminUserAssetsListView(AssetConnectivityMixin, generics.ListAPIView):
     permission_classes = (IsOrgAdmin,)
     serializer_class = serializers.AssetSimpleSerializer
     pagination_class = LimitOffsetPagination
@@ -29,7 +29,21 @@ __all__ = [
 ]
 
 
-class AssetViewSet(IDInFilterMixin, LabelFilter, BulkModelViewSet):
+class AssetConnectivityMixin:
+    def get_serializer(self, *args, **kwargs):
+        # 只为要序列化的资产批量读取可连接性
+        if args and self.request.method == 'GET':
+            if kwargs.get('many'):
+                assets = list(args[0])
+                args = (assets,) + args[1:]
+            else:
+                assets = [args[0]]
+            Asset.set_assets_connectivity(assets)
+        return super().get_serializer(*args, **kwargs)
+
+
+class AssetViewSet(AssetConnectivityMixin, IDInFilterMixin, LabelFilter,
+                   BulkModelViewSet):
     """
     API endpoint that allows Asset to be viewed or edited.
     """
@@ -59,8 +73,8 @@ class AssetViewSet(IDInFilterMixin, LabelFilter, BulkModelViewSet):
             queryset = queryset.filter(nodes=node)
         else:
             queryset = queryset.filter(
-                nodes__key__regex='^{}(:[0-9]+)*$'.format(node.key),
-            )
+                Node.subtree_key_q(node.key, field='nodes__key')
+            ).distinct()
         return queryset
 
     def filter_admin_user_id(self, queryset):
@@ -83,7 +97,8 @@ class AssetViewSet(IDInFilterMixin, LabelFilter, BulkModelViewSet):
         return queryset
 
 
-class AssetListUpdateApi(IDInFilterMixin, ListBulkCreateUpdateDestroyAPIView):
+class AssetListUpdateApi(AssetConnectivityMixin, IDInFilterMixin,
+                         ListBulkCreateUpdateDestroyAPIView):
     """
     Asset bulk update api
     """
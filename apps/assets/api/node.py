@@ -24,8 +24,10 @@ from common.utils import get_logger, get_object_or_none
 from common.tree import TreeNodeSerializer
 from ..hands import IsOrgAdmin
 from ..models import Node
+from ..tree import get_node_tree
 from ..tasks import update_assets_hardware_info_util, test_asset_connectivity_util
 from .. import serializers
+from .asset import AssetConnectivityMixin
 
 
 logger = get_logger(__file__)
@@ -77,7 +79,9 @@ class NodeListAsTreeApi(generics.ListAPIView):
     serializer_class = TreeNodeSerializer
 
     def get_queryset(self):
-        queryset = [node.as_tree_node() for node in Node.objects.all()]
+        nodes = get_node_tree().get_org_nodes()
+        Node.prefetch_nodes_assets_amount(nodes)
+        queryset = [node.as_tree_node() for node in nodes]
         return queryset
 
     def filter_queryset(self, queryset):
@@ -87,7 +91,7 @@ class NodeListAsTreeApi(generics.ListAPIView):
 
     @staticmethod
     def refresh_nodes(queryset):
-        Node.expire_nodes_assets_amount()
+        Node.refresh_nodes_assets_amount()
         Node.expire_nodes_full_value()
         return queryset
 
@@ -140,7 +144,7 @@ class NodeChildrenAsTreeApi(generics.ListAPIView):
 
     def filter_refresh_nodes(self, queryset):
         if self.request.query_params.get('refresh', '0') == '1':
-            Node.expire_nodes_assets_amount()
+            Node.refresh_nodes_assets_amount()
             Node.expire_nodes_full_value()
         return queryset
 
@@ -208,7 +212,7 @@ class NodeChildrenApi(mixins.ListModelMixin, generics.CreateAPIView):
         return queryset
 
 
-class NodeAssetsApi(generics.ListAPIView):
+class NodeAssetsApi(AssetConnectivityMixin, generics.ListAPIView):
     permission_classes = (IsOrgAdmin,)
     serializer_class = serializers.AssetSerializer
 
@@ -313,5 +317,5 @@ class RefreshAssetsAmount(APIView):
     model = Node
 
     def get(self, request, *args, **kwargs):
-        self.model.expire_nodes_assets_amount()
+        self.model.refresh_nodes_assets_amount()
         return Response("Ok")
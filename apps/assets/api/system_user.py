@@ -23,6 +23,7 @@ from common.utils import get_logger
 from common.permissions import IsOrgAdmin, IsOrgAdminOrAppUser
 from ..models import SystemUser, Asset
 from .. import serializers
+from .asset import AssetConnectivityMixin
 from ..tasks import push_system_user_to_assets_manual, \
     test_system_user_connectivity_manual, push_system_user_a_asset_manual, \
     test_system_user_connectivity_a_asset
@@ -97,7 +98,7 @@ class SystemUserTestConnectiveApi(generics.RetrieveAPIView):
         return Response({"task": task.id})
 
 
-class SystemUserAssetsListView(generics.ListAPIView):
+class SystemUserAssetsListView(AssetConnectivityMixin, generics.ListAPIView):
     permission_classes = (IsOrgAdmin,)
     serializer_class = serializers.AssetSimpleSerializer
     pagination_class = LimitOffsetPagination
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+import re
+import time
+import threading
+
+from django.core.cache import cache
+from django.db import transaction
+
+from common.utils import get_logger
+from orgs.utils import get_current_org, set_current_org, set_to_root_org
+
+__all__ = [
+    'CommandFilterMatcher', 'get_command_filter_matcher',
+    'expire_command_filter_matchers',
+]
+logger = get_logger(__file__)
+
+CMD_FILTER_VERSION_KEY = '_CMD_FILTER_VERSION'
+# 分组引用和行内标记在合并后含义会改变
+UNMERGEABLE_PATTERN = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)')
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+
+class CommandFilterMatcher:
+    """
+    系统用户所有的命令过滤规则编译成一个正则, 一次匹配得到优先级最高的规则
+
+    每个规则是一个从开头匹配的前向断言, 按优先级排列, 第一个成功的分支就是
+    原来逐条 search 时第一个匹配的规则, 匹配的内容也和 search 一致
+    规则的正则不能合并时 (如使用了分组引用), 退回逐条匹配
+    """
+    def __init__(self, rules, version=None):
+        self.version = version
+        self.rules = list(rules)
+        self.pattern = self.compile(self.rules)
+
+    @staticmethod
+    def compile(rules):
+        if not rules:
+            return None
+        branches = []
+        for i, rule in enumerate(rules):
+            if UNMERGEABLE_PATTERN.search(rule.pattern_source):
+                return None
+            branches.append(r'(?=[\s\S]*?(?P<r{}>{}))'.format(i, rule.pattern_source))
+        try:
+            return re.compile('|'.join(branches))
+        except (re.error, AssertionError) as e:
+            logger.debug("Merge command filter rules error: {}".format(e))
+            return None
+
+    def match_rules(self, command):
+        for rule in self.rules:
+            action, matched_cmd = rule.match(command)
+            if action != rule.ACTION_UNKNOWN:
+                return rule, matched_cmd
+        return None, ''
+
+    def match(self, command):
+        """
+        :return: (rule, 匹配的命令), 没有匹配时 rule 为 None
+        """
+        if self.pattern is None:
+            return self.match_rules(command)
+        found = self.pattern.match(command)
+        if not found:
+            return None, ''
+        name = found.lastgroup
+        return self.rules[int(name[1:])], found.group(name)
+
+    def is_command_can_run(self, command):
+        rule, matched_cmd = self.match(command)
+        if rule is None or rule.action == rule.ACTION_ALLOW:
+            return True, None
+        return False, matched_cmd
+
+
+def get_cmd_filter_version():
+    version = cache.get(CMD_FILTER_VERSION_KEY)
+    if version is None:
+        # cache 被清空后不能从 1 开始, 否则可能和 worker 中旧的版本号一致
+        cache.add(CMD_FILTER_VERSION_KEY, int(time.time()), None)
+        version = cache.get(CMD_FILTER_VERSION_KEY)
+    return version
+
+
+def build_command_filter_matcher(system_user, version):
+    from .models import CommandFilterRule
+    # celery 中没有当前组织, 在 root 组织下按系统用户的过滤器查询
+    _current_org = get_current_org()
+    set_to_root_org()
+    try:
+        rules = list(CommandFilterRule.objects.filter(
+            filter__in=system_user.cmd_filters.all()
+        ).distinct())
+    finally:
+        set_current_org(_current_org)
+    return CommandFilterMatcher(rules, version)
+
+
+def get_command_filter_matcher(system_user):
+    """
+    每个 worker 缓存编译好的匹配器, 规则或过滤器变化时增加版本号
+    """
+    version = get_cmd_filter_version()
+    key = str(system_user.id)
+    matcher = _matchers.get(key)
+    if matcher is not None and matcher.version == version:
+        return matcher
+    matcher = build_command_filter_matcher(system_user, version)
+    with _matchers_lock:
+        # 版本变化后清空, 避免缓存已经删除的系统用户
+        for k in [k for k, v in _matchers.items() if v.version != version]:
+            _matchers.pop(k, None)
+        _matchers[key] = matcher
+    return matcher
+
+
+def _incr_cmd_filter_version():
+    try:
+        cache.incr(CMD_FILTER_VERSION_KEY)
+    except ValueError:
+        cache.set(CMD_FILTER_VERSION_KEY, int(time.time()), None)
+
+
+def expire_command_filter_matchers():
+    transaction.on_commit(_incr_cmd_filter_version)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+"""
+资产可连接性的存储
+
+每个组织一个 redis hash, field 为 <资产id>_<用户id>, 用户为管理用户或系统用户,
+值为 [状态, 检测时间戳, 耗时毫秒], 不设置过期时间.
+修改过的组织由周期任务保存到 AssetConnectivity 表, redis 中的数据丢失后从表中恢复.
+"""
+import json
+import time
+import datetime
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from common.utils import get_logger
+from orgs.utils import set_to_root_org
+
+__all__ = ['ConnectivityStore']
+logger = get_logger(__file__)
+
+CONNECTIVITY_KEY = 'ASSETS_CONNECTIVITY_{}'
+CONNECTIVITY_DIRTY_KEY = 'ASSETS_CONNECTIVITY_DIRTY_ORGS'
+# hash 存在说明已经从数据库恢复过, 即使这个组织还没有任何数据
+LOADED_FIELD = '_loaded'
+UNREACHABLE, REACHABLE, UNKNOWN = range(0, 3)
+
+
+class ConnectivityStore:
+    def __init__(self, org_id):
+        self.org_id = str(org_id or '')
+        self.key = CONNECTIVITY_KEY.format(self.org_id or 'DEFAULT')
+
+    @staticmethod
+    def get_redis_client():
+        return cache.get_master_client()
+
+    @staticmethod
+    def get_field(asset_id, user_id):
+        return '{}_{}'.format(asset_id, user_id)
+
+    def ensure_loaded(self):
+        client = self.get_redis_client()
+        if not client.exists(self.key):
+            self.restore()
+
+    def restore(self):
+        """
+        从数据库恢复, 使用 hsetnx, 不会覆盖恢复期间新写入的结果
+        """
+        from .models import AssetConnectivity
+        rows = AssetConnectivity.objects.filter(org_id=self.org_id)
+        pipe = self.get_redis_client().pipeline()
+        for row in rows.iterator():
+            value = [row.status, int(row.date_checked.timestamp()), row.latency]
+            pipe.hsetnx(self.key, self.get_field(row.asset_id, row.user_id),
+                        json.dumps(value))
+        pipe.hsetnx(self.key, LOADED_FIELD, 1)
+        pipe.execute()
+
+    def set_many(self, items):
+        """
+        :param items: [(asset_id, user_id, status, latency), ]
+        """
+        if not items:
+            return
+        self.ensure_loaded()
+        now = int(time.time())
+        mapping = {
+            self.get_field(asset_id, user_id): json.dumps([status, now, latency])
+            for asset_id, user_id, status, latency in items
+        }
+        pipe = self.get_redis_client().pipeline()
+        pipe.hmset(self.key, mapping)
+        pipe.sadd(CONNECTIVITY_DIRTY_KEY, self.org_id)
+        pipe.execute()
+
+    def get_many(self, pairs):
+        """
+        列表页一次读取
+        :param pairs: [(asset_id, user_id), ]
+        :return: {(asset_id, user_id): {"status", "date_checked", "latency"}},
+            没有检测过的不返回
+        """
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        self.ensure_loaded()
+        fields = [self.get_field(asset_id, user_id) for asset_id, user_id in pairs]
+        values = self.get_redis_client().hmget(self.key, fields)
+        data = {}
+        for pair, value in zip(pairs, values):
+            if value is None:
+                continue
+            status, ts, latency = json.loads(value.decode())
+            data[pair] = {
+                'status': status,
+                'date_checked': datetime.datetime.fromtimestamp(ts, tz=timezone.utc),
+                'latency': latency,
+            }
+        return data
+
+    def get_status_many(self, pairs):
+        """
+        :return: {(asset_id, user_id): status}, 没有检测过的为 UNKNOWN
+        """
+        pairs = list(pairs)
+        data = self.get_many(pairs)
+        return {
+            pair: data[pair]['status'] if pair in data else UNKNOWN
+            for pair in pairs
+        }
+
+    def prune(self, items):
+        """
+        删除已经不存在的资产, 管理用户和系统用户的数据
+        :param items: {(asset_id, user_id): value}
+        :return: 被删除的 keys
+        """
+        from .models import Asset, AdminUser, SystemUser
+        assets_id = {asset_id for asset_id, user_id in items}
+        users_id = {user_id for asset_id, user_id in items}
+        exists_assets = {
+            str(i) for i in
+            Asset.objects.filter(id__in=assets_id).values_list('id', flat=True)
+        }
+        exists_users = {
+            str(i) for model in (AdminUser, SystemUser) for i in
+            model.objects.filter(id__in=users_id).values_list('id', flat=True)
+        }
+        deleted = [
+            k for k in items
+            if k[0] not in exists_assets or k[1] not in exists_users
+        ]
+        if deleted:
+            self.get_redis_client().hdel(
+                self.key, *[self.get_field(*k) for k in deleted]
+            )
+        return deleted
+
+    def persist(self):
+        """
+        把 redis 中的数据同步到数据库, 只写入有变化的记录,
+        已经删除的资产和用户从 redis 和数据库中一起删除
+        """
+        from .models import AssetConnectivity
+        values = self.get_redis_client().hgetall(self.key)
+        values.pop(LOADED_FIELD.encode(), None)
+        items = {}
+        for field, value in values.items():
+            asset_id, user_id = field.decode().split('_', 1)
+            items[(asset_id, user_id)] = json.loads(value.decode())
+        for k in self.prune(items):
+            items.pop(k)
+
+        rows = AssetConnectivity.objects.filter(org_id=self.org_id)\
+            .only('id', 'asset_id', 'user_id', 'status', 'latency', 'date_checked')
+        exists = {(str(row.asset_id), str(row.user_id)): row for row in rows}
+        to_create, to_update = [], []
+        for (asset_id, user_id), (status, ts, latency) in items.items():
+            date_checked = datetime.datetime.fromtimestamp(ts, tz=timezone.utc)
+            row = exists.pop((asset_id, user_id), None)
+            if row is None:
+                to_create.append(AssetConnectivity(
+                    org_id=self.org_id, asset_id=asset_id, user_id=user_id,
+                    status=status, latency=latency, date_checked=date_checked,
+                ))
+            elif (row.status, row.latency, int(row.date_checked.timestamp())) \
+                    != (status, latency, ts):
+                row.status, row.latency, row.date_checked = status, latency, date_checked
+                to_update.append(row)
+        # 剩下的是 redis 中已经没有的记录
+        to_delete = [row.id for row in exists.values()]
+
+        with transaction.atomic():
+            if to_delete:
+                AssetConnectivity.objects.filter(id__in=to_delete).delete()
+            for row in to_update:
+                row.save(update_fields=['status', 'latency', 'date_checked'])
+            AssetConnectivity.objects.bulk_create(to_create, batch_size=1000)
+        return len(to_create) + len(to_update)
+
+    @classmethod
+    def persist_dirty(cls):
+        """
+        保存有修改的组织, 先移出 dirty 集合, 保存期间的修改会在下次保存
+        """
+        set_to_root_org()
+        client = cls.get_redis_client()
+        orgs_id = client.smembers(CONNECTIVITY_DIRTY_KEY)
+        for org_id in orgs_id:
+            org_id = org_id.decode()
+            client.srem(CONNECTIVITY_DIRTY_KEY, org_id)
+            try:
+                count = cls(org_id).persist()
+                logger.debug("Persist {} connectivity of org {}".format(count, org_id))
+            except Exception as e:
+                client.sadd(CONNECTIVITY_DIRTY_KEY, org_id)
+                logger.error("Persist connectivity error: {}".format(e))
@@ -0,0 +1,33 @@
+# Generated by Django 2.1.7 on 2019-05-07 15:42
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def set_nodes_level(apps, schema_editor):
+    node_model = apps.get_model("assets", "Node")
+    db_alias = schema_editor.connection.alias
+    levels = defaultdict(list)
+    for pk, key in node_model.objects.using(db_alias).values_list('id', 'key'):
+        levels[len(key.split(':'))].append(pk)
+    for level, pks in levels.items():
+        for i in range(0, len(pks), 1000):
+            node_model.objects.using(db_alias).filter(pk__in=pks[i:i+1000])\
+                .update(level=level)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0026_auto_20190425_1108'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='level',
+            field=models.IntegerField(db_index=True, default=1, verbose_name='Level'),
+        ),
+        migrations.RunPython(set_nodes_level),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.1.7 on 2019-05-08 10:21
+
+import ipaddress
+
+from django.db import migrations, models
+
+
+def set_assets_ip_number(apps, schema_editor):
+    asset_model = apps.get_model("assets", "Asset")
+    db_alias = schema_editor.connection.alias
+    assets = asset_model.objects.using(db_alias).values_list('id', 'ip')
+    for pk, ip in assets.iterator():
+        try:
+            number = int(ipaddress.ip_address(str(ip).strip()))
+        except ValueError:
+            continue
+        asset_model.objects.using(db_alias).filter(pk=pk)\
+            .update(ip_number=number)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0027_node_level'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asset',
+            name='ip_number',
+            field=models.DecimalField(db_index=True, decimal_places=0, default=0, max_digits=39, verbose_name='IP number'),
+        ),
+        migrations.RunPython(set_assets_ip_number),
+    ]
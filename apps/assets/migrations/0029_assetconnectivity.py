@@ -0,0 +1,33 @@
+# Generated by Django 2.1.7 on 2019-05-16 15:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0028_asset_ip_number'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssetConnectivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('org_id', models.CharField(blank=True, db_index=True, default='', max_length=36, verbose_name='Organization')),
+                ('asset_id', models.UUIDField(verbose_name='Asset')),
+                ('user_id', models.UUIDField(verbose_name='User')),
+                ('status', models.IntegerField(choices=[(0, 'Unreachable'), (1, 'Reachable'), (2, 'Unknown')], default=2, verbose_name='Connectivity')),
+                ('latency', models.IntegerField(null=True, verbose_name='Latency')),
+                ('date_checked', models.DateTimeField(verbose_name='Date checked')),
+            ],
+            options={
+                'db_table': 'assets_connectivity',
+                'verbose_name': 'Asset connectivity',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='assetconnectivity',
+            unique_together={('asset_id', 'user_id')},
+        ),
+    ]
@@ -11,8 +11,9 @@ from collections import defaultdict
 from django.db import models
 from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
-from django.core.cache import cache
 
+from common.utils import ip_to_number
+from ..connectivity import ConnectivityStore
 from .user import AdminUser, SystemUser
 from orgs.mixins import OrgModelMixin, OrgManager
 
@@ -46,6 +47,13 @@ class AssetQuerySet(models.QuerySet):
     def valid(self):
         return self.active()
 
+    def update(self, **kwargs):
+        # ip_number 用于按 ip 排序, 和 ip 一起更新; ip 为表达式时需要调用方同时更新 ip_number
+        ip = kwargs.get('ip')
+        if isinstance(ip, str) and 'ip_number' not in kwargs:
+            kwargs['ip_number'] = ip_to_number(ip)
+        return super().update(**kwargs)
+
 
 class Asset(OrgModelMixin):
     # Important
@@ -72,6 +80,7 @@ class Asset(OrgModelMixin):
 
     id = models.UUIDField(default=uuid.uuid4, primary_key=True)
     ip = models.GenericIPAddressField(max_length=32, verbose_name=_('IP'), db_index=True)
+    ip_number = models.DecimalField(max_digits=39, decimal_places=0, default=0, db_index=True, verbose_name=_('IP number'))
     hostname = models.CharField(max_length=128, verbose_name=_('Hostname'))
     protocol = models.CharField(max_length=128, default=PROTOCOL_SSH, choices=PROTOCOL_CHOICES, verbose_name=_('Protocol'))
     port = models.IntegerField(default=22, verbose_name=_('Port'))
@@ -111,7 +120,6 @@ class Asset(OrgModelMixin):
     comment = models.TextField(max_length=128, default='', blank=True, verbose_name=_('Comment'))
 
     objects = OrgManager.from_queryset(AssetQuerySet)()
-    CONNECTIVITY_CACHE_KEY = '_JMS_ASSET_CONNECTIVITY_{}'
     UNREACHABLE, REACHABLE, UNKNOWN = range(0, 3)
     CONNECTIVITY_CHOICES = (
         (UNREACHABLE, _("Unreachable")),
@@ -122,6 +130,14 @@ class Asset(OrgModelMixin):
     def __str__(self):
         return '{0.hostname}({0.ip})'.format(self)
 
+    def save(self, *args, **kwargs):
+        self.ip_number = ip_to_number(self.ip)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'ip' in update_fields \
+                and 'ip_number' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['ip_number']
+        return super().save(*args, **kwargs)
+
     @property
     def is_valid(self):
         warning = ''
@@ -153,7 +169,7 @@ class Asset(OrgModelMixin):
         nodes = []
         for node in self.get_nodes():
             _nodes = node.get_ancestor(with_self=True)
-            _nodes.append(_nodes)
+            nodes.append(_nodes)
         if flat:
             nodes = list(reduce(lambda x, y: set(x) | set(y), nodes))
         return nodes
@@ -184,16 +200,55 @@ class Asset(OrgModelMixin):
 
     @property
     def connectivity(self):
+        """
+        管理用户的可连接性, 列表页使用 set_assets_connectivity 批量设置
+        """
         if not self.is_unixlike():
             return self.REACHABLE
-        key = self.CONNECTIVITY_CACHE_KEY.format(str(self.id))
-        cached = cache.get(key, None)
-        return cached if cached is not None else self.UNKNOWN
+        if hasattr(self, '_connectivity'):
+            return self._connectivity
+        if not self.admin_user_id:
+            return self.UNKNOWN
+        pair = (str(self.id), str(self.admin_user_id))
+        store = ConnectivityStore(self.org_id)
+        return store.get_status_many([pair])[pair]
 
     @connectivity.setter
     def connectivity(self, value):
-        key = self.CONNECTIVITY_CACHE_KEY.format(str(self.id))
-        cache.set(key, value, 3600*2)
+        self.set_assets_connectivity_status([(self, value, None)])
+
+    @classmethod
+    def set_assets_connectivity(cls, assets):
+        """
+        按组织批量读取管理用户的可连接性, 设置到实例上
+        """
+        orgs_assets = defaultdict(list)
+        for asset in assets:
+            if asset.admin_user_id:
+                orgs_assets[asset.org_id].append(asset)
+            else:
+                asset._connectivity = cls.UNKNOWN
+        for org_id, org_assets in orgs_assets.items():
+            pairs = [(str(a.id), str(a.admin_user_id)) for a in org_assets]
+            status = ConnectivityStore(org_id).get_status_many(pairs)
+            for asset, pair in zip(org_assets, pairs):
+                asset._connectivity = status[pair]
+
+    @classmethod
+    def set_assets_connectivity_status(cls, items):
+        """
+        :param items: [(asset, status, latency), ], 记录管理用户的可连接性
+        """
+        orgs_items = defaultdict(list)
+        for asset, status, latency in items:
+            if not asset.admin_user_id:
+                continue
+            orgs_items[asset.org_id].append(
+                (str(asset.id), str(asset.admin_user_id), status, latency)
+            )
+            asset._connectivity = status
+        for org_id, org_items in orgs_items.items():
+            ConnectivityStore(org_id).set_many(org_items)
 
     def get_auth_info(self):
         if self.admin_user:
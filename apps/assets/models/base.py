@@ -12,6 +12,7 @@ from django.conf import settings
 from common.utils import get_signer, ssh_key_string_to_obj, ssh_key_gen
 from common.validators import alphanumeric
 from orgs.mixins import OrgModelMixin
+from ..connectivity import ConnectivityStore
 from .utils import private_key_validator
 
 signer = get_signer()
@@ -115,6 +116,21 @@ class AssetUser(OrgModelMixin):
     def get_auth(self, asset=None):
         pass
 
+    def get_assets_connectivity(self, assets):
+        """
+        :param assets: [(asset_id, hostname), ], 一次读取这个用户在这些资产上的可连接性
+        :return: {"unreachable": [hostname, ], "reachable": [hostname, ]}
+        """
+        hostnames = {(str(asset_id), str(self.id)): hostname for asset_id, hostname in assets}
+        status = ConnectivityStore(self.org_id).get_status_many(hostnames.keys())
+        data = {'unreachable': [], 'reachable': []}
+        for pair, hostname in hostnames.items():
+            if status[pair] == self.REACHABLE:
+                data['reachable'].append(hostname)
+            elif status[pair] == self.UNREACHABLE:
+                data['unreachable'].append(hostname)
+        return data
+
     def clear_auth(self):
         self._password = ''
         self._private_key = ''
@@ -64,17 +64,20 @@ class CommandFilterRule(OrgModelMixin):
         verbose_name = _("Command filter rule")
 
     @property
-    def _pattern(self):
-        if self.__pattern:
-            return self.__pattern
+    def pattern_source(self):
         if self.type == 'command':
             regex = []
             for cmd in self.content.split('\r\n'):
                 cmd = cmd.replace(' ', '\s+')
                 regex.append(r'\b{0}\b'.format(cmd))
-            self.__pattern = re.compile(r'{}'.format('|'.join(regex)))
-        else:
-            self.__pattern = re.compile(r'{0}'.format(self.content))
+            return r'{}'.format('|'.join(regex))
+        return r'{0}'.format(self.content)
+
+    @property
+    def _pattern(self):
+        if self.__pattern:
+            return self.__pattern
+        self.__pattern = re.compile(self.pattern_source)
         return self.__pattern
 
     def match(self, data):
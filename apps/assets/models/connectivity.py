@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+#
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+from .base import AssetUser
+
+__all__ = ['AssetConnectivity']
+
+
+class AssetConnectivity(models.Model):
+    """
+    资产可连接性的快照, 由 assets.connectivity.ConnectivityStore 定期从 redis 保存
+    user_id 为管理用户或系统用户的 id
+    """
+    org_id = models.CharField(max_length=36, blank=True, default='', db_index=True, verbose_name=_('Organization'))
+    asset_id = models.UUIDField(verbose_name=_('Asset'))
+    user_id = models.UUIDField(verbose_name=_('User'))
+    status = models.IntegerField(choices=AssetUser.CONNECTIVITY_CHOICES, default=AssetUser.UNKNOWN, verbose_name=_('Connectivity'))
+    latency = models.IntegerField(null=True, verbose_name=_('Latency'))
+    date_checked = models.DateTimeField(verbose_name=_('Date checked'))
+
+    class Meta:
+        db_table = 'assets_connectivity'
+        unique_together = ('asset_id', 'user_id')
+        verbose_name = _('Asset connectivity')
+
+    def __str__(self):
+        return '{}_{}: {}'.format(self.asset_id, self.user_id, self.status)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 #
 import uuid
+from collections import defaultdict
 
 from django.db import models, transaction
 from django.db.models import Q
@@ -11,6 +12,7 @@ from django.core.cache import cache
 from orgs.mixins import OrgModelMixin
 from orgs.utils import set_current_org, get_current_org
 from orgs.models import Organization
+from ..tree import get_node_tree, expire_node_tree
 
 __all__ = ['Node']
 
@@ -19,13 +21,14 @@ class Node(OrgModelMixin):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True)
     key = models.CharField(unique=True, max_length=64, verbose_name=_("Key"))  # '1:1:1:1'
     value = models.CharField(max_length=128, verbose_name=_("Value"))
+    level = models.IntegerField(default=1, db_index=True, verbose_name=_("Level"))
     child_mark = models.IntegerField(default=0)
     date_create = models.DateTimeField(auto_now_add=True)
 
     is_node = True
     _assets_amount = None
-    _full_value_cache_key = '_NODE_VALUE_{}'
     _assets_amount_cache_key = '_NODE_ASSETS_AMOUNT_{}'
+    _assets_amount_cache_timeout = 3600
 
     class Meta:
         verbose_name = _("Node")
@@ -33,6 +36,10 @@ class Node(OrgModelMixin):
     def __str__(self):
         return self.full_value
 
+    def save(self, *args, **kwargs):
+        self.level = self.compute_level(self.key)
+        return super().save(*args, **kwargs)
+
     def __eq__(self, other):
         if not other:
             return False
@@ -65,7 +72,7 @@ class Node(OrgModelMixin):
         if cached is not None:
             return cached
         assets_amount = self.get_all_assets().count()
-        cache.set(cache_key, assets_amount, 3600)
+        cache.set(cache_key, assets_amount, self._assets_amount_cache_timeout)
         return assets_amount
 
     @assets_amount.setter
@@ -83,44 +90,134 @@ class Node(OrgModelMixin):
             for node in nodes:
                 node.expire_assets_amount()
             return
-        key = cls._assets_amount_cache_key.format('*')
-        cache.delete_pattern(key)
+        # 不再使用 delete_pattern 扫描整个 keyspace, 直接整体重新计算
+        cls.refresh_nodes_assets_amount()
+
+    @classmethod
+    def get_nodes_ancestor_keys(cls, nodes_keys, with_self=True):
+        keys = set()
+        for key in nodes_keys:
+            keys.update(cls(key=key).get_ancestor_keys(with_self=with_self))
+        return keys
+
+    @classmethod
+    def incr_nodes_assets_amount(cls, deltas):
+        """
+        按增量更新缓存中的节点资产数量
+        :param deltas: {node_key: delta}
+        缓存中没有的节点不处理, 读取时会整体重新计算
+        """
+        for key, delta in deltas.items():
+            if not delta:
+                continue
+            cache_key = cls._assets_amount_cache_key.format(key)
+            try:
+                cache.incr(cache_key, delta)
+            except ValueError:
+                continue
+
+    @classmethod
+    def refresh_nodes_assets_amount(cls):
+        """
+        一次性计算所有节点的资产数量: 只查询一次资产节点关系表,
+        在内存中把资产汇总到各级祖先节点, 再用 set_many 写入缓存
+        :return: {cache_key: amount}
+        """
+        from .asset import Asset
+        _current_org = get_current_org()
+        set_current_org(Organization.root())
+        try:
+            nodes = list(cls.objects.all().values_list('key', 'org_id'))
+            relations = Asset.nodes.through.objects.all()\
+                .values_list('asset_id', 'node__key')
+            # 没有节点的资产属于所在组织的根节点
+            orphans = Asset.objects.filter(nodes=None)\
+                .values_list('id', 'org_id')
+
+            ancestors_cache = {}
+            assets_by_key = defaultdict(set)
+            for asset_id, key in relations:
+                ancestor_keys = ancestors_cache.get(key)
+                if ancestor_keys is None:
+                    ancestor_keys = cls(key=key).get_ancestor_keys(with_self=True)
+                    ancestors_cache[key] = ancestor_keys
+                for ancestor_key in ancestor_keys:
+                    assets_by_key[ancestor_key].add(asset_id)
+
+            roots_by_org = defaultdict(list)
+            for key, org_id in nodes:
+                if key.isdigit():
+                    roots_by_org[org_id].append(key)
+            for asset_id, org_id in orphans:
+                for key in roots_by_org.get(org_id, []):
+                    assets_by_key[key].add(asset_id)
+        finally:
+            set_current_org(_current_org)
+
+        amounts = {
+            cls._assets_amount_cache_key.format(key): len(assets_by_key.get(key, []))
+            for key, org_id in nodes
+        }
+        cache.set_many(amounts, cls._assets_amount_cache_timeout)
+        return amounts
+
+    @classmethod
+    def prefetch_nodes_assets_amount(cls, nodes):
+        """
+        批量设置节点的资产数量, 缓存不全时整体重新计算, 避免逐个节点 count
+        """
+        nodes_cache_keys = {
+            cls._assets_amount_cache_key.format(node.key): node for node in nodes
+        }
+        amounts = cache.get_many(list(nodes_cache_keys.keys()))
+        if len(amounts) < len(nodes_cache_keys):
+            amounts = cls.refresh_nodes_assets_amount()
+        for cache_key, node in nodes_cache_keys.items():
+            amount = amounts.get(cache_key)
+            if amount is not None:
+                node.assets_amount = amount
+        return nodes
 
     @property
     def full_value(self):
-        key = self._full_value_cache_key.format(self.key)
-        cached = cache.get(key)
-        if cached:
-            return cached
         if self.is_root():
             return self.value
-        parent_full_value = self.parent.full_value
-        value = parent_full_value + ' / ' + self.value
-        key = self._full_value_cache_key.format(self.key)
-        cache.set(key, value, 3600)
-        return value
+        parent_full_value = get_node_tree().get_full_value(self.parent_key)
+        if parent_full_value is None:
+            # 当前事务中新建的节点还不在快照中
+            parent_full_value = self.parent.full_value
+        return parent_full_value + ' / ' + self.value
 
     def expire_full_value(self):
-        key = self._full_value_cache_key.format(self.key)
-        cache.delete_pattern(key+'*')
+        expire_node_tree()
 
     @classmethod
     def expire_nodes_full_value(cls, nodes=None):
-        if nodes:
-            for node in nodes:
-                node.expire_full_value()
-            return
-        key = cls._full_value_cache_key.format('*')
-        cache.delete_pattern(key+'*')
+        expire_node_tree()
 
-    @property
-    def level(self):
-        return len(self.key.split(':'))
+    @staticmethod
+    def compute_level(key):
+        return len(str(key).split(':'))
+
+    @staticmethod
+    def descendant_key_q(key, field='key'):
+        """
+        子孙节点的 key 都以 `key:` 开头, 使用范围查询代替正则, 可以使用索引
+        key >= '1:2:' and key < '1:2;'  (';' 是 ':' 的下一个字符)
+        """
+        return Q(**{
+            '{}__gte'.format(field): key + ':',
+            '{}__lt'.format(field): key + ';',
+        })
+
+    @classmethod
+    def subtree_key_q(cls, key, field='key'):
+        return Q(**{field: key}) | cls.descendant_key_q(key, field=field)
 
     def get_next_child_key(self):
         mark = self.child_mark
         self.child_mark += 1
-        self.save()
+        self.save(update_fields=['child_mark'])
         return "{}:{}".format(self.key, mark)
 
     def get_next_child_preset_name(self):
@@ -141,23 +238,27 @@ class Node(OrgModelMixin):
             return child
 
     def get_children(self, with_self=False):
-        pattern = r'^{0}$|^{0}:[0-9]+$' if with_self else r'^{0}:[0-9]+$'
-        return self.__class__.objects.filter(
-            key__regex=pattern.format(self.key)
-        )
+        level = self.compute_level(self.key)
+        q = self.descendant_key_q(self.key) & Q(level=level + 1)
+        if with_self:
+            q |= Q(key=self.key)
+        return self.__class__.objects.filter(q)
 
     def get_all_children(self, with_self=False):
-        pattern = r'^{0}$|^{0}:' if with_self else r'^{0}'
-        return self.__class__.objects.filter(
-            key__regex=pattern.format(self.key)
-        )
+        if with_self:
+            q = self.subtree_key_q(self.key)
+        else:
+            q = self.descendant_key_q(self.key)
+        return self.__class__.objects.filter(q)
 
     def get_sibling(self, with_self=False):
-        key = ':'.join(self.key.split(':')[:-1])
-        pattern = r'^{}:[0-9]+$'.format(key)
-        sibling = self.__class__.objects.filter(
-            key__regex=pattern.format(self.key)
-        )
+        level = self.compute_level(self.key)
+        if self.is_root():
+            sibling = self.__class__.objects.filter(level=1)
+        else:
+            sibling = self.__class__.objects.filter(
+                self.descendant_key_q(self.parent_key), level=level
+            )
         if not with_self:
             sibling = sibling.exclude(key=self.key)
         return sibling
@@ -180,14 +281,10 @@ class Node(OrgModelMixin):
 
     def get_all_assets(self):
         from .asset import Asset
-        pattern = r'^{0}$|^{0}:'.format(self.key)
-        args = []
-        kwargs = {}
+        q = self.subtree_key_q(self.key, field='nodes__key')
         if self.is_root():
-            args.append(Q(nodes__key__regex=pattern) | Q(nodes=None))
-        else:
-            kwargs['nodes__key__regex'] = pattern
-        assets = Asset.objects.filter(*args, **kwargs).distinct()
+            q |= Q(nodes=None)
+        assets = Asset.objects.filter(q).distinct()
         return assets
 
     def get_all_valid_assets(self):
@@ -211,6 +308,9 @@ class Node(OrgModelMixin):
     def parent(self):
         if self.is_root():
             return self
+        parent = get_node_tree().get_node(self.parent_key)
+        if parent is not None:
+            return parent
         try:
             parent = self.__class__.objects.get(key=self.parent_key)
             return parent
@@ -256,7 +356,7 @@ class Node(OrgModelMixin):
             if not _current_org.is_real():
                 return cls.default_node()
             set_current_org(Organization.root())
-            org_nodes_roots = cls.objects.filter(key__regex=r'^[0-9]+$')
+            org_nodes_roots = cls.objects.filter(level=1)
             org_nodes_roots_keys = org_nodes_roots.values_list('key', flat=True) or ['1']
             key = max([int(k) for k in org_nodes_roots_keys])
             key = str(key + 1) if key != 0 else '2'
@@ -266,7 +366,7 @@ class Node(OrgModelMixin):
 
     @classmethod
     def root(cls):
-        root = cls.objects.filter(key__regex=r'^[0-9]+$')
+        root = cls.objects.filter(level=1)
         if root:
             return root[0]
         else:
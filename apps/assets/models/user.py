@@ -11,6 +11,7 @@ from django.core.validators import MinValueValidator, MaxValueValidator
 
 from common.utils import get_signer
 from ..const import SYSTEM_USER_CONN_CACHE_KEY
+from ..connectivity import ConnectivityStore
 from .base import AssetUser
 
 
@@ -31,7 +32,6 @@ class AdminUser(AssetUser):
     become_method = models.CharField(choices=BECOME_METHOD_CHOICES, default='sudo', max_length=4)
     become_user = models.CharField(default='root', max_length=64)
     _become_pass = models.CharField(default='', max_length=128)
-    CONNECTIVE_CACHE_KEY = '_JMS_ADMIN_USER_CONNECTIVE_{}'
 
     def __str__(self):
         return self.name
@@ -70,20 +70,8 @@ class AdminUser(AssetUser):
 
     @property
     def connectivity(self):
-        from .asset import Asset
-        assets = self.get_related_assets().values_list('id', 'hostname', flat=True)
-        data = {
-            'unreachable': [],
-            'reachable': [],
-        }
-        for asset_id, hostname in assets:
-            key = Asset.CONNECTIVITY_CACHE_KEY.format(str(self.id))
-            value = cache.get(key, Asset.UNKNOWN)
-            if value == Asset.REACHABLE:
-                data['reachable'].append(hostname)
-            elif value == Asset.UNREACHABLE:
-                data['unreachable'].append(hostname)
-        return data
+        assets = self.get_related_assets().values_list('id', 'hostname')
+        return self.get_assets_connectivity(assets)
 
     class Meta:
         ordering = ['name']
@@ -141,7 +129,6 @@ class SystemUser(AssetUser):
     cmd_filters = models.ManyToManyField('CommandFilter', related_name='system_users', verbose_name=_("Command filter"), blank=True)
 
     SYSTEM_USER_CACHE_KEY = "__SYSTEM_USER_CACHED_{}"
-    CONNECTIVE_CACHE_KEY = '_JMS_SYSTEM_USER_CONNECTIVE_{}'
 
     def __str__(self):
         return '{0.name}({0.username})'.format(self)
@@ -162,31 +149,24 @@ class SystemUser(AssetUser):
 
     @property
     def connectivity(self):
-        cache_key = self.CONNECTIVE_CACHE_KEY.format(str(self.id))
-        value = cache.get(cache_key, None)
-        if not value or 'unreachable' not in value:
-            return {'unreachable': [], 'reachable': []}
-        else:
-            return value
+        assets = [(a.id, a.hostname) for a in self.get_related_assets()]
+        return self.get_assets_connectivity(assets)
 
     @connectivity.setter
     def connectivity(self, value):
-        data = self.connectivity
-        unreachable = data['unreachable']
-        reachable = data['reachable']
-
-        for host in value.get('dark', {}).keys():
-            if host not in unreachable:
-                unreachable.append(host)
-            if host in reachable:
-                reachable.remove(host)
-        for host in value.get('contacted'):
-            if host not in reachable:
-                reachable.append(host)
-            if host in unreachable:
-                unreachable.remove(host)
-        cache_key = self.CONNECTIVE_CACHE_KEY.format(str(self.id))
-        cache.set(cache_key, data, 3600)
+        """
+        :param value: 测试结果的 summary, {"contacted": {}, "dark": {}, "latency": {}}
+        """
+        assets = {a.hostname: str(a.id) for a in self.get_related_assets()}
+        latency = value.get('latency', {})
+        items = []
+        for status, hosts in ((self.UNREACHABLE, value.get('dark', {})),
+                              (self.REACHABLE, value.get('contacted', []))):
+            for host in hosts:
+                if host not in assets:
+                    continue
+                items.append((assets[host], str(self.id), status, latency.get(host)))
+        ConnectivityStore(self.org_id).set_many(items)
 
     @property
     def assets_unreachable(self):
@@ -221,13 +201,8 @@ class SystemUser(AssetUser):
         return rules
 
     def is_command_can_run(self, command):
-        for rule in self.cmd_filter_rules:
-            action, matched_cmd = rule.match(command)
-            if action == rule.ACTION_ALLOW:
-                return True, None
-            elif action == rule.ACTION_DENY:
-                return False, matched_cmd
-        return True, None
+        from ..cmd_filter_matcher import get_command_filter_matcher
+        return get_command_filter_matcher(self).is_command_can_run(command)
 
     @classmethod
     def get_system_user_by_id_or_cached(cls, sid):
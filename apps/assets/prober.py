@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+"""
+不通过 ansible 测试资产的可连接性
+
+ansible 的 ping 需要在远端启动 python 并上传模块, 这里只检查 tcp 连接和 ssh 认证,
+使用有上限的线程池并发执行. 网域中的资产通过网关的 direct-tcpip 通道连接,
+同一个网关只建立一个 ssh 连接, 所有通道复用这个连接.
+"""
+import time
+import random
+import socket
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+
+from common.utils import get_logger
+
+__all__ = ['SSHProber', 'get_probe_targets', 'probe_assets']
+logger = get_logger(__file__)
+
+
+def get_user_auth(user):
+    return {
+        'username': user.username,
+        'password': user.password,
+        'pkey': user.private_key_obj,
+    }
+
+
+def get_probe_targets(assets, system_user=None):
+    """
+    :param system_user: 为 None 时使用资产的管理用户
+    :return: [{"hostname", "ip", "port", "auth", "gateway"}], 认证信息
+        每个用户只解密一次
+    """
+    from .models import Gateway
+    assets = list(assets)
+    # 调用方传入的通常是列表, 一次查询所有资产的管理用户
+    if system_user is None:
+        prefetch_related_objects(assets, 'admin_user')
+    domains_id = {asset.domain_id for asset in assets if asset.domain_id}
+    gateways = defaultdict(list)
+    if domains_id:
+        for gateway in Gateway.objects.filter(domain_id__in=domains_id, is_active=True):
+            gateways[gateway.domain_id].append(gateway)
+
+    auth_cache = {}
+    gateway_cache = {}
+
+    def get_auth(user):
+        if user.id not in auth_cache:
+            auth_cache[user.id] = get_user_auth(user)
+        return auth_cache[user.id]
+
+    def get_gateway(gateway):
+        if gateway.id not in gateway_cache:
+            gateway_cache[gateway.id] = {
+                'id': str(gateway.id), 'ip': gateway.ip, 'port': gateway.port,
+                'auth': get_user_auth(gateway),
+            }
+        return gateway_cache[gateway.id]
+
+    targets = []
+    for asset in assets:
+        user = system_user or asset.admin_user
+        if user is None:
+            continue
+        gateway = None
+        if gateways.get(asset.domain_id):
+            gateway = get_gateway(random.choice(gateways[asset.domain_id]))
+        targets.append({
+            'hostname': asset.hostname, 'ip': asset.ip, 'port': asset.port,
+            'auth': get_auth(user), 'gateway': gateway,
+        })
+    return targets
+
+
+class SSHProber:
+    """
+    probe 返回 (是否可连接, 错误信息, 耗时毫秒)
+    """
+    def __init__(self, timeout=None, workers=None):
+        self.timeout = timeout or settings.ASSETS_PROBE_TIMEOUT
+        self.workers = workers or settings.ASSETS_PROBE_WORKERS
+        self._gateway_transports = {}
+        # 连接失败的网关记录异常, 本次运行中后面的资产直接失败, 不再等待超时
+        self._gateway_errors = {}
+        self._gateway_locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def auth(transport, auth):
+        username = auth['username']
+        password = auth.get('password')
+        if auth.get('pkey'):
+            try:
+                transport.auth_publickey(username, auth['pkey'])
+                return
+            except paramiko.AuthenticationException:
+                if not password:
+                    raise
+        if not password:
+            raise paramiko.AuthenticationException("No password or private key")
+        transport.auth_password(username, password)
+
+    def start_transport(self, sock, auth):
+        transport = paramiko.Transport(sock)
+        transport.banner_timeout = self.timeout
+        transport.auth_timeout = self.timeout
+        try:
+            transport.start_client(timeout=self.timeout)
+            self.auth(transport, auth)
+        except Exception:
+            transport.close()
+            raise
+        return transport
+
+    def get_gateway_transport(self, gateway):
+        with self._lock:
+            lock = self._gateway_locks[gateway['id']]
+        with lock:
+            error = self._gateway_errors.get(gateway['id'])
+            if error is not None:
+                raise error.with_traceback(None)
+            transport = self._gateway_transports.get(gateway['id'])
+            if transport is None or not transport.is_active():
+                try:
+                    sock = socket.create_connection(
+                        (gateway['ip'], gateway['port']), timeout=self.timeout
+                    )
+                    transport = self.start_transport(sock, gateway['auth'])
+                except Exception as e:
+                    self._gateway_errors[gateway['id']] = e
+                    raise
+                self._gateway_transports[gateway['id']] = transport
+            return transport
+
+    def open_sock(self, target):
+        addr = (target['ip'], target['port'])
+        gateway = target.get('gateway')
+        if gateway is None:
+            return socket.create_connection(addr, timeout=self.timeout)
+        transport = self.get_gateway_transport(gateway)
+        return transport.open_channel(
+            'direct-tcpip', addr, ('127.0.0.1', 0), timeout=self.timeout
+        )
+
+    def probe(self, target):
+        start = time.time()
+        sock = transport = None
+        try:
+            sock = self.open_sock(target)
+            transport = self.start_transport(sock, target['auth'])
+            ok, error = True, ''
+        except Exception as e:
+            ok, error = False, str(e) or e.__class__.__name__
+        finally:
+            if transport is not None:
+                transport.close()
+            elif sock is not None:
+                sock.close()
+        return ok, error, int((time.time() - start) * 1000)
+
+    def close(self):
+        for transport in self._gateway_transports.values():
+            transport.close()
+        self._gateway_transports = {}
+        self._gateway_errors = {}
+
+    def run(self, targets):
+        """
+        :return: {hostname: (是否可连接, 错误信息, 耗时毫秒)}
+        """
+        if not targets:
+            return {}
+        workers = min(self.workers, len(targets))
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(self.probe, targets)
+                return {
+                    target['hostname']: result
+                    for target, result in zip(targets, results)
+                }
+        finally:
+            self.close()
+
+
+def probe_assets(assets, system_user=None):
+    """
+    返回和 ansible ping 相同格式的 summary, 另外 latency 中记录每个资产的耗时
+    {"contacted": {"hostname": {}}, "dark": {"hostname": {"ping": {"msg": ""}}},
+     "latency": {"hostname": 12}}
+    """
+    targets = get_probe_targets(assets, system_user=system_user)
+    summary = {'contacted': {}, 'dark': {}, 'latency': {}}
+    for hostname, (ok, error, latency) in SSHProber().run(targets).items():
+        if ok:
+            summary['contacted'][hostname] = {}
+        else:
+            summary['dark'][hostname] = {'ping': {'msg': error}}
+        summary['latency'][hostname] = latency
+    return summary
@@ -20,7 +20,8 @@ class AssetSerializer(BulkSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Asset
         list_serializer_class = BulkListSerializer
-        fields = '__all__'
+        # ip_number 只用于排序, 不对外提供
+        exclude = ('ip_number',)
         validators = []
 
     @classmethod
@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 #
 from collections import defaultdict
-from django.db.models.signals import post_save, m2m_changed, post_delete
+from django.db import transaction
+from django.db.models.signals import post_save, m2m_changed, post_delete, \
+    pre_delete, pre_save
 from django.dispatch import receiver
+from django.core.cache import cache
 
 from common.utils import get_logger
-from .models import Asset, SystemUser, Node
+from .models import Asset, SystemUser, Node, CommandFilter, CommandFilterRule
+from .tree import expire_node_tree
+from .cmd_filter_matcher import expire_command_filter_matchers
 from .tasks import update_assets_hardware_info_util, \
-    test_asset_connectivity_util, push_system_user_to_assets
+    test_asset_connectivity_util, push_system_user_to_assets, \
+    refresh_nodes_assets_amount_util
 
 
 logger = get_logger(__file__)
@@ -28,6 +34,55 @@ def set_asset_root_node(asset):
     asset.nodes.add(Node.root())
 
 
+def get_assets_nodes_keys(assets_id):
+    relations = Asset.nodes.through.objects.filter(asset_id__in=assets_id)\
+        .values_list('asset_id', 'node__key')
+    assets_nodes_keys = defaultdict(set)
+    for asset_id, key in relations:
+        assets_nodes_keys[asset_id].add(key)
+    return assets_nodes_keys
+
+
+def update_nodes_assets_amount(before, after):
+    """
+    根据资产变更前后所在的节点, 计算各祖先节点资产数量的增量, 事务提交后写入缓存
+    没有节点的资产算在根节点下, 不在 before/after 中表示资产不存在
+    :param before: {asset_id: set(node_key)}
+    :param after: {asset_id: set(node_key)}
+    """
+    root_keys = set()
+
+    def get_counted_keys(nodes_keys):
+        if nodes_keys is None:
+            return set()
+        keys = Node.get_nodes_ancestor_keys(nodes_keys)
+        if keys:
+            return keys
+        if not root_keys:
+            root_keys.add(Node.root().key)
+        return root_keys
+
+    deltas = defaultdict(int)
+    for asset_id in set(before) | set(after):
+        before_keys = get_counted_keys(before.get(asset_id))
+        after_keys = get_counted_keys(after.get(asset_id))
+        for key in after_keys - before_keys:
+            deltas[key] += 1
+        for key in before_keys - after_keys:
+            deltas[key] -= 1
+    if not deltas:
+        return
+    transaction.on_commit(lambda: Node.incr_nodes_assets_amount(deltas))
+
+
+def refresh_nodes_assets_amount_on_commit():
+    # 移动节点会批量修改子节点 key, 合并成一次延迟的整体计算
+    def schedule():
+        if cache.add('_NODE_ASSETS_AMOUNT_REFRESH_SCHEDULED', 1, 10):
+            refresh_nodes_assets_amount_util.apply_async(countdown=10)
+    transaction.on_commit(schedule)
+
+
 @receiver(post_save, sender=Asset, dispatch_uid="my_unique_identifier")
 def on_asset_created_or_update(sender, instance=None, created=False, **kwargs):
     if created:
@@ -35,16 +90,22 @@ def on_asset_created_or_update(sender, instance=None, created=False, **kwargs):
         update_asset_hardware_info_on_created(instance)
         test_asset_conn_on_created(instance)
 
-        # 过期节点资产数量
-        nodes = instance.nodes.all()
-        Node.expire_nodes_assets_amount(nodes)
+        # 新建的资产还没有节点, 先算在根节点下
+        update_nodes_assets_amount({}, {instance.id: set()})
+
+
+@receiver(pre_delete, sender=Asset, dispatch_uid="my_unique_identifier")
+def on_asset_pre_delete(sender, instance=None, **kwargs):
+    # post_delete 时关联关系已经删除
+    instance._nodes_keys_before_delete = set(
+        instance.nodes.values_list('key', flat=True)
+    )
 
 
 @receiver(post_delete, sender=Asset, dispatch_uid="my_unique_identifier")
 def on_asset_delete(sender, instance=None, **kwargs):
-    # 过期节点资产数量
-    nodes = instance.nodes.all()
-    Node.expire_nodes_assets_amount(nodes)
+    nodes_keys = getattr(instance, '_nodes_keys_before_delete', set())
+    update_nodes_assets_amount({instance.id: nodes_keys}, {})
 
 
 @receiver(post_save, sender=SystemUser, dispatch_uid="my_unique_identifier")
@@ -76,12 +137,8 @@ def on_system_user_assets_change(sender, instance=None, **kwargs):
 def on_asset_node_changed(sender, instance=None, **kwargs):
     logger.debug("Asset nodes change signal received")
     if isinstance(instance, Asset):
-        if kwargs['action'] == 'pre_remove':
-            nodes = kwargs['model'].objects.filter(pk__in=kwargs['pk_set'])
-            Node.expire_nodes_assets_amount(nodes)
         if kwargs['action'] == 'post_add':
             nodes = kwargs['model'].objects.filter(pk__in=kwargs['pk_set'])
-            Node.expire_nodes_assets_amount(nodes)
             system_users_assets = defaultdict(set)
             system_users = SystemUser.objects.filter(nodes__in=nodes)
             # 清理节点缓存
@@ -95,8 +152,6 @@ def on_asset_node_changed(sender, instance=None, **kwargs):
 def on_node_assets_changed(sender, instance=None, **kwargs):
     if isinstance(instance, Node):
         logger.debug("Node assets change signal {} received".format(instance))
-        # 当节点和资产关系发生改变时，过期资产数量缓存
-        instance.expire_assets_amount()
         assets = kwargs['model'].objects.filter(pk__in=kwargs['pk_set'])
         if kwargs['action'] == 'post_add':
             # 重新关联系统用户和资产的关系
@@ -105,7 +160,89 @@ def on_node_assets_changed(sender, instance=None, **kwargs):
                 system_user.assets.add(*tuple(assets))
 
 
+@receiver(m2m_changed, sender=Asset.nodes.through)
+def on_asset_nodes_changed_update_amount(sender, instance=None, action='',
+                                         model=None, pk_set=None, **kwargs):
+    """
+    资产和节点关系变化时按增量更新祖先节点的资产数量, 不再过期缓存
+    """
+    if action == 'pre_clear':
+        # post_clear 时拿不到被清理的关系
+        if isinstance(instance, Asset):
+            instance._nodes_keys_before_clear = set(
+                instance.nodes.values_list('key', flat=True)
+            )
+        else:
+            instance._assets_id_before_clear = set(
+                instance.assets.values_list('id', flat=True)
+            )
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if isinstance(instance, Asset):
+        after_keys = set(instance.nodes.values_list('key', flat=True))
+        if action == 'post_clear':
+            before_keys = getattr(instance, '_nodes_keys_before_clear', set())
+        else:
+            changed_keys = set(
+                model.objects.filter(pk__in=pk_set).values_list('key', flat=True)
+            )
+            if action == 'post_add':
+                before_keys = after_keys - changed_keys
+            else:
+                before_keys = after_keys | changed_keys
+        update_nodes_assets_amount(
+            {instance.id: before_keys}, {instance.id: after_keys}
+        )
+    elif isinstance(instance, Node):
+        if action == 'post_clear':
+            assets_id = getattr(instance, '_assets_id_before_clear', set())
+        else:
+            assets_id = pk_set or set()
+        after = get_assets_nodes_keys(assets_id)
+        before = {}
+        for asset_id in assets_id:
+            if action == 'post_add':
+                before[asset_id] = after[asset_id] - {instance.key}
+            else:
+                before[asset_id] = after[asset_id] | {instance.key}
+        update_nodes_assets_amount(before, after)
+
+
+@receiver(pre_save, sender=Node)
+def on_node_pre_save(sender, instance=None, update_fields=None, **kwargs):
+    # 记录修改前的 key, 用来判断节点是否移动
+    if update_fields is not None and 'key' not in update_fields:
+        instance._old_key = instance.key
+        return
+    instance._old_key = Node.objects.filter(pk=instance.pk)\
+        .values_list('key', flat=True).first()
+
+
 @receiver(post_save, sender=Node)
 def on_node_update_or_created(sender, instance=None, created=False, **kwargs):
-    if instance and not created:
-        instance.expire_full_value()
+    # 新建、改名、移动都会改变节点树, 让各 worker 重建节点树快照
+    expire_node_tree()
+    # 只有移动节点会改变资产数量, 改名和 child_mark 的修改不需要重新计算
+    old_key = getattr(instance, '_old_key', None)
+    if not created and old_key and old_key != instance.key:
+        refresh_nodes_assets_amount_on_commit()
+
+
+@receiver(post_delete, sender=Node)
+def on_node_delete(sender, instance=None, **kwargs):
+    expire_node_tree()
+    refresh_nodes_assets_amount_on_commit()
+
+
+@receiver(post_save, sender=CommandFilter)
+@receiver(post_delete, sender=CommandFilter)
+@receiver(post_save, sender=CommandFilterRule)
+@receiver(post_delete, sender=CommandFilterRule)
+@receiver(m2m_changed, sender=SystemUser.cmd_filters.through)
+def on_cmd_filter_changed(sender, action=None, **kwargs):
+    # m2m_changed 只处理 post_add, post_remove, post_clear
+    if action and not action.startswith('post'):
+        return
+    expire_command_filter_matchers()
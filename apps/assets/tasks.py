@@ -4,6 +4,7 @@ import re
 import os
 
 from celery import shared_task
+from django.conf import settings
 from django.utils.translation import ugettext as _
 from django.core.cache import cache
 
@@ -11,17 +12,19 @@ from common.utils import (
     capacity_convert, sum_capacity, encrypt_password, get_logger
 )
 from ops.celery.decorator import (
-    register_as_period_task, after_app_shutdown_clean_periodic
+    register_as_period_task, after_app_shutdown_clean_periodic,
+    after_app_ready_start
 )
 
-from .models import SystemUser, AdminUser, Asset
+from .models import SystemUser, AdminUser, Asset, Node
+from .connectivity import ConnectivityStore
+from .prober import probe_assets
 from . import const
 
 
 FORKS = 10
 TIMEOUT = 60
 logger = get_logger(__file__)
-CACHE_MAX_TIME = 60*60*2
 disk_pattern = re.compile(r'^hd|sd|xvd|vd')
 PERIOD_TASK = os.environ.get("PERIOD_TASK", "on")
 
@@ -43,6 +46,49 @@ def clean_hosts(assets):
     return clean_assets
 
 
+def set_asset_hardware_info(asset, info):
+    """
+    :param info: setup 模块返回的 ansible_facts
+    """
+    ___vendor = info.get('ansible_system_vendor', 'Unknown')
+    ___model = info.get('ansible_product_name', 'Unknown')
+    ___sn = info.get('ansible_product_serial', 'Unknown')
+
+    for ___cpu_model in info.get('ansible_processor', []):
+        if ___cpu_model.endswith('GHz') or ___cpu_model.startswith("Intel"):
+            break
+    else:
+        ___cpu_model = 'Unknown'
+    ___cpu_model = ___cpu_model[:64]
+    ___cpu_count = info.get('ansible_processor_count', 0)
+    ___cpu_cores = info.get('ansible_processor_cores', None) or \
+                   len(info.get('ansible_processor', []))
+    ___cpu_vcpus = info.get('ansible_processor_vcpus', 0)
+    ___memory = '%s %s' % capacity_convert(
+        '{} MB'.format(info.get('ansible_memtotal_mb'))
+    )
+    disk_info = {}
+    for dev, dev_info in info.get('ansible_devices', {}).items():
+        if disk_pattern.match(dev) and dev_info['removable'] == '0':
+            disk_info[dev] = dev_info['size']
+    ___disk_total = '%s %s' % sum_capacity(disk_info.values())
+    ___disk_info = json.dumps(disk_info)
+
+    ___platform = info.get('ansible_system', 'Unknown')
+    ___os = info.get('ansible_distribution', 'Unknown')
+    ___os_version = info.get('ansible_distribution_version', 'Unknown')
+    ___os_arch = info.get('ansible_architecture', 'Unknown')
+    ___hostname_raw = info.get('ansible_hostname', 'Unknown')
+
+    fields = []
+    for k, v in locals().items():
+        if k.startswith('___'):
+            setattr(asset, k.strip('_'), v)
+            fields.append(k.strip('_'))
+    asset.save(update_fields=fields)
+    return asset
+
+
 @shared_task
 def set_assets_hardware_info(assets, result, **kwargs):
     """
@@ -66,41 +112,31 @@ def set_assets_hardware_info(assets, result, **kwargs):
         if not info:
             logger.error(_("Get asset info failed: {}").format(hostname))
             continue
-        ___vendor = info.get('ansible_system_vendor', 'Unknown')
-        ___model = info.get('ansible_product_name', 'Unknown')
-        ___sn = info.get('ansible_product_serial', 'Unknown')
+        set_asset_hardware_info(asset, info)
+        assets_updated.append(asset)
+    return assets_updated
 
-        for ___cpu_model in info.get('ansible_processor', []):
-            if ___cpu_model.endswith('GHz') or ___cpu_model.startswith("Intel"):
-                break
-        else:
-            ___cpu_model = 'Unknown'
-        ___cpu_model = ___cpu_model[:64]
-        ___cpu_count = info.get('ansible_processor_count', 0)
-        ___cpu_cores = info.get('ansible_processor_cores', None) or \
-                       len(info.get('ansible_processor', []))
-        ___cpu_vcpus = info.get('ansible_processor_vcpus', 0)
-        ___memory = '%s %s' % capacity_convert(
-            '{} MB'.format(info.get('ansible_memtotal_mb'))
-        )
-        disk_info = {}
-        for dev, dev_info in info.get('ansible_devices', {}).items():
-            if disk_pattern.match(dev) and dev_info['removable'] == '0':
-                disk_info[dev] = dev_info['size']
-        ___disk_total = '%s %s' % sum_capacity(disk_info.values())
-        ___disk_info = json.dumps(disk_info)
-
-        ___platform = info.get('ansible_system', 'Unknown')
-        ___os = info.get('ansible_distribution', 'Unknown')
-        ___os_version = info.get('ansible_distribution_version', 'Unknown')
-        ___os_arch = info.get('ansible_architecture', 'Unknown')
-        ___hostname_raw = info.get('ansible_hostname', 'Unknown')
-
-        for k, v in locals().items():
-            if k.startswith('___'):
-                setattr(asset, k.strip('_'), v)
-        asset.save()
+
+def set_assets_hardware_info_from_history(assets, history_id):
+    """
+    流式执行时 facts 保存在每个主机的结果中, 逐条读取, 不需要全部加载到内存
+    """
+    from ops.models import AdHocRunHostResult
+    assets_map = {asset.hostname: asset for asset in assets}
+    host_results = AdHocRunHostResult.objects.filter(
+        history_id=history_id, task_name='setup',
+        status=AdHocRunHostResult.STATUS_OK,
+    )
+    assets_updated = []
+    for host_result in host_results.iterator():
+        asset = assets_map.pop(host_result.hostname, None)
+        info = host_result.result.get('ansible_facts', {})
+        if asset is None or not info:
+            continue
+        set_asset_hardware_info(asset, info)
         assets_updated.append(asset)
+    for hostname in assets_map:
+        logger.error(_("Get asset info failed: {}").format(hostname))
     return assets_updated
 
 
@@ -124,8 +160,11 @@ def update_assets_hardware_info_util(assets, task_name=None):
         task_name, hosts=hosts, tasks=tasks, created_by=created_by,
         pattern='all', options=const.TASK_OPTIONS, run_as_admin=True,
     )
-    result = task.run()
-    set_assets_hardware_info(assets, result)
+    # setup 的 facts 很大, 主机结果直接写入数据库, 不保存在内存中
+    result = task.run(stream=True)
+    history_id = result[1].get('history')
+    if history_id:
+        set_assets_hardware_info_from_history(hosts, history_id)
     return result
 
 
@@ -151,6 +190,20 @@ def update_assets_hardware_info_period():
 ##  ADMIN USER CONNECTIVE  ##
 
 
+def set_assets_connectivity_info(assets, summary):
+    latency = summary.get('latency', {})
+    items = []
+    for asset in assets:
+        if asset.hostname in summary.get('dark', {}):
+            value = asset.UNREACHABLE
+        elif asset.hostname in summary.get('contacted', []):
+            value = asset.REACHABLE
+        else:
+            value = asset.UNKNOWN
+        items.append((asset, value, latency.get(asset.hostname)))
+    Asset.set_assets_connectivity_status(items)
+
+
 @shared_task
 def test_asset_connectivity_util(assets, task_name=None):
     from ops.utils import update_or_create_ansible_task
@@ -160,21 +213,20 @@ def test_asset_connectivity_util(assets, task_name=None):
     hosts = clean_hosts(assets)
     if not hosts:
         return {}
+    if settings.ASSETS_NATIVE_PROBE:
+        summary = probe_assets(hosts)
+        set_assets_connectivity_info(assets, summary)
+        return summary
     tasks = const.TEST_ADMIN_USER_CONN_TASKS
     created_by = assets[0].org_id
     task, created = update_or_create_ansible_task(
         task_name=task_name, hosts=hosts, tasks=tasks, pattern='all',
         options=const.TASK_OPTIONS, run_as_admin=True, created_by=created_by,
     )
-    result = task.run()
+    # 需要 summary 中的主机列表, 分片执行时也不使用流式结果
+    result = task.run(stream=False)
     summary = result[1]
-    for asset in assets:
-        if asset.hostname in summary.get('dark', {}):
-            asset.connectivity = asset.UNREACHABLE
-        elif asset.hostname in summary.get('contacted', []):
-            asset.connectivity = asset.REACHABLE
-        else:
-            asset.connectivity = asset.UNKNOWN
+    set_assets_connectivity_info(assets, summary)
     return summary
 
 
@@ -256,12 +308,17 @@ def test_system_user_connectivity_util(system_user, assets, task_name):
     hosts = clean_hosts(assets)
     if not hosts:
         return {}
+    if settings.ASSETS_NATIVE_PROBE:
+        summary = probe_assets(hosts, system_user=system_user)
+        result = ({}, summary)
+        set_system_user_connectivity_info(system_user, result)
+        return result
     task, created = update_or_create_ansible_task(
         task_name, hosts=hosts, tasks=tasks, pattern='all',
         options=const.TASK_OPTIONS,
         run_as=system_user, created_by=system_user.org_id,
     )
-    result = task.run()
+    result = task.run(stream=False)
     set_system_user_connectivity_info(system_user, result)
     return result
 
@@ -419,5 +476,30 @@ def test_admin_user_connectability_period():
 #         push_system_user_related_nodes(system_user)
 
 
+@shared_task
+def refresh_nodes_assets_amount_util():
+    amounts = Node.refresh_nodes_assets_amount()
+    logger.debug("Refresh nodes assets amount: {} nodes".format(len(amounts)))
+    return len(amounts)
+
+
+@shared_task
+@register_as_period_task(interval=1800)
+@after_app_ready_start
+@after_app_shutdown_clean_periodic
+def refresh_nodes_assets_amount_period():
+    """
+    节点资产数量由信号按增量维护, 这里定期整体对账, 修正可能的偏差
+    """
+    refresh_nodes_assets_amount_util()
 
 
+@shared_task
+@register_as_period_task(interval=300)
+@after_app_ready_start
+@after_app_shutdown_clean_periodic
+def persist_connectivity_period():
+    """
+    可连接性保存在 redis 中, 定期把有修改的组织保存到数据库, redis 数据丢失后可以恢复
+    """
+    ConnectivityStore.persist_dirty()
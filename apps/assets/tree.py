@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+import copy
+import time
+import threading
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+
+from common.utils import get_logger
+from orgs.utils import current_org, get_current_org, set_current_org, \
+    set_to_root_org
+
+__all__ = ['NodeTree', 'get_node_tree', 'expire_node_tree']
+logger = get_logger(__file__)
+
+NODE_TREE_VERSION_KEY = '_NODE_TREE_VERSION'
+_tree = None
+_tree_lock = threading.Lock()
+
+
+class NodeTree:
+    """
+    所有组织节点的内存快照, 每个 worker 构建一次, 通过 redis 中的版本号判断
+    是否过期, 节点保存或删除时增加版本号
+
+    返回的节点都是拷贝, 调用方可以随意修改 (如设置 assets_amount)
+    """
+    def __init__(self, nodes, version):
+        self.version = version
+        self._nodes = {node.key: node for node in nodes}
+        self._children = defaultdict(list)
+        self._full_values = {}
+        for node in nodes:
+            if not node.is_root():
+                self._children[node.parent_key].append(node.key)
+
+    @classmethod
+    def build(cls, version):
+        from .models import Node
+        _current_org = get_current_org()
+        set_to_root_org()
+        try:
+            nodes = list(Node.objects.all())
+        finally:
+            set_current_org(_current_org)
+        logger.debug("Build node tree snapshot: {} nodes, version {}".format(
+            len(nodes), version
+        ))
+        return cls(nodes, version)
+
+    def __contains__(self, key):
+        return key in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def get_node(self, key):
+        node = self._nodes.get(key)
+        if node is None:
+            return None
+        return copy.copy(node)
+
+    def get_parent(self, key):
+        parent_key = ":".join(key.split(":")[:-1])
+        if not parent_key:
+            return None
+        return self.get_node(parent_key)
+
+    def get_children(self, key):
+        return [self.get_node(k) for k in self._children.get(key, [])]
+
+    def get_ancestors(self, key, with_self=False):
+        ancestors = []
+        key_list = key.split(':')
+        if not with_self:
+            key_list.pop()
+        while key_list:
+            node = self.get_node(':'.join(key_list))
+            if node is not None:
+                ancestors.append(node)
+            key_list.pop()
+        return ancestors
+
+    def get_full_value(self, key):
+        value = self._full_values.get(key)
+        if value is not None:
+            return value
+        node = self._nodes.get(key)
+        if node is None:
+            return None
+        value = node.value
+        if not node.is_root():
+            parent_full_value = self.get_full_value(node.parent_key)
+            if parent_full_value is not None:
+                value = parent_full_value + ' / ' + node.value
+        self._full_values[key] = value
+        return value
+
+    def get_org_nodes(self):
+        """
+        与 OrgManager 的过滤规则一致
+        """
+        if not current_org:
+            return []
+        if current_org.is_real():
+            nodes = [n for n in self._nodes.values() if n.org_id == current_org.id]
+        elif current_org.is_default():
+            nodes = [n for n in self._nodes.values() if not n.org_id]
+        else:
+            nodes = list(self._nodes.values())
+        return [copy.copy(node) for node in nodes]
+
+
+def get_node_tree_version():
+    version = cache.get(NODE_TREE_VERSION_KEY)
+    if version is None:
+        # cache 被清空后不能从 1 开始, 否则可能和 worker 中旧的版本号一致
+        cache.add(NODE_TREE_VERSION_KEY, int(time.time()), None)
+        version = cache.get(NODE_TREE_VERSION_KEY)
+    return version
+
+
+def get_node_tree():
+    global _tree
+    version = get_node_tree_version()
+    tree = _tree
+    if tree is not None and tree.version == version:
+        return tree
+    with _tree_lock:
+        if _tree is None or _tree.version != version:
+            _tree = NodeTree.build(version)
+        return _tree
+
+
+def _incr_node_tree_version():
+    try:
+        cache.incr(NODE_TREE_VERSION_KEY)
+    except ValueError:
+        cache.set(NODE_TREE_VERSION_KEY, int(time.time()), None)
+
+
+def expire_node_tree():
+    # 事务提交后再增加版本号, 否则其他 worker 可能用未提交的数据构建快照
+    transaction.on_commit(_incr_node_tree_version)
@@ -102,7 +102,7 @@ class AdminUserAssetsView(AdminUserRequiredMixin, SingleObjectMixin, ListView):
             'app': _('Assets'),
             'action': _('Admin user detail'),
             "total_amount": len(self.queryset),
-            'unreachable_amount': len([asset for asset in self.queryset if asset.connectivity is False])
+            'unreachable_amount': len(self.object.connectivity['unreachable'])
         }
         kwargs.update(context)
         return super().get_context_data(**kwargs)
@@ -18,6 +18,7 @@ from io import StringIO
 import uuid
 from functools import wraps
 import copy
+import ipaddress
 
 import paramiko
 import sshpubkeys
@@ -388,6 +389,16 @@ def get_request_ip(request):
     return login_ip
 
 
+def ip_to_number(ip):
+    """
+    把 ip 转换成整数, 用于在数据库中按 ip 排序, 非法的 ip 返回 0
+    """
+    try:
+        return int(ipaddress.ip_address(str(ip).strip()))
+    except ValueError:
+        return 0
+
+
 def get_command_storage_setting():
     default = settings.DEFAULT_TERMINAL_COMMAND_STORAGE
     value = settings.TERMINAL_COMMAND_STORAGE
@@ -331,6 +331,18 @@ defaults = {
     'TERMINAL_SESSION_KEEP_DURATION': 9999,
     'TERMINAL_HOST_KEY': '',
     'TERMINAL_TELNET_REGEX': '',
+    'TERMINAL_COMMAND_ASYNC_SAVE': True,
+    'TERMINAL_COMMAND_SAVE_BATCH_SIZE': 1000,
+    'TERMINAL_REPLAY_CACHE_SIZE': 10240,
+    'TERMINAL_REPLAY_SEEKABLE': False,
+    'ANSIBLE_FORKS': 40,
+    'ANSIBLE_ORG_FORKS': {},
+    'ANSIBLE_SHARD_SIZE': 500,
+    'ANSIBLE_SHARD_CONCURRENCY': 4,
+    'ANSIBLE_SHARD_TIMEOUT': 3600 * 6,
+    'ASSETS_NATIVE_PROBE': True,
+    'ASSETS_PROBE_WORKERS': 200,
+    'ASSETS_PROBE_TIMEOUT': 10,
     'SECURITY_MFA_AUTH': False,
     'SECURITY_LOGIN_LIMIT_COUNT': 7,
     'SECURITY_LOGIN_LIMIT_TIME': 30,
@@ -528,6 +528,29 @@ TERMINAL_ASSET_LIST_PAGE_SIZE = CONFIG.TERMINAL_ASSET_LIST_PAGE_SIZE
 TERMINAL_SESSION_KEEP_DURATION = CONFIG.TERMINAL_SESSION_KEEP_DURATION
 TERMINAL_HOST_KEY = CONFIG.TERMINAL_HOST_KEY
 TERMINAL_HEADER_TITLE = CONFIG.TERMINAL_HEADER_TITLE
+# 命令先写入 redis 队列, 由 celery 批量保存
+TERMINAL_COMMAND_ASYNC_SAVE = CONFIG.TERMINAL_COMMAND_ASYNC_SAVE
+TERMINAL_COMMAND_SAVE_BATCH_SIZE = CONFIG.TERMINAL_COMMAND_SAVE_BATCH_SIZE
+# 外部存储录像的本地缓存, 单位 MB, 超过后删除最久没有访问的录像
+TERMINAL_REPLAY_CACHE_DIR = os.path.join(PROJECT_DIR, 'data', 'replay_cache')
+TERMINAL_REPLAY_CACHE_SIZE = CONFIG.TERMINAL_REPLAY_CACHE_SIZE
+# 上传的录像转换为分段的 gzip 并生成时间索引, 可以只读取某段时间的录像
+TERMINAL_REPLAY_SEEKABLE = CONFIG.TERMINAL_REPLAY_SEEKABLE
+
+# 主机数超过 ANSIBLE_SHARD_SIZE 的 adhoc 分片执行, 最多同时执行
+# ANSIBLE_SHARD_CONCURRENCY 个分片, 0 为不分片
+# ANSIBLE_FORKS 为分片执行时所有分片的 forks 总数, 可以按组织设置
+# ANSIBLE_ORG_FORKS: {"组织id": 100, "DEFAULT": 20}
+ANSIBLE_FORKS = CONFIG.ANSIBLE_FORKS
+ANSIBLE_ORG_FORKS = CONFIG.ANSIBLE_ORG_FORKS
+ANSIBLE_SHARD_SIZE = CONFIG.ANSIBLE_SHARD_SIZE
+ANSIBLE_SHARD_CONCURRENCY = CONFIG.ANSIBLE_SHARD_CONCURRENCY
+ANSIBLE_SHARD_TIMEOUT = CONFIG.ANSIBLE_SHARD_TIMEOUT
+
+# 可连接性测试直接检查 tcp 和 ssh 认证, 不再执行 ansible ping
+ASSETS_NATIVE_PROBE = CONFIG.ASSETS_NATIVE_PROBE
+ASSETS_PROBE_WORKERS = CONFIG.ASSETS_PROBE_WORKERS
+ASSETS_PROBE_TIMEOUT = CONFIG.ASSETS_PROBE_TIMEOUT
 
 # Django bootstrap3 setting, more see http://django-bootstrap3.readthedocs.io/en/latest/settings.html
 BOOTSTRAP3 = {
@@ -6,7 +6,8 @@ from django.conf import settings
 from django.views.generic import TemplateView, View
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from django.db.models import Count
+from django.db.models import Count, Max
+from django.core.cache import cache
 from django.shortcuts import redirect
 from django.contrib.auth.mixins import LoginRequiredMixin
 from rest_framework.response import Response
@@ -14,19 +15,20 @@ from django.views.decorators.csrf import csrf_exempt
 from django.http import HttpResponse
 from django.utils.encoding import iri_to_uri
 
-from users.models import User
 from assets.models import Asset
-from terminal.models import Session
+from terminal.models import Session, SessionDailyRollup
 from orgs.utils import current_org
 
 
 class IndexView(LoginRequiredMixin, TemplateView):
     template_name = 'index.html'
+    # 首页数据按组织缓存
+    CACHE_KEY = 'INDEX_VIEW_DATA_{}'
+    cache_timeout = 60
 
     session_week = None
     session_month = None
-    session_month_dates = []
-    session_month_dates_archive = []
+    month_rollups = []
 
     def dispatch(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
@@ -47,14 +49,14 @@ class IndexView(LoginRequiredMixin, TemplateView):
 
     @staticmethod
     def get_online_user_count():
-        return len(set(Session.objects.filter(is_finished=False).values_list('user', flat=True)))
+        return Session.objects.filter(is_finished=False).values('user').distinct().count()
 
     @staticmethod
     def get_online_session_count():
         return Session.objects.filter(is_finished=False).count()
 
     def get_top5_user_a_week(self):
-        return self.session_week.values('user').annotate(total=Count('user')).order_by('-total')[:5]
+        return list(self.session_week.values('user').annotate(total=Count('user')).order_by('-total')[:5])
 
     def get_week_login_user_count(self):
         return self.session_week.values('user').distinct().count()
@@ -62,46 +64,36 @@ class IndexView(LoginRequiredMixin, TemplateView):
     def get_week_login_asset_count(self):
         return self.session_week.count()
 
+    @staticmethod
+    def get_month_rollups():
+        """
+        最近 30 天每天的统计, 由定时任务汇总
+        """
+        org_id = SessionDailyRollup.get_current_org_id()
+        month_ago = timezone.localtime().date() - datetime.timedelta(days=30)
+        return list(SessionDailyRollup.objects.filter(
+            org_id=org_id, date__gt=month_ago
+        ).order_by('date'))
+
     def get_month_day_metrics(self):
-        month_str = [d.strftime('%m-%d') for d in self.session_month_dates] or ['0']
+        month_str = [r.date.strftime('%m-%d') for r in self.month_rollups] or ['0']
         return month_str
 
     def get_month_login_metrics(self):
-        data = []
-        time_min = datetime.datetime.min.time()
-        time_max = datetime.datetime.max.time()
-        for d in self.session_month_dates:
-            ds = datetime.datetime.combine(d, time_min).replace(tzinfo=timezone.get_current_timezone())
-            de = datetime.datetime.combine(d, time_max).replace(tzinfo=timezone.get_current_timezone())
-            data.append(self.session_month.filter(date_start__range=(ds, de)).count())
-        return data
+        return [r.sessions_amount for r in self.month_rollups]
 
     def get_month_active_user_metrics(self):
-        if self.session_month_dates_archive:
-            return [q.values('user').distinct().count()
-                    for q in self.session_month_dates_archive]
-        else:
-            return [0]
+        return [r.users_amount for r in self.month_rollups] or [0]
 
     def get_month_active_asset_metrics(self):
-        if self.session_month_dates_archive:
-            return [q.values('asset').distinct().count()
-                    for q in self.session_month_dates_archive]
-        else:
-            return [0]
+        return [r.assets_amount for r in self.month_rollups] or [0]
 
     def get_month_active_user_total(self):
         return self.session_month.values('user').distinct().count()
 
-    def get_month_inactive_user_total(self):
-        return current_org.get_org_users().count() - self.get_month_active_user_total()
-
     def get_month_active_asset_total(self):
         return self.session_month.values('asset').distinct().count()
 
-    def get_month_inactive_asset_total(self):
-        return Asset.objects.all().count() - self.get_month_active_asset_total()
-
     @staticmethod
     def get_user_disabled_total():
         return current_org.get_org_users().filter(is_active=False).count()
@@ -110,52 +102,51 @@ class IndexView(LoginRequiredMixin, TemplateView):
     def get_asset_disabled_total():
         return Asset.objects.filter(is_active=False).count()
 
+    def set_last_sessions(self, items, field):
+        """
+        一次查询取出每一项在本周最后一次登录的会话
+        """
+        if not items:
+            return
+        sessions = self.session_week.filter(**{
+            field + '__in': [item[field] for item in items],
+            'date_start__in': [item['last_date'] for item in items],
+        })
+        last_sessions = {(getattr(s, field), s.date_start): s for s in sessions}
+        for item in items:
+            item['last'] = last_sessions.get((item[field], item['last_date']))
+
     def get_week_top10_asset(self):
-        assets = list(self.session_week.values('asset').annotate(total=Count('asset')).order_by('-total')[:10])
-        for asset in assets:
-            last_login = self.session_week.filter(asset=asset["asset"]).order_by('date_start').last()
-            asset['last'] = last_login
+        assets = list(self.session_week.values('asset').annotate(
+            total=Count('asset'), last_date=Max('date_start')
+        ).order_by('-total')[:10])
+        self.set_last_sessions(assets, 'asset')
         return assets
 
     def get_week_top10_user(self):
         users = list(self.session_week.values('user').annotate(
-            total=Count('asset')).order_by('-total')[:10])
-        for user in users:
-            last_login = self.session_week.filter(user=user["user"]).order_by('date_start').last()
-            user['last'] = last_login
+            total=Count('asset'), last_date=Max('date_start')
+        ).order_by('-total')[:10])
+        self.set_last_sessions(users, 'user')
         return users
 
     def get_last10_sessions(self):
-        sessions = self.session_week.order_by('-date_start')[:10]
-        for session in sessions:
-            try:
-                session.avatar_url = User.objects.get(username=session.user).avatar_url()
-            except User.DoesNotExist:
-                session.avatar_url = User.objects.first().avatar_url()
-        return sessions
+        return list(self.session_week.order_by('-date_start')[:10])
 
-    def get_context_data(self, **kwargs):
+    def get_index_data(self):
         week_ago = timezone.now() - timezone.timedelta(weeks=1)
         month_ago = timezone.now() - timezone.timedelta(days=30)
         self.session_week = Session.objects.filter(date_start__gt=week_ago)
         self.session_month = Session.objects.filter(date_start__gt=month_ago)
-        self.session_month_dates = self.session_month.dates('date_start', 'day')
-
-        self.session_month_dates_archive = []
-        time_min = datetime.datetime.min.time()
-        time_max = datetime.datetime.max.time()
-
-        for d in self.session_month_dates:
-            ds = datetime.datetime.combine(d, time_min).replace(
-                tzinfo=timezone.get_current_timezone())
-            de = datetime.datetime.combine(d, time_max).replace(
-                tzinfo=timezone.get_current_timezone())
-            self.session_month_dates_archive.append(
-                self.session_month.filter(date_start__range=(ds, de)))
-
-        context = {
-            'assets_count': self.get_asset_count(),
-            'users_count': self.get_user_count(),
+        self.month_rollups = self.get_month_rollups()
+
+        users_count = self.get_user_count()
+        assets_count = self.get_asset_count()
+        month_user_active = self.get_month_active_user_total()
+        month_asset_active = self.get_month_active_asset_total()
+        return {
+            'assets_count': assets_count,
+            'users_count': users_count,
             'online_user_count': self.get_online_user_count(),
             'online_asset_count': self.get_online_session_count(),
             'user_visit_count_weekly': self.get_week_login_user_count(),
@@ -165,17 +156,23 @@ class IndexView(LoginRequiredMixin, TemplateView):
             'month_total_visit_count': self.get_month_login_metrics(),
             'month_user': self.get_month_active_user_metrics(),
             'mouth_asset': self.get_month_active_asset_metrics(),
-            'month_user_active': self.get_month_active_user_total(),
-            'month_user_inactive': self.get_month_inactive_user_total(),
+            'month_user_active': month_user_active,
+            'month_user_inactive': users_count - month_user_active,
             'month_user_disabled': self.get_user_disabled_total(),
-            'month_asset_active': self.get_month_active_asset_total(),
-            'month_asset_inactive': self.get_month_inactive_asset_total(),
+            'month_asset_active': month_asset_active,
+            'month_asset_inactive': assets_count - month_asset_active,
             'month_asset_disabled': self.get_asset_disabled_total(),
             'week_asset_hot_ten': self.get_week_top10_asset(),
             'last_login_ten': self.get_last10_sessions(),
             'week_user_hot_ten': self.get_week_top10_user(),
         }
 
+    def get_context_data(self, **kwargs):
+        key = self.CACHE_KEY.format(current_org.id)
+        context = cache.get(key)
+        if context is None:
+            context = self.get_index_data()
+            cache.set(key, context, self.cache_timeout)
         kwargs.update(context)
         return super(IndexView, self).get_context_data(**kwargs)
 
@@ -60,10 +60,8 @@ class AdHocResultCallback(CallbackMixin, CallbackModule, CMDCallBackModule):
     """
     Task result Callback
     """
-    def clean_result(self, t, host, task_name, task_result):
-        contacted = self.results_summary["contacted"]
-        dark = self.results_summary["dark"]
-
+    @staticmethod
+    def get_detail(task_result):
         if task_result.get('rc') is not None:
             cmd = task_result.get('cmd')
             if isinstance(cmd, list):
@@ -83,6 +81,12 @@ class AdHocResultCallback(CallbackMixin, CallbackModule, CMDCallBackModule):
                 "changed": task_result.get('changed', False),
                 "msg": task_result.get('msg', '')
             }
+        return detail
+
+    def clean_result(self, t, host, task_name, task_result):
+        contacted = self.results_summary["contacted"]
+        dark = self.results_summary["dark"]
+        detail = self.get_detail(task_result)
 
         if t in ("ok", "skipped"):
             contacted[host][task_name] = detail
@@ -125,6 +129,41 @@ class AdHocResultCallback(CallbackMixin, CallbackModule, CMDCallBackModule):
         pass
 
 
+class AdHocStreamResultCallback(AdHocResultCallback):
+    """
+    每个主机的结果产生时写入 sink, 内存中只保留计数
+
+    sink 需要实现 write(host, task_name, status, result, detail) 和 flush()
+    results_summary example: {
+      "contacted": {}, "dark": {}, "success": True,
+      "stats": {"ok": 1, "failed": 1, "contacted": 1, "dark": 1, ...}
+    }
+    stats 中 ok, failed, unreachable, skipped 为任务结果数,
+    contacted, dark 为主机数
+    """
+    def __init__(self, sink, display=None):
+        self.sink = sink
+        self.hosts = set()
+        self.dark_hosts = set()
+        super().__init__(display)
+        self.results_summary['stats'] = defaultdict(int)
+
+    def gather_result(self, t, result):
+        self._clean_results(result._result, result._task.action)
+        host = result._host.get_name()
+        task_result = result._result
+        detail = self.get_detail(task_result)
+
+        stats = self.results_summary['stats']
+        stats[t] += 1
+        self.hosts.add(host)
+        if t not in ("ok", "skipped"):
+            self.dark_hosts.add(host)
+        stats['dark'] = len(self.dark_hosts)
+        stats['contacted'] = len(self.hosts) - stats['dark']
+        self.sink.write(host, result.task_name, t, task_result, detail)
+
+
 class CommandResultCallback(AdHocResultCallback):
     """
     Command result callback
@@ -136,14 +175,20 @@ class CommandResultCallback(AdHocResultCallback):
       "rc": 0,
       "delta": 0:0:0.123
     }
+    设置 sink 后每个主机的结果完成时写入 sink, 不保存在内存中,
+    sink 的接口同 AdHocStreamResultCallback
     """
-    def __init__(self, display=None, **kwargs):
+    def __init__(self, display=None, sink=None, **kwargs):
 
         self.results_command = dict()
+        self.sink = sink
         super().__init__(display)
 
     def gather_result(self, t, res):
-        super().gather_result(t, res)
+        if self.sink is None:
+            super().gather_result(t, res)
+        else:
+            self._clean_results(res._result, res._task.action)
         self.gather_cmd(t, res)
 
     def v2_playbook_on_play_start(self, play):
@@ -194,7 +239,10 @@ class CommandResultCallback(AdHocResultCallback):
             cmd['delta'] = res._result.get('delta')
         else:
             cmd['err'] = "Error: {}".format(res)
-        self.results_command[host] = cmd
+        if self.sink is not None:
+            self.sink.write(host, res.task_name, t, res._result, cmd)
+        else:
+            self.results_command[host] = cmd
 
 
 class PlaybookResultCallBack(CallbackBase):
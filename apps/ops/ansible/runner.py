@@ -11,7 +11,8 @@ from ansible.playbook.play import Play
 import ansible.constants as C
 
 from .callback import (
-    AdHocResultCallback, PlaybookResultCallBack, CommandResultCallback
+    AdHocResultCallback, PlaybookResultCallBack, CommandResultCallback,
+    AdHocStreamResultCallback,
 )
 from common.utils import get_logger
 from .exceptions import AnsibleError
@@ -130,15 +131,22 @@ class AdHocRunner:
     default_options = get_default_options()
     command_modules_choices = ('shell', 'raw', 'command', 'script', 'win_shell')
 
-    def __init__(self, inventory, options=None):
+    def __init__(self, inventory, options=None, results_sink=None):
+        """
+        :param results_sink: 设置后每个主机的结果直接写入 sink, 不保存在内存中,
+            见 AdHocStreamResultCallback
+        """
         self.options = self.update_options(options)
         self.inventory = inventory
+        self.results_sink = results_sink
         self.loader = DataLoader()
         self.variable_manager = VariableManager(
             loader=self.loader, inventory=self.inventory
         )
 
     def get_result_callback(self, file_obj=None):
+        if self.results_sink is not None:
+            return AdHocStreamResultCallback(self.results_sink)
         return self.__class__.results_callback_class()
 
     @staticmethod
@@ -232,12 +240,17 @@ class AdHocRunner:
         finally:
             tqm.cleanup()
             self.loader.cleanup_all_tmp_files()
+            if self.results_sink is not None:
+                self.results_sink.flush()
 
 
 class CommandRunner(AdHocRunner):
     results_callback_class = CommandResultCallback
     modules_choices = ('shell', 'raw', 'command', 'script')
 
+    def get_result_callback(self, file_obj=None):
+        return self.__class__.results_callback_class(sink=self.results_sink)
+
     def execute(self, cmd, pattern, module='shell'):
         if module and module not in self.modules_choices:
             raise AnsibleError("Module should in {}".format(self.modules_choices))
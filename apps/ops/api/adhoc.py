@@ -3,17 +3,19 @@
 
 from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, generics
+from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.views import Response
 
 from common.permissions import IsOrgAdmin
 from orgs.utils import current_org
-from ..models import Task, AdHoc, AdHocRunHistory
+from ..models import Task, AdHoc, AdHocRunHistory, AdHocRunHostResult
 from ..serializers import TaskSerializer, AdHocSerializer, \
-    AdHocRunHistorySerializer
+    AdHocRunHistorySerializer, AdHocRunHostResultSerializer
 from ..tasks import run_ansible_task
 
 __all__ = [
-    'TaskViewSet', 'TaskRun', 'AdHocViewSet', 'AdHocRunHistoryViewSet'
+    'TaskViewSet', 'TaskRun', 'AdHocViewSet', 'AdHocRunHistoryViewSet',
+    'AdHocRunHostResultListApi',
 ]
 
 
@@ -77,3 +79,23 @@ class AdHocRunHistoryViewSet(viewsets.ModelViewSet):
 
 
 
+
+
+class AdHocRunHostResultListApi(generics.ListAPIView):
+    """
+    分页获取一次执行中每个主机的结果, 可以按 hostname, status 过滤
+    """
+    serializer_class = AdHocRunHostResultSerializer
+    permission_classes = (IsOrgAdmin,)
+    pagination_class = LimitOffsetPagination
+
+    def get_queryset(self):
+        history = get_object_or_404(AdHocRunHistory, id=self.kwargs.get('pk'))
+        queryset = AdHocRunHostResult.objects.filter(history=history)
+        hostname = self.request.query_params.get('hostname')
+        status = self.request.query_params.get('status')
+        if hostname:
+            queryset = queryset.filter(hostname=hostname)
+        if status:
+            queryset = queryset.filter(status__in=status.split(','))
+        return queryset
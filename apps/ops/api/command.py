@@ -1,22 +1,67 @@
 # -*- coding: utf-8 -*-
 #
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
 from django.db import transaction
 
 from common.permissions import IsValidUser
 from ..models import CommandExecution
-from ..serializers import CommandExecutionSerializer
+from ..serializers import CommandExecutionSerializer, \
+    CommandExecutionHostResultSerializer
 from ..tasks import run_command_execution
 
 
 class CommandExecutionViewSet(viewsets.ModelViewSet):
     serializer_class = CommandExecutionSerializer
     permission_classes = (IsValidUser,)
+    results_limit = 100
+    results_max_limit = 1000
+
+    def with_host_results(self):
+        """
+        详情和 ?result=1 的列表返回每个主机的输出, 格式和原来的 result 一致
+        """
+        if self.action == 'retrieve':
+            return True
+        return self.request.query_params.get('result') in ('1', 'true')
 
     def get_queryset(self):
-        return CommandExecution.objects.filter(
+        queryset = CommandExecution.objects.filter(
             user_id=str(self.request.user.id)
         )
+        if self.action == 'list' and self.with_host_results():
+            queryset = queryset.prefetch_related('host_results')
+        return queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['with_host_results'] = self.with_host_results()
+        return context
+
+    @action(detail=True, methods=['get'])
+    def results(self, request, *args, **kwargs):
+        """
+        增量获取主机结果: ?since=<上次返回的 seq>&limit=100
+        返回 {"progress": {...}, "results": [...], "seq": 最后一条的 seq}
+        """
+        execution = self.get_object()
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = int(request.query_params.get('limit', self.results_limit))
+        except ValueError:
+            return Response({"error": "since and limit must be int"}, status=400)
+        limit = min(max(limit, 1), self.results_max_limit)
+        # 先取进度再取结果, is_finished 为 True 时返回的结果就是全部剩余的结果
+        progress = execution.get_progress()
+        results = execution.host_results.filter(seq__gt=since)[:limit]
+        serializer = CommandExecutionHostResultSerializer(results, many=True)
+        data = serializer.data
+        return Response({
+            'progress': progress,
+            'results': data,
+            'seq': data[-1]['seq'] if data else since,
+        })
 
     def perform_create(self, serializer):
         instance = serializer.save()
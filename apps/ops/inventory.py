@@ -1,13 +1,51 @@
 # -*- coding: utf-8 -*-
 #
+import time
+import random
+import hashlib
+import threading
+from collections import OrderedDict, defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import QuerySet
 
 from .ansible.inventory import BaseInventory
 from assets.utils import get_assets_by_id_list, get_system_user_by_id
 
 __all__ = [
-    'JMSInventory'
+    'JMSInventory', 'expire_inventory_cache',
 ]
 
+INVENTORY_VERSION_KEY = '_INVENTORY_VERSION'
+# 每个 worker 缓存最近使用的 inventory
+INVENTORY_CACHE_SIZE = 16
+_inventory_cache = OrderedDict()
+_inventory_cache_lock = threading.Lock()
+
+
+def get_inventory_version():
+    version = cache.get(INVENTORY_VERSION_KEY)
+    if version is None:
+        # cache 被清空后不能从 1 开始, 否则可能和 worker 中旧的版本号一致
+        cache.add(INVENTORY_VERSION_KEY, int(time.time()), None)
+        version = cache.get(INVENTORY_VERSION_KEY)
+    return version
+
+
+def _incr_inventory_version():
+    try:
+        cache.incr(INVENTORY_VERSION_KEY)
+    except ValueError:
+        cache.set(INVENTORY_VERSION_KEY, int(time.time()), None)
+
+
+def expire_inventory_cache():
+    """
+    资产, 认证信息, 网域, 节点, 标签变化时调用
+    """
+    transaction.on_commit(_incr_inventory_version)
+
 
 class JMSInventory(BaseInventory):
     """
@@ -26,21 +64,72 @@ class JMSInventory(BaseInventory):
         self.run_as = run_as
         self.become_info = become_info
 
-        host_list = []
+        key = self.get_cache_key()
+        version = get_inventory_version()
+        cached = _inventory_cache.get(key)
+        if cached and cached[0] == version:
+            host_list = [dict(host) for host in cached[1]]
+        else:
+            host_list = self.get_host_list()
+            with _inventory_cache_lock:
+                _inventory_cache[key] = (version, host_list)
+                _inventory_cache.move_to_end(key)
+                while len(_inventory_cache) > INVENTORY_CACHE_SIZE:
+                    _inventory_cache.popitem(last=False)
+            host_list = [dict(host) for host in host_list]
+        super().__init__(host_list=host_list)
 
-        for asset in assets:
-            info = self.convert_to_ansible(asset, run_as_admin=run_as_admin)
+    def get_cache_key(self):
+        """
+        按资产集合, 执行用户和 become 信息生成 key
+        """
+        if isinstance(self.assets, QuerySet):
+            assets_id = self.assets.values_list('id', flat=True)
+        else:
+            assets_id = [asset.id for asset in self.assets]
+        data = '{}|{}|{}|{}'.format(
+            ','.join(sorted(str(i) for i in assets_id)), self.using_admin,
+            self.run_as.id if self.run_as else '', self.become_info,
+        )
+        return hashlib.md5(data.encode()).hexdigest()
+
+    def prefetch_assets(self):
+        """
+        一次查询节点, 标签, 网域, 管理用户, 网关
+        """
+        assets = self.assets
+        if isinstance(assets, QuerySet):
+            assets = assets.select_related('domain', 'admin_user')\
+                .prefetch_related('nodes', 'labels')
+        assets = list(assets)
+        domains_id = {asset.domain_id for asset in assets if asset.domain_id}
+        self._gateways = defaultdict(list)
+        if domains_id:
+            from assets.models import Gateway
+            gateways = Gateway.objects.filter(
+                domain_id__in=domains_id, is_active=True
+            )
+            for gateway in gateways:
+                self._gateways[gateway.domain_id].append(gateway)
+        return assets
+
+    def get_host_list(self):
+        self._auth_info = {}
+        self._proxy_commands = {}
+        host_list = []
+        for asset in self.prefetch_assets():
+            info = self.convert_to_ansible(asset, run_as_admin=self.using_admin)
             host_list.append(info)
 
-        if run_as:
+        if self.run_as:
             run_user_info = self.get_run_user_info()
             for host in host_list:
                 host.update(run_user_info)
 
-        if become_info:
+        if self.become_info:
             for host in host_list:
-                host.update(become_info)
-        super().__init__(host_list=host_list)
+                host.update(self.become_info)
+        return host_list
 
     def convert_to_ansible(self, asset, run_as_admin=False):
         info = {
@@ -51,10 +140,11 @@ class JMSInventory(BaseInventory):
             'vars': dict(),
             'groups': [],
         }
-        if asset.domain and asset.domain.has_gateway():
-            info["vars"].update(self.make_proxy_command(asset))
+        gateways = self._gateways.get(asset.domain_id)
+        if asset.domain and gateways:
+            info["vars"].update(self.make_proxy_command(random.choice(gateways)))
         if run_as_admin:
-            info.update(asset.get_auth_info())
+            info.update(self.get_admin_user_auth_info(asset) or {})
         for node in asset.nodes.all():
             info["groups"].append(node.value)
         for label in asset.labels.all():
@@ -69,6 +159,16 @@ class JMSInventory(BaseInventory):
             info["groups"].append("domain_"+asset.domain.name)
         return info
 
+    def get_admin_user_auth_info(self, asset):
+        """
+        每个管理用户只解密一次
+        """
+        if not asset.admin_user_id:
+            return None
+        if asset.admin_user_id not in self._auth_info:
+            self._auth_info[asset.admin_user_id] = asset.get_auth_info()
+        return self._auth_info[asset.admin_user_id]
+
     def get_run_user_info(self):
         system_user = self.run_as
         if not system_user:
@@ -76,9 +176,9 @@ class JMSInventory(BaseInventory):
         else:
             return system_user._to_secret_json()
 
-    @staticmethod
-    def make_proxy_command(asset):
-        gateway = asset.domain.random_gateway()
+    def make_proxy_command(self, gateway):
+        if gateway.id in self._proxy_commands:
+            return self._proxy_commands[gateway.id]
         proxy_command_list = [
             "ssh", "-p", str(gateway.port),
             "-o", "StrictHostKeyChecking=no",
@@ -96,4 +196,5 @@ class JMSInventory(BaseInventory):
         proxy_command = "'-o ProxyCommand={}'".format(
             " ".join(proxy_command_list)
         )
-        return {"ansible_ssh_common_args": proxy_command}
+        self._proxy_commands[gateway.id] = {"ansible_ssh_common_args": proxy_command}
+        return self._proxy_commands[gateway.id]
@@ -0,0 +1,31 @@
+# Generated by Django 2.1.7 on 2019-05-14 11:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ops', '0005_auto_20181219_1807'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdHocRunHostResult',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('hostname', models.CharField(db_index=True, max_length=128, verbose_name='Hostname')),
+                ('task_name', models.CharField(blank=True, default='', max_length=1024, verbose_name='Task name')),
+                ('status', models.CharField(choices=[('ok', 'ok'), ('failed', 'failed'), ('unreachable', 'unreachable'), ('skipped', 'skipped')], db_index=True, max_length=16, verbose_name='Status')),
+                ('_detail', models.TextField(blank=True, null=True, verbose_name='Result detail')),
+                ('_result', models.TextField(blank=True, null=True, verbose_name='Result')),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('history', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='host_results', to='ops.AdHocRunHistory')),
+            ],
+            options={
+                'db_table': 'ops_adhoc_host_result',
+                'ordering': ('id',),
+            },
+        ),
+    ]
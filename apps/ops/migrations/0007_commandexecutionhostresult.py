@@ -0,0 +1,35 @@
+# Generated by Django 2.1.7 on 2019-05-15 09:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ops', '0006_adhocrunhostresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommandExecutionHostResult',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('seq', models.IntegerField(verbose_name='Sequence')),
+                ('hostname', models.CharField(max_length=128, verbose_name='Hostname')),
+                ('status', models.CharField(choices=[('ok', 'ok'), ('failed', 'failed'), ('unreachable', 'unreachable'), ('skipped', 'skipped')], max_length=16, verbose_name='Status')),
+                ('rc', models.IntegerField(null=True, verbose_name='Return code')),
+                ('stdout', models.TextField(blank=True, default='', verbose_name='Stdout')),
+                ('stderr', models.TextField(blank=True, default='', verbose_name='Stderr')),
+                ('msg', models.TextField(blank=True, default='', verbose_name='Message')),
+                ('delta', models.CharField(blank=True, default='', max_length=32, verbose_name='Time')),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('execution', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='host_results', to='ops.CommandExecution')),
+            ],
+            options={
+                'db_table': 'ops_command_execution_host_result',
+                'ordering': ('seq',),
+                'unique_together': {('execution', 'seq')},
+            },
+        ),
+    ]
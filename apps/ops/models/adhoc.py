@@ -6,8 +6,8 @@ import os
 import time
 import datetime
 
-from celery import current_task
-from django.db import models
+from celery import current_task, group
+from django.db import models, transaction
 from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
@@ -20,8 +20,11 @@ from ..celery.utils import delete_celery_periodic_task, \
     disable_celery_periodic_task
 from ..ansible import AdHocRunner, AnsibleError
 from ..inventory import JMSInventory
+from ..result_sink import HostResultSink
+from ..shard import ShardQueue, split_shards, get_org_forks, \
+    merge_shard_result
 
-__all__ = ["Task", "AdHoc", "AdHocRunHistory"]
+__all__ = ["Task", "AdHoc", "AdHocRunHistory", "AdHocRunHostResult"]
 
 
 logger = get_logger(__file__)
@@ -84,10 +87,12 @@ class Task(models.Model):
     def get_run_history(self):
         return self.history.all()
 
-    def run(self, record=True):
+    def run(self, record=True, sharded=None, stream=None):
         set_to_root_org()
         if self.latest_adhoc:
-            return self.latest_adhoc.run(record=record)
+            return self.latest_adhoc.run(
+                record=record, sharded=sharded, stream=stream
+            )
         else:
             return {'error': 'No adhoc'}
 
@@ -182,6 +187,9 @@ class AdHoc(models.Model):
 
     @property
     def inventory(self):
+        return self.get_inventory()
+
+    def get_inventory(self, hosts=None):
         if self.become:
             become_info = {
                 'become': {
@@ -191,8 +199,10 @@ class AdHoc(models.Model):
         else:
             become_info = None
 
+        if hosts is None:
+            hosts = self.hosts.all()
         inventory = JMSInventory(
-            self.hosts.all(), run_as_admin=self.run_as_admin,
+            hosts, run_as_admin=self.run_as_admin,
             run_as=self.run_as, become_info=become_info
         )
         return inventory
@@ -204,31 +214,65 @@ class AdHoc(models.Model):
         else:
             return {}
 
-    def run(self, record=True):
+    @property
+    def org_id(self):
+        """
+        主机都属于同一个组织时返回这个组织, 否则为默认组织
+        """
+        orgs_id = list(self.hosts.values_list('org_id', flat=True).distinct()[:2])
+        if len(orgs_id) == 1:
+            return orgs_id[0]
+        return ''
+
+    def is_need_shard(self):
+        shard_size = settings.ANSIBLE_SHARD_SIZE
+        if not shard_size or settings.ANSIBLE_SHARD_CONCURRENCY < 1:
+            return False
+        return self.hosts.count() > shard_size
+
+    def run(self, record=True, sharded=None, stream=None):
+        """
+        :param sharded: 是否分片执行, 为 None 时主机数超过 ANSIBLE_SHARD_SIZE 分片,
+            分片的结果写入同一个执行历史, 所以不记录时不分片
+        :param stream: 每个主机的结果写入 AdHocRunHostResult, 返回的 raw 为空,
+            summary 中只有计数, 同样只在记录时有效. 为 None 时分片执行使用,
+            需要 summary 中主机列表的调用者要传入 False
+        """
         set_to_root_org()
-        if record:
-            return self._run_and_record()
+        if sharded is None:
+            sharded = record and self.is_need_shard()
+        if stream is None:
+            stream = record and sharded
+        if record and sharded:
+            return self._run_sharded_and_record(stream=stream)
+        elif record:
+            return self._run_and_record(stream=stream)
         else:
             return self._run_only()
 
-    def _run_and_record(self):
+    def _run_and_record(self, stream=False):
         try:
             hid = current_task.request.id
         except AttributeError:
             hid = str(uuid.uuid4())
         history = AdHocRunHistory(id=hid, adhoc=self, task=self.task)
+        sink = None
+        if stream:
+            # 主机结果的外键指向执行历史, 需要先保存
+            history.save()
+            sink = HostResultSink(history.id)
         time_start = time.time()
         try:
             date_start = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             print(_("{} Start task: {}").format(date_start, self.task.name))
-            raw, summary = self._run_only()
+            raw, summary = self._run_only(sink=sink)
+            if stream:
+                # 调用者通过执行历史读取每个主机的结果
+                summary['history'] = str(history.id)
             date_end = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             print(_("{} Task finish").format(date_end))
             history.is_finished = True
-            if summary.get('dark'):
-                history.is_success = False
-            else:
-                history.is_success = True
+            history.is_success = AdHocRunHistory.is_summary_success(summary)
             history.result = raw
             history.summary = summary
             return raw, summary
@@ -239,8 +283,10 @@ class AdHoc(models.Model):
             history.timedelta = time.time() - time_start
             history.save()
 
-    def _run_only(self):
-        runner = AdHocRunner(self.inventory, options=self.options)
+    def _run_only(self, sink=None):
+        runner = AdHocRunner(
+            self.inventory, options=self.options, results_sink=sink
+        )
         try:
             result = runner.run(
                 self.tasks,
@@ -252,6 +298,102 @@ class AdHoc(models.Model):
             logger.warn("Failed run adhoc {}, {}".format(self.task.name, e))
             pass
 
+    def _run_shard(self, hosts_id, forks, sink=None):
+        hosts = self.hosts.filter(id__in=hosts_id)
+        options = self.options
+        options['forks'] = forks
+        runner = AdHocRunner(
+            self.get_inventory(hosts), options=options, results_sink=sink
+        )
+        try:
+            result = runner.run(self.tasks, self.pattern, self.task.name)
+            return result.results_raw, result.results_summary
+        except AnsibleError as e:
+            logger.warn("Failed run adhoc shard {}, {}".format(self.task.name, e))
+            dark = {
+                hostname: {'all': str(e)}
+                for hostname in hosts.values_list('hostname', flat=True)
+            }
+            return {}, {'contacted': {}, 'dark': dark, 'success': False}
+
+    def run_shards(self, history_id, forks, stream=False):
+        """
+        从队列中取出分片执行, 直到队列为空, 每个分片的结果放到队列的结果中,
+        全部完成后由发起的进程一次合并到执行历史
+        """
+        set_to_root_org()
+        queue = ShardQueue(history_id)
+        sink = HostResultSink(history_id) if stream else None
+        while True:
+            hosts_id = queue.pop()
+            if hosts_id is None:
+                break
+            raw, summary = {}, {'success': False}
+            try:
+                raw, summary = self._run_shard(hosts_id, forks, sink=sink)
+            except Exception as e:
+                logger.error("Run adhoc shard error: {}".format(e))
+                summary['dark'] = {'all': str(e)}
+            finally:
+                done = queue.finish_one(raw, summary)
+                state = queue.get_state()
+                if done is not None and state is not None:
+                    print(_("Shard finished: {}/{}").format(done, state[0]))
+
+    def _run_sharded_and_record(self, stream=False):
+        from ..tasks import run_adhoc_shards
+        try:
+            hid = current_task.request.id
+        except AttributeError:
+            hid = str(uuid.uuid4())
+        history = AdHocRunHistory(id=hid, adhoc=self, task=self.task)
+        history.result = {}
+        summary = {'contacted': {}, 'dark': {}, 'success': True}
+        if stream:
+            summary.update({'stats': {}, 'history': str(history.id)})
+        history.summary = summary
+        history.save()
+        time_start = time.time()
+
+        hosts_id = [str(i) for i in self.hosts.values_list('id', flat=True)]
+        shards = split_shards(hosts_id, settings.ANSIBLE_SHARD_SIZE)
+        concurrency = min(settings.ANSIBLE_SHARD_CONCURRENCY, len(shards))
+        forks = max(get_org_forks(self.org_id) // concurrency, 1)
+        queue = ShardQueue(history.id)
+        queue.push(shards)
+
+        date_start = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        print(_("{} Start task: {}").format(date_start, self.task.name))
+        print(_("{} hosts, {} shards, concurrency {}, forks {}").format(
+            len(hosts_id), len(shards), concurrency, forks
+        ))
+        finished = False
+        results = []
+        try:
+            # 当前进程也执行分片, 只需要再派发 concurrency - 1 个
+            if concurrency > 1:
+                group(
+                    run_adhoc_shards.si(
+                        str(self.id), str(history.id), forks, stream=stream
+                    )
+                    for _i in range(concurrency - 1)
+                ).apply_async()
+            self.run_shards(history.id, forks, stream=stream)
+            finished = queue.wait(settings.ANSIBLE_SHARD_TIMEOUT)
+        except Exception as e:
+            logger.error("Run adhoc shards error: {}".format(e))
+        finally:
+            try:
+                results = queue.get_results()
+            finally:
+                queue.clean()
+            history = AdHocRunHistory.finish_sharded(
+                history.id, results, finished, time.time() - time_start
+            )
+        date_end = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        print(_("{} Task finish").format(date_end))
+        return history.result, history.summary
+
     @become.setter
     def become(self, item):
         """
@@ -362,13 +504,77 @@ class AdHocRunHistory(models.Model):
     def summary(self, item):
         self._summary = json.dumps(item)
 
+    @classmethod
+    def finish_sharded(cls, hid, results, finished, timedelta):
+        """
+        所有分片的结果一次合并, 每个分片不再读写整个执行历史
+        :param results: [(raw, summary), ], 每个分片的结果
+        """
+        with transaction.atomic():
+            history = cls.objects.select_for_update().get(id=hid)
+            raw, summary = history.result, history.summary
+            for shard_raw, shard_summary in results:
+                raw, summary = merge_shard_result(
+                    raw, summary, shard_raw, shard_summary
+                )
+            if not finished:
+                summary['success'] = False
+                summary.setdefault('dark', {})['all'] = \
+                    "Some shards not finished in {}s".format(int(timedelta))
+            history.result = raw
+            history.summary = summary
+            history.is_finished = True
+            history.is_success = cls.is_summary_success(summary)
+            history.date_finished = timezone.now()
+            history.timedelta = timedelta
+            history.save()
+        return history
+
+    @staticmethod
+    def is_summary_success(summary):
+        return bool(summary.get('success', True)) and not summary.get('dark')
+
+    @property
+    def is_stream(self):
+        """
+        结果是否按主机写入 AdHocRunHostResult
+        """
+        return 'stats' in self.summary
+
+    @property
+    def stat(self):
+        summary = self.summary
+        if 'stats' in summary:
+            stats = summary['stats']
+            return {
+                'success': stats.get('contacted', 0),
+                'failed': stats.get('dark', 0) + len(summary.get('dark', {})),
+            }
+        return {
+            'success': len(summary.get('contacted', [])),
+            'failed': len(summary.get('dark', [])),
+        }
+
     @property
     def success_hosts(self):
-        return self.summary.get('contacted', [])
+        if not self.is_stream:
+            return self.summary.get('contacted', [])
+        failed_hosts = self.failed_hosts
+        hosts = self.host_results.values_list('hostname', flat=True).distinct()
+        return sorted(set(hosts) - set(failed_hosts))
 
     @property
     def failed_hosts(self):
-        return self.summary.get('dark', {})
+        if not self.is_stream:
+            return self.summary.get('dark', {})
+        failed_hosts = dict(self.summary.get('dark', {}))
+        results = self.host_results.filter(
+            status__in=AdHocRunHostResult.FAILED_STATUS
+        )
+        for result in results:
+            failed_hosts.setdefault(result.hostname, {})[result.task_name] = \
+                result.detail
+        return failed_hosts
 
     def __str__(self):
         return self.short_id
@@ -376,3 +582,52 @@ class AdHocRunHistory(models.Model):
     class Meta:
         db_table = "ops_adhoc_history"
         get_latest_by = 'date_start'
+
+
+class AdHocRunHostResult(models.Model):
+    """
+    每个主机每个任务的执行结果, 流式执行时由 HostResultSink 写入
+    """
+    STATUS_OK = 'ok'
+    STATUS_FAILED = 'failed'
+    STATUS_UNREACHABLE = 'unreachable'
+    STATUS_SKIPPED = 'skipped'
+    STATUS_CHOICES = (
+        (STATUS_OK, 'ok'),
+        (STATUS_FAILED, 'failed'),
+        (STATUS_UNREACHABLE, 'unreachable'),
+        (STATUS_SKIPPED, 'skipped'),
+    )
+    FAILED_STATUS = (STATUS_FAILED, STATUS_UNREACHABLE)
+
+    id = models.BigAutoField(primary_key=True)
+    history = models.ForeignKey(AdHocRunHistory, related_name='host_results', on_delete=models.CASCADE)
+    hostname = models.CharField(max_length=128, db_index=True, verbose_name=_('Hostname'))
+    task_name = models.CharField(max_length=1024, blank=True, default='', verbose_name=_('Task name'))
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, db_index=True, verbose_name=_('Status'))
+    _detail = models.TextField(blank=True, null=True, verbose_name=_('Result detail'))
+    _result = models.TextField(blank=True, null=True, verbose_name=_('Result'))
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def detail(self):
+        return json.loads(self._detail) if self._detail else {}
+
+    @detail.setter
+    def detail(self, item):
+        self._detail = json.dumps(item)
+
+    @property
+    def result(self):
+        return json.loads(self._result) if self._result else {}
+
+    @result.setter
+    def result(self, item):
+        self._result = json.dumps(item)
+
+    def __str__(self):
+        return '{}: {} {}'.format(self.hostname, self.task_name, self.status)
+
+    class Meta:
+        db_table = "ops_adhoc_host_result"
+        ordering = ('id',)
@@ -3,6 +3,7 @@
 import uuid
 import json
 
+from django.core.cache import cache
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ugettext
@@ -12,6 +13,9 @@ from django.db import models
 from orgs.models import Organization
 from ..ansible.runner import CommandRunner
 from ..inventory import JMSInventory
+from ..result_sink import CommandResultSink
+
+__all__ = ['CommandExecution', 'CommandExecutionHostResult']
 
 
 class CommandExecution(models.Model):
@@ -26,6 +30,9 @@ class CommandExecution(models.Model):
     date_start = models.DateTimeField(null=True)
     date_finished = models.DateTimeField(null=True)
 
+    PROGRESS_KEY = 'COMMAND_EXECUTION_PROGRESS_{}'
+    PROGRESS_TIMEOUT = 24 * 3600
+
     def __str__(self):
         return self.command[:10]
 
@@ -53,6 +60,67 @@ class CommandExecution(models.Model):
     def get_hosts_names(self):
         return ','.join(self.hosts.all().values_list('hostname', flat=True))
 
+    @property
+    def progress_key(self):
+        return self.PROGRESS_KEY.format(self.id)
+
+    def init_progress(self, total):
+        client = cache.get_master_client()
+        pipe = client.pipeline()
+        pipe.delete(self.progress_key)
+        pipe.hmset(self.progress_key, {'total': total, 'done': 0, 'failed': 0})
+        pipe.expire(self.progress_key, self.PROGRESS_TIMEOUT)
+        pipe.execute()
+
+    def incr_progress(self, failed=False):
+        """
+        完成的主机数加一, 返回值作为这个主机结果的序号
+        """
+        client = cache.get_master_client()
+        pipe = client.pipeline()
+        pipe.hincrby(self.progress_key, 'done', 1)
+        if failed:
+            pipe.hincrby(self.progress_key, 'failed', 1)
+        return pipe.execute()[0]
+
+    def get_progress(self):
+        """
+        {"total": 10, "done": 5, "failed": 1}, 缓存过期后从数据库统计
+        """
+        client = cache.get_master_client()
+        values = client.hgetall(self.progress_key)
+        if values:
+            values = {k.decode(): int(v) for k, v in values.items()}
+        else:
+            values = {
+                'total': self.hosts.count(),
+                'done': self.host_results.count(),
+                'failed': self.host_results.filter(
+                    status__in=CommandExecutionHostResult.FAILED_STATUS
+                ).count(),
+            }
+        values['is_finished'] = self.is_finished
+        return values
+
+    def get_host_results_compat(self):
+        """
+        按原来 result 的格式返回每个主机的结果, 兼容已有的接口, 不保存在 result 中
+        {hostname: {"cmd": "", "stderr": "", "stdout": "", "rc": 0, "delta": ""}}
+        """
+        # 出错的执行和升级前的执行直接返回保存的结果
+        if self.result:
+            return self.result
+        results = {}
+        for r in self.host_results.all():
+            if r.status != CommandExecutionHostResult.STATUS_OK:
+                results[r.hostname] = {'err': r.msg}
+                continue
+            results[r.hostname] = {
+                'cmd': self.command, 'stderr': r.stderr, 'stdout': r.stdout,
+                'rc': r.rc, 'delta': r.delta,
+            }
+        return results
+
     def run(self):
         print('-'*10 + ' ' + ugettext('Task start') + ' ' + '-'*10)
         org = Organization.get_instance(self.run_as.org_id)
@@ -60,10 +128,14 @@ class CommandExecution(models.Model):
         self.date_start = timezone.now()
         ok, msg = self.run_as.is_command_can_run(self.command)
         if ok:
-            runner = CommandRunner(self.inventory)
+            self.init_progress(self.hosts.count())
+            # 每个主机的结果完成时写入 CommandExecutionHostResult, result 只保存错误
+            runner = CommandRunner(
+                self.inventory, results_sink=CommandResultSink(self)
+            )
             try:
-                result = runner.execute(self.command, 'all')
-                self.result = result.results_command
+                runner.execute(self.command, 'all')
+                self.result = {}
             except Exception as e:
                 print("Error occur: {}".format(e))
                 self.result = {"error": str(e)}
@@ -76,3 +148,40 @@ class CommandExecution(models.Model):
         self.save()
         print('-'*10 + ' ' + ugettext('Task end') + ' ' + '-'*10)
         return self.result
+
+
+class CommandExecutionHostResult(models.Model):
+    """
+    批量命令每个主机的执行结果, seq 为主机完成的顺序, 从 1 开始
+    """
+    STATUS_OK = 'ok'
+    STATUS_FAILED = 'failed'
+    STATUS_UNREACHABLE = 'unreachable'
+    STATUS_SKIPPED = 'skipped'
+    STATUS_CHOICES = (
+        (STATUS_OK, 'ok'),
+        (STATUS_FAILED, 'failed'),
+        (STATUS_UNREACHABLE, 'unreachable'),
+        (STATUS_SKIPPED, 'skipped'),
+    )
+    FAILED_STATUS = (STATUS_FAILED, STATUS_UNREACHABLE)
+
+    id = models.BigAutoField(primary_key=True)
+    execution = models.ForeignKey(CommandExecution, related_name='host_results', on_delete=models.CASCADE)
+    seq = models.IntegerField(verbose_name=_('Sequence'))
+    hostname = models.CharField(max_length=128, verbose_name=_('Hostname'))
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, verbose_name=_('Status'))
+    rc = models.IntegerField(null=True, verbose_name=_('Return code'))
+    stdout = models.TextField(blank=True, default='', verbose_name=_('Stdout'))
+    stderr = models.TextField(blank=True, default='', verbose_name=_('Stderr'))
+    msg = models.TextField(blank=True, default='', verbose_name=_('Message'))
+    delta = models.CharField(max_length=32, blank=True, default='', verbose_name=_('Time'))
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{}: {}'.format(self.hostname, self.status)
+
+    class Meta:
+        db_table = 'ops_command_execution_host_result'
+        unique_together = ('execution', 'seq')
+        ordering = ('seq',)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+import json
+
+from common.utils import get_logger
+
+__all__ = ['HostResultSink', 'CommandResultSink']
+logger = get_logger(__file__)
+
+
+class HostResultSink:
+    """
+    AdHocStreamResultCallback 的 sink, 主机结果批量写入 AdHocRunHostResult
+    """
+    batch_size = 200
+
+    def __init__(self, history_id):
+        self.history_id = history_id
+        self.buffer = []
+
+    def write(self, host, task_name, status, result, detail):
+        from .models import AdHocRunHostResult
+        instance = AdHocRunHostResult(
+            history_id=self.history_id, hostname=host,
+            task_name=task_name or '', status=status,
+        )
+        instance.detail = detail
+        instance.result = result
+        self.buffer.append(instance)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        from .models import AdHocRunHostResult
+        if not self.buffer:
+            return
+        buffer, self.buffer = self.buffer, []
+        try:
+            AdHocRunHostResult.objects.bulk_create(buffer)
+        except Exception as e:
+            logger.error("Save adhoc host results error: {}".format(e))
+
+
+class CommandResultSink:
+    """
+    CommandResultCallback 的 sink, 每个主机完成时写入一条
+    CommandExecutionHostResult 并更新 redis 中的进度
+    """
+    def __init__(self, execution):
+        self.execution = execution
+
+    def write(self, host, task_name, status, result, detail):
+        from .models import CommandExecutionHostResult
+        failed = status in CommandExecutionHostResult.FAILED_STATUS
+        seq = self.execution.incr_progress(failed=failed)
+        msg = result.get('msg', '') or detail.get('err', '')
+        try:
+            CommandExecutionHostResult.objects.create(
+                execution=self.execution, seq=seq, hostname=host,
+                status=status, rc=result.get('rc'),
+                stdout=result.get('stdout') or '',
+                stderr=result.get('stderr') or '',
+                msg=msg if isinstance(msg, str) else json.dumps(msg),
+                delta=result.get('delta') or '',
+            )
+        except Exception as e:
+            logger.error("Save command execution result error: {}".format(e))
+
+    def flush(self):
+        pass
@@ -3,7 +3,8 @@ from __future__ import unicode_literals
 from rest_framework import serializers
 from django.shortcuts import reverse
 
-from .models import Task, AdHoc, AdHocRunHistory, CommandExecution
+from .models import Task, AdHoc, AdHocRunHistory, AdHocRunHostResult, \
+    CommandExecution, CommandExecutionHostResult
 
 
 class CeleryResultSerializer(serializers.Serializer):
@@ -52,11 +53,9 @@ class AdHocRunHistorySerializer(serializers.ModelSerializer):
 
     @staticmethod
     def get_stat(obj):
-        return {
-            "total": obj.adhoc.hosts.count(),
-            "success": len(obj.summary.get("contacted", [])),
-            "failed": len(obj.summary.get("dark", [])),
-        }
+        stat = obj.stat
+        stat["total"] = obj.adhoc.hosts.count()
+        return stat
 
     def get_field_names(self, declared_fields, info):
         fields = super().get_field_names(declared_fields, info)
@@ -64,8 +63,20 @@ class AdHocRunHistorySerializer(serializers.ModelSerializer):
         return fields
 
 
-class CommandExecutionSerializer(serializers.ModelSerializer):
+class AdHocRunHostResultSerializer(serializers.ModelSerializer):
+    detail = serializers.JSONField(read_only=True)
     result = serializers.JSONField(read_only=True)
+
+    class Meta:
+        model = AdHocRunHostResult
+        fields = [
+            'id', 'hostname', 'task_name', 'status', 'detail', 'result',
+            'date_created',
+        ]
+
+
+class CommandExecutionSerializer(serializers.ModelSerializer):
+    result = serializers.SerializerMethodField()
     log_url = serializers.SerializerMethodField()
 
     class Meta:
@@ -82,3 +93,18 @@ class CommandExecutionSerializer(serializers.ModelSerializer):
     @staticmethod
     def get_log_url(obj):
         return reverse('api-ops:celery-task-log', kwargs={'pk': obj.id})
+
+    def get_result(self, obj):
+        # 每个主机的输出从 host_results 读取, 只在需要时返回
+        if self.context.get('with_host_results'):
+            return obj.get_host_results_compat()
+        return obj.result
+
+
+class CommandExecutionHostResultSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CommandExecutionHostResult
+        fields = [
+            'seq', 'hostname', 'status', 'rc', 'stdout', 'stderr', 'msg',
+            'delta', 'date_created',
+        ]
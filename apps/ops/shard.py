@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+"""
+主机数量很多的 adhoc 分片执行
+
+主机按 ANSIBLE_SHARD_SIZE 分片后放到 redis 队列, 由一组 celery 任务和发起执行的
+进程一起从队列取出分片执行, 同时执行的分片数不超过 ANSIBLE_SHARD_CONCURRENCY,
+每个分片的结果先放到 redis 中, 全部完成后一次合并到 AdHocRunHistory.
+发起的进程自己也会执行分片, 即使其它 worker 都在忙, 也不会一直等待.
+"""
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from common.utils import get_logger
+
+__all__ = [
+    'ShardQueue', 'split_shards', 'get_org_forks', 'merge_shard_result',
+]
+logger = get_logger(__file__)
+
+SHARD_QUEUE_KEY = '_ADHOC_SHARD_QUEUE_{}'
+SHARD_STATE_KEY = '_ADHOC_SHARD_STATE_{}'
+SHARD_RESULT_KEY = '_ADHOC_SHARD_RESULT_{}'
+
+
+def split_shards(items, size):
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+def get_org_forks(org_id):
+    """
+    分片执行时所有分片的 forks 总数, 没有设置组织的值时使用 ANSIBLE_FORKS
+    """
+    from orgs.models import Organization
+    key = str(org_id) if org_id else Organization.DEFAULT_ID_NAME
+    org_forks = settings.ANSIBLE_ORG_FORKS or {}
+    try:
+        forks = int(org_forks.get(key) or settings.ANSIBLE_FORKS)
+    except (TypeError, ValueError):
+        forks = settings.ANSIBLE_FORKS
+    return max(forks, 1)
+
+
+def merge_shard_result(raw, summary, shard_raw, shard_summary):
+    """
+    合并后的结果和不分片执行时的 results_raw, results_summary 格式相同
+    """
+    for k, v in shard_raw.items():
+        raw.setdefault(k, {}).update(v)
+    for k in ('contacted', 'dark'):
+        summary.setdefault(k, {}).update(shard_summary.get(k, {}))
+    # 流式执行的结果只有计数, 各分片的主机不重复, 直接相加
+    if 'stats' in shard_summary:
+        stats = summary.setdefault('stats', {})
+        for k, v in shard_summary['stats'].items():
+            stats[k] = stats.get(k, 0) + v
+    summary['success'] = summary.get('success', True) and \
+        shard_summary.get('success', True)
+    return raw, summary
+
+
+class ShardQueue:
+    """
+    一次执行的分片队列, state 中记录分片总数和已经完成的数量,
+    result 中按完成顺序保存每个分片的结果.
+    每次取出或完成分片时刷新过期时间, 执行时间超过 timeout 也不会过期
+    """
+    def __init__(self, run_id, timeout=None):
+        self.queue_key = SHARD_QUEUE_KEY.format(run_id)
+        self.state_key = SHARD_STATE_KEY.format(run_id)
+        self.result_key = SHARD_RESULT_KEY.format(run_id)
+        self.timeout = timeout or settings.ANSIBLE_SHARD_TIMEOUT
+
+    @property
+    def keys(self):
+        return self.queue_key, self.state_key, self.result_key
+
+    @staticmethod
+    def get_redis_client():
+        return cache.get_master_client()
+
+    def touch(self, pipe):
+        for key in self.keys:
+            pipe.expire(key, self.timeout)
+
+    def push(self, shards):
+        pipe = self.get_redis_client().pipeline()
+        pipe.delete(*self.keys)
+        pipe.rpush(self.queue_key, *[json.dumps(shard) for shard in shards])
+        pipe.hmset(self.state_key, {'total': len(shards), 'done': 0})
+        self.touch(pipe)
+        pipe.execute()
+
+    def pop(self):
+        pipe = self.get_redis_client().pipeline()
+        pipe.lpop(self.queue_key)
+        self.touch(pipe)
+        data = pipe.execute()[0]
+        if data is None:
+            return None
+        return json.loads(data.decode())
+
+    def finish_one(self, raw, summary):
+        """
+        保存分片的结果, 返回已经完成的分片数. 状态已经过期时不再写入
+        """
+        if not self.get_redis_client().exists(self.state_key):
+            logger.error("Adhoc shard state lost: {}".format(self.state_key))
+            return None
+        pipe = self.get_redis_client().pipeline()
+        pipe.rpush(self.result_key, json.dumps([raw, summary]))
+        pipe.hincrby(self.state_key, 'done', 1)
+        self.touch(pipe)
+        return pipe.execute()[1]
+
+    def get_state(self):
+        """
+        :return: (total, done), 状态不存在时返回 None
+        """
+        total, done = self.get_redis_client().hmget(
+            self.state_key, 'total', 'done'
+        )
+        if total is None:
+            return None
+        return int(total), int(done or 0)
+
+    def get_results(self):
+        values = self.get_redis_client().lrange(self.result_key, 0, -1)
+        return [json.loads(value.decode()) for value in values]
+
+    def wait(self, timeout, interval=1):
+        """
+        等待其它 worker 执行中的分片完成, 超时或者状态丢失时返回 False
+        """
+        deadline = time.time() + timeout
+        while True:
+            state = self.get_state()
+            if state is None:
+                logger.error("Adhoc shard state lost: {}".format(self.state_key))
+                return False
+            total, done = state
+            if done >= total:
+                return True
+            if time.time() > deadline:
+                logger.error("Wait adhoc shards timeout: {}/{}".format(done, total))
+                return False
+            time.sleep(interval)
+
+    def clean(self):
+        self.get_redis_client().delete(*self.keys)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+#
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from assets.models import Asset, AdminUser, SystemUser, Domain, Gateway, \
+    Node, Label
+from .inventory import expire_inventory_cache
+
+
+@receiver(post_save, sender=Asset)
+@receiver(post_delete, sender=Asset)
+@receiver(post_save, sender=AdminUser)
+@receiver(post_delete, sender=AdminUser)
+@receiver(post_save, sender=SystemUser)
+@receiver(post_delete, sender=SystemUser)
+@receiver(post_save, sender=Domain)
+@receiver(post_delete, sender=Domain)
+@receiver(post_save, sender=Gateway)
+@receiver(post_delete, sender=Gateway)
+@receiver(post_save, sender=Node)
+@receiver(post_delete, sender=Node)
+@receiver(post_save, sender=Label)
+@receiver(post_delete, sender=Label)
+@receiver(m2m_changed, sender=Asset.nodes.through)
+@receiver(m2m_changed, sender=Asset.labels.through)
+def on_inventory_related_changed(sender, action=None, **kwargs):
+    # m2m_changed 只处理 post_add, post_remove, post_clear
+    if action and not action.startswith('post'):
+        return
+    expire_inventory_cache()
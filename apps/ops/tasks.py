@@ -12,7 +12,7 @@ from .celery.decorator import (
     after_app_ready_start
 )
 from .celery.utils import create_or_update_celery_periodic_tasks
-from .models import Task, CommandExecution, CeleryTask
+from .models import Task, AdHoc, CommandExecution, CeleryTask
 
 logger = get_logger(__file__)
 
@@ -38,6 +38,18 @@ def run_ansible_task(tid, callback=None, **kwargs):
         logger.error("No task found")
 
 
+@shared_task
+def run_adhoc_shards(aid, hid, forks, stream=False):
+    """
+    分片执行 adhoc 的 worker, 从分片队列中取出分片执行, 结果合并到执行历史 hid
+    """
+    adhoc = get_object_or_none(AdHoc, id=aid)
+    if adhoc:
+        adhoc.run_shards(hid, forks, stream=stream)
+    else:
+        logger.error("No adhoc found: {}".format(aid))
+
+
 @shared_task
 def run_command_execution(cid, **kwargs):
     execution = get_object_or_none(CommandExecution, id=cid)
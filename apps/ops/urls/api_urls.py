@@ -16,6 +16,7 @@ router.register(r'command-executions', api.CommandExecutionViewSet, 'command-exe
 
 urlpatterns = [
     path('tasks/<uuid:pk>/run/', api.TaskRun.as_view(), name='task-run'),
+    path('history/<uuid:pk>/hosts/', api.AdHocRunHostResultListApi.as_view(), name='history-host-result-list'),
     path('celery/task/<uuid:pk>/log/', api.CeleryTaskLogApi.as_view(), name='celery-task-log'),
     path('celery/task/<uuid:pk>/result/', api.CeleryResultApi.as_view(), name='celery-result'),
 ]
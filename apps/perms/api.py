@@ -17,15 +17,17 @@ from common.utils import get_object_or_none
 from orgs.mixins import RootOrgViewMixin
 from orgs.utils import set_to_root_org
 from .utils import (
-    AssetPermissionUtil, parse_asset_to_tree_node, parse_node_to_tree_node
+    AssetPermissionUtil, parse_asset_to_tree_node, parse_node_to_tree_node,
+    check_user_asset_permission, check_user_asset_permission_bulk,
+    get_user_granted_tree_level, parse_more_to_tree_node,
 )
 from .models import AssetPermission
 from .hands import (
     AssetGrantedSerializer, User, UserGroup, Asset, Node,
-    SystemUser, NodeSerializer
+    SystemUser, NodeSerializer, get_node_tree
 )
 from . import serializers
-from .mixins import AssetsFilterMixin
+from .mixins import AssetsFilterMixin, GrantedAssetsSerializerMixin
 
 
 __all__ = [
@@ -171,9 +173,10 @@ class AssetPermissionViewSet(viewsets.ModelViewSet):
         return self.queryset.all()
 
 
-class UserGrantedAssetsApi(AssetsFilterMixin, ListAPIView):
+class UserGrantedAssetsApi(GrantedAssetsSerializerMixin, AssetsFilterMixin,
+                           ListAPIView):
     """
-    用户授权的所有资产
+    用户授权的所有资产, 搜索、排序和分页都在数据库中完成
     """
     permission_classes = (IsOrgAdminOrAppUser,)
     serializer_class = AssetGrantedSerializer
@@ -188,20 +191,14 @@ class UserGrantedAssetsApi(AssetsFilterMixin, ListAPIView):
     def get_queryset(self):
         self.change_org_if_need()
         user_id = self.kwargs.get('pk', '')
-        queryset = []
 
         if user_id:
             user = get_object_or_404(User, id=user_id)
         else:
             user = self.request.user
 
-        util = AssetPermissionUtil(user)
-        for k, v in util.get_assets().items():
-            system_users_granted = [s for s in v if s.protocol == k.protocol]
-            k.system_users_granted = system_users_granted
-            queryset.append(k)
-
-        return queryset
+        self.util = AssetPermissionUtil(user)
+        return self.util.get_assets_queryset()
 
     def get_permissions(self):
         if self.kwargs.get('pk') is None:
@@ -284,10 +281,16 @@ class UserGrantedNodesWithAssetsApi(AssetsFilterMixin, ListAPIView):
 
 
 class UserGrantedNodesWithAssetsAsTreeApi(ListAPIView):
+    """
+    用户授权的节点和资产树, lazy=1 时只返回 key 节点的下一层,
+    资产按 cursor 和 limit 分页, 还有剩余资产时最后附加一个 type 为 more 的节点
+    """
     serializer_class = TreeNodeSerializer
     permission_classes = (IsOrgAdminOrAppUser,)
     show_assets = True
     system_user_id = None
+    lazy = False
+    lazy_assets_limit = 500
 
     def change_org_if_need(self):
         if self.request.user.is_superuser or \
@@ -298,6 +301,7 @@ class UserGrantedNodesWithAssetsAsTreeApi(ListAPIView):
     def get(self, request, *args, **kwargs):
         self.show_assets = request.query_params.get('show_assets', '1') == '1'
         self.system_user_id = request.query_params.get('system_user')
+        self.lazy = request.query_params.get('lazy', '0') == '1'
         return super().get(request, *args, **kwargs)
 
     def get_permissions(self):
@@ -305,6 +309,53 @@ class UserGrantedNodesWithAssetsAsTreeApi(ListAPIView):
             self.permission_classes = (IsValidUser,)
         return super().get_permissions()
 
+    def get_query_param_int(self, name, default):
+        try:
+            value = int(self.request.query_params.get(name, default))
+        except ValueError:
+            value = default
+        return max(value, 0)
+
+    def get_lazy_queryset(self, user):
+        node_key = self.request.query_params.get('key', '')
+        level = get_user_granted_tree_level(
+            user, node_key=node_key, system_user_id=self.system_user_id
+        )
+        if not level:
+            return []
+        tree = get_node_tree()
+        queryset = []
+        for key, assets_amount in level['children']:
+            node = tree.get_node(key)
+            if node is None:
+                continue
+            node.assets_amount = assets_amount
+            queryset.append(parse_node_to_tree_node(node))
+
+        parent = tree.get_node(node_key) if node_key else None
+        if not self.show_assets or parent is None:
+            return queryset
+        cursor = self.get_query_param_int('cursor', 0)
+        limit = self.get_query_param_int('limit', self.lazy_assets_limit) \
+            or self.lazy_assets_limit
+        page = level['assets'][cursor:cursor+limit]
+        assets = Asset.objects.filter(id__in=[i[0] for i in page])\
+            .select_related('domain')
+        assets = {str(asset.id): asset for asset in assets}
+        system_users_id = {i for _, ids in page for i in ids}
+        system_users = SystemUser.objects.filter(id__in=system_users_id)
+        system_users = {str(s.id): s for s in system_users}
+        for asset_id, ids in page:
+            asset = assets.get(asset_id)
+            if asset is None:
+                continue
+            _system_users = [system_users[i] for i in ids if i in system_users]
+            queryset.append(parse_asset_to_tree_node(parent, asset, _system_users))
+        remain = len(level['assets']) - cursor - len(page)
+        if remain > 0:
+            queryset.append(parse_more_to_tree_node(parent, cursor+len(page), remain))
+        return queryset
+
     def get_queryset(self):
         self.change_org_if_need()
         user_id = self.kwargs.get('pk', '')
@@ -313,6 +364,8 @@ class UserGrantedNodesWithAssetsAsTreeApi(ListAPIView):
             user = self.request.user
         else:
             user = get_object_or_404(User, id=user_id)
+        if self.lazy:
+            return self.get_lazy_queryset(user)
         util = AssetPermissionUtil(user)
         if self.system_user_id:
             util.filter_permission_with_system_user(system_user=self.system_user_id)
@@ -329,7 +382,8 @@ class UserGrantedNodesWithAssetsAsTreeApi(ListAPIView):
         return queryset
 
 
-class UserGrantedNodeAssetsApi(AssetsFilterMixin, ListAPIView):
+class UserGrantedNodeAssetsApi(GrantedAssetsSerializerMixin, AssetsFilterMixin,
+                               ListAPIView):
     """
     查询用户授权的节点下的资产的api, 与上面api不同的是，只返回某个节点下的资产
     """
@@ -352,15 +406,9 @@ class UserGrantedNodeAssetsApi(AssetsFilterMixin, ListAPIView):
             user = get_object_or_404(User, id=user_id)
         else:
             user = self.request.user
-        util = AssetPermissionUtil(user)
+        self.util = AssetPermissionUtil(user)
         node = get_object_or_404(Node, id=node_id)
-        nodes = util.get_nodes_with_assets()
-        assets = nodes.get(node, [])
-        for asset, system_users in assets.items():
-            asset.system_users_granted = system_users
-
-        assets = list(assets.keys())
-        return assets
+        return self.util.get_assets_queryset().filter(nodes=node)
 
     def get_permissions(self):
         if self.kwargs.get('pk') is None:
@@ -484,6 +532,11 @@ class UserGroupGrantedNodeAssetsApi(ListAPIView):
 
 
 class ValidateUserAssetPermissionApi(RootOrgViewMixin, APIView):
+    """
+    验证用户是否可以使用系统用户登录资产
+    GET: ?user_id=&asset_id=&system_user_id=
+    POST: 批量验证 [{"user_id": "", "asset_id": "", "system_user_id": ""}, ]
+    """
     permission_classes = (IsOrgAdminOrAppUser,)
 
     @staticmethod
@@ -496,13 +549,33 @@ class ValidateUserAssetPermissionApi(RootOrgViewMixin, APIView):
         asset = get_object_or_404(Asset, id=asset_id)
         system_user = get_object_or_404(SystemUser, id=system_id)
 
-        util = AssetPermissionUtil(user)
-        assets_granted = util.get_assets()
-        if system_user in assets_granted.get(asset, []):
+        if check_user_asset_permission(user, asset, system_user):
             return Response({'msg': True}, status=200)
         else:
             return Response({'msg': False}, status=403)
 
+    @staticmethod
+    def post(request):
+        serializer = serializers.ValidateUserAssetPermissionSerializer(
+            data=request.data, many=True
+        )
+        if not serializer.is_valid():
+            return Response({'error': serializer.errors}, status=400)
+        items = [
+            (d['user_id'], d['asset_id'], d['system_user_id'])
+            for d in serializer.validated_data
+        ]
+        result = check_user_asset_permission_bulk(items)
+        data = []
+        for item in items:
+            user_id, asset_id, system_user_id = [str(i) for i in item]
+            data.append({
+                'user_id': user_id, 'asset_id': asset_id,
+                'system_user_id': system_user_id,
+                'msg': result.get((user_id, asset_id, system_user_id), False),
+            })
+        return Response(data, status=200)
+
 
 class AssetPermissionRemoveUserApi(RetrieveUpdateAPIView):
     """
@@ -4,6 +4,7 @@
 from common.permissions import AdminUserRequiredMixin
 from users.models import User, UserGroup
 from assets.models import Asset, SystemUser, Node
+from assets.tree import get_node_tree
 from assets.serializers import AssetGrantedSerializer, NodeSerializer
 
 
@@ -0,0 +1,27 @@
+# Generated by Django 2.1.7 on 2019-05-06 10:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0026_auto_20190425_1108'),
+        ('perms', '0009_auto_20180903_1132'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GrantedAssetIndex',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='granted_index', to='assets.Asset', verbose_name='Asset')),
+                ('permission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='granted_index', to='perms.AssetPermission', verbose_name='Asset permission')),
+            ],
+            options={
+                'verbose_name': 'Granted asset index',
+                'unique_together': {('permission', 'asset')},
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.1.7 on 2019-05-17 10:42
+
+from django.db import migrations
+from django.db.models import Q
+
+
+def get_node_assets_id(asset_model, node, db_alias):
+    q = Q(nodes__key=node.key) | Q(nodes__key__startswith=node.key + ':')
+    if node.key.isdigit():
+        q |= Q(nodes=None)
+    return asset_model.objects.using(db_alias).filter(q)\
+        .values_list('id', flat=True).distinct()
+
+
+def backfill_granted_asset_index(apps, schema_editor):
+    """
+    升级后索引表是空的, 在这里把已有的授权规则展开, 不依赖 celery 任务
+    """
+    perm_model = apps.get_model("perms", "AssetPermission")
+    index_model = apps.get_model("perms", "GrantedAssetIndex")
+    asset_model = apps.get_model("assets", "Asset")
+    db_alias = schema_editor.connection.alias
+
+    permissions = perm_model.objects.using(db_alias).all()\
+        .prefetch_related('nodes')
+    for perm in permissions:
+        assets_id = set(perm.assets.all().values_list('id', flat=True))
+        for node in perm.nodes.all():
+            assets_id.update(get_node_assets_id(asset_model, node, db_alias))
+        index_model.objects.using(db_alias).bulk_create([
+            index_model(permission_id=perm.id, asset_id=asset_id)
+            for asset_id in assets_id
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perms', '0010_grantedassetindex'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_granted_asset_index, migrations.RunPython.noop),
+    ]
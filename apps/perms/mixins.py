@@ -1,11 +1,16 @@
 # ~*~ coding: utf-8 ~*~
 #
+from django.db.models import Q, QuerySet
 
 
 class AssetsFilterMixin(object):
     """
-    对资产进行过滤(查询，排序)
+    对资产进行过滤(查询，排序), queryset 在数据库中完成, list 在内存中完成
     """
+    search_fields = ('hostname', 'ip', 'comment')
+    ordering_fields = (
+        'hostname', 'ip', 'port', 'protocol', 'platform', 'os', 'comment',
+    )
 
     def filter_queryset(self, queryset):
         queryset = self.search_assets(queryset)
@@ -17,6 +22,11 @@ class AssetsFilterMixin(object):
         value = self.request.query_params.get('search')
         if not value:
             return queryset
+        if isinstance(queryset, QuerySet):
+            q = Q()
+            for field in self.search_fields:
+                q |= Q(**{'{}__icontains'.format(field): value})
+            return queryset.filter(q)
         queryset = [asset for asset in queryset if is_obj_attr_has(asset, value)]
         return queryset
 
@@ -32,5 +42,30 @@ class AssetsFilterMixin(object):
         else:
             reverse = False
 
+        if isinstance(queryset, QuerySet):
+            if order_by not in self.ordering_fields:
+                order_by = 'hostname'
+            # ip 按数值排序
+            if order_by == 'ip':
+                order_by = 'ip_number'
+            if reverse:
+                order_by = '-' + order_by
+            return queryset.order_by(order_by, 'id')
+
         queryset = sort_assets(queryset, order_by=order_by, reverse=reverse)
         return queryset
+
+
+class GrantedAssetsSerializerMixin(object):
+    """
+    授权资产在数据库中分页后, 只为要序列化的资产设置授权的系统用户,
+    需要在 get_queryset 中设置 self.util
+    """
+    util = None
+
+    def get_serializer(self, *args, **kwargs):
+        if args and kwargs.get('many') and self.util is not None:
+            assets = list(args[0])
+            self.util.set_assets_system_users_granted(assets)
+            args = (assets,) + args[1:]
+        return super().get_serializer(*args, **kwargs)
@@ -80,6 +80,23 @@ class AssetPermission(OrgModelMixin):
         return assets
 
 
+class GrantedAssetIndex(models.Model):
+    """
+    授权规则展开后的资产索引, 节点授权会被展开成节点下的所有资产,
+    由 signals 增量维护, 查询用户授权资产时直接读取, 不再实时遍历节点
+    """
+    id = models.BigAutoField(primary_key=True)
+    permission = models.ForeignKey(AssetPermission, on_delete=models.CASCADE, related_name='granted_index', verbose_name=_("Asset permission"))
+    asset = models.ForeignKey('assets.Asset', on_delete=models.CASCADE, related_name='granted_index', verbose_name=_("Asset"))
+
+    class Meta:
+        unique_together = [('permission', 'asset')]
+        verbose_name = _("Granted asset index")
+
+    def __str__(self):
+        return '{0.permission_id} => {0.asset_id}'.format(self)
+
+
 class NodePermission(OrgModelMixin):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True)
     node = models.ForeignKey('assets.Node', on_delete=models.CASCADE, verbose_name=_("Node"))
@@ -13,6 +13,7 @@ __all__ = [
     'AssetPermissionUpdateUserSerializer', 'AssetPermissionUpdateAssetSerializer',
     'AssetPermissionNodeSerializer', 'GrantedNodeSerializer',
     'GrantedAssetSerializer', 'GrantedSystemUserSerializer',
+    'ValidateUserAssetPermissionSerializer',
 ]
 
 
@@ -130,3 +131,9 @@ class GrantedSystemUserSerializer(serializers.ModelSerializer):
             'id', 'name', 'username', 'protocol', 'priority',
             'login_mode', 'comment'
         ]
+
+
+class ValidateUserAssetPermissionSerializer(serializers.Serializer):
+    user_id = serializers.UUIDField()
+    asset_id = serializers.UUIDField()
+    system_user_id = serializers.UUIDField()
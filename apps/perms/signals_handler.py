@@ -1,15 +1,35 @@
 # -*- coding: utf-8 -*-
 #
-from django.db.models.signals import m2m_changed
+from django.db import transaction
+from django.db.models.signals import (
+    m2m_changed, pre_save, post_save, pre_delete, post_delete
+)
 from django.dispatch import receiver
 
 from common.utils import get_logger
 from .models import AssetPermission
+from .hands import Asset, Node, User, SystemUser
+from .utils import (
+    get_nodes_related_permissions_id, expire_permission_check_cache,
+    mark_permissions_index_pending
+)
 
 
 logger = get_logger(__file__)
 
 
+def rebuild_permissions_granted_index_on_commit(permissions_id):
+    from .tasks import rebuild_permissions_granted_index
+    permissions_id = [str(i) for i in permissions_id]
+    if not permissions_id:
+        return
+
+    def rebuild():
+        mark_permissions_index_pending(permissions_id)
+        rebuild_permissions_granted_index.delay(permissions_id)
+    transaction.on_commit(rebuild)
+
+
 @receiver(m2m_changed, sender=AssetPermission.nodes.through)
 def on_permission_nodes_changed(sender, instance=None, **kwargs):
     if isinstance(instance, AssetPermission) and kwargs['action'] == 'post_add':
@@ -40,3 +60,133 @@ def on_permission_system_users_changed(sender, instance=None, **kwargs):
         for system_user in system_users:
             system_user.nodes.add(*tuple(nodes))
             system_user.assets.add(*tuple(assets))
+
+
+@receiver(m2m_changed, sender=AssetPermission.assets.through)
+@receiver(m2m_changed, sender=AssetPermission.nodes.through)
+def on_permission_granted_changed(sender, instance=None, action='', pk_set=None, **kwargs):
+    """
+    授权规则的资产或节点变化时，重建该授权规则的资产索引
+    """
+    if isinstance(instance, AssetPermission):
+        if action not in ('post_add', 'post_remove', 'post_clear'):
+            return
+        permissions_id = [instance.id]
+    elif action in ('post_add', 'post_remove'):
+        permissions_id = pk_set
+    elif action == 'pre_clear':
+        permissions_id = instance.granted_by_permissions.values_list('id', flat=True)
+    else:
+        return
+    logger.debug("Asset permission granted change signal received")
+    rebuild_permissions_granted_index_on_commit(permissions_id)
+
+
+@receiver(m2m_changed, sender=Asset.nodes.through)
+def on_asset_nodes_changed_rebuild_index(sender, instance=None, action='', pk_set=None, **kwargs):
+    """
+    资产和节点的关系变化时, 授权了这些节点或其祖先节点的授权规则需要重建索引
+    """
+    if isinstance(instance, Node):
+        if action not in ('post_add', 'post_remove', 'post_clear'):
+            return
+        nodes_key = [instance.key]
+    elif action in ('post_add', 'post_remove'):
+        nodes_key = Node.objects.filter(pk__in=pk_set).values_list('key', flat=True)
+    elif action == 'pre_clear':
+        nodes_key = instance.nodes.all().values_list('key', flat=True)
+    else:
+        return
+    permissions_id = get_nodes_related_permissions_id(nodes_key)
+    rebuild_permissions_granted_index_on_commit(permissions_id)
+
+
+@receiver(post_save, sender=Node)
+def on_node_key_changed(sender, instance=None, created=False, **kwargs):
+    """
+    节点移动后, 新旧位置的祖先节点的授权规则都需要重建索引
+    _old_key 由 assets 的 pre_save 信号设置
+    """
+    old_key = getattr(instance, '_old_key', None)
+    if created or not old_key or old_key == instance.key:
+        return
+    permissions_id = get_nodes_related_permissions_id([old_key, instance.key])
+    rebuild_permissions_granted_index_on_commit(permissions_id)
+
+
+@receiver(pre_delete, sender=Node)
+def on_node_delete(sender, instance=None, **kwargs):
+    permissions_id = get_nodes_related_permissions_id([instance.key])
+    rebuild_permissions_granted_index_on_commit(permissions_id)
+
+
+# 只有这些字段会影响授权的判断和授权树, 其它字段的修改不需要让缓存失效
+PERMISSION_RELATED_FIELDS = {
+    Asset: ('is_active', 'protocol'),
+    SystemUser: ('protocol', 'priority'),
+}
+
+
+def get_permission_related_values(sender, pk):
+    fields = PERMISSION_RELATED_FIELDS[sender]
+    return sender.objects.filter(pk=pk).values_list(*fields).first()
+
+
+def is_update_fields_related(sender, update_fields):
+    if sender is Node:
+        fields = ('key',)
+    else:
+        fields = PERMISSION_RELATED_FIELDS[sender]
+    return update_fields is None or bool(set(update_fields) & set(fields))
+
+
+@receiver(pre_save, sender=Asset)
+@receiver(pre_save, sender=SystemUser)
+def on_permission_related_pre_save(sender, instance=None, update_fields=None, **kwargs):
+    if not is_update_fields_related(sender, update_fields):
+        return
+    instance._perms_old_values = get_permission_related_values(sender, instance.pk)
+
+
+@receiver(post_save, sender=Asset)
+@receiver(post_save, sender=SystemUser)
+@receiver(post_save, sender=Node)
+def on_permission_related_saved(sender, instance=None, created=False, update_fields=None, **kwargs):
+    if created:
+        # 新建的节点下还没有资产
+        if sender is not Node:
+            expire_permission_check_cache()
+        return
+    if not is_update_fields_related(sender, update_fields):
+        return
+    if sender is Node:
+        old_values = getattr(instance, '_old_key', None)
+        new_values = instance.key
+    else:
+        old_values = getattr(instance, '_perms_old_values', None)
+        new_values = tuple(
+            getattr(instance, f) for f in PERMISSION_RELATED_FIELDS[sender]
+        )
+    if old_values != new_values:
+        expire_permission_check_cache()
+
+
+@receiver(post_save, sender=AssetPermission)
+@receiver(post_delete, sender=AssetPermission)
+@receiver(post_delete, sender=Asset)
+@receiver(post_delete, sender=SystemUser)
+@receiver(post_delete, sender=Node)
+def on_permission_related_changed(sender, **kwargs):
+    expire_permission_check_cache()
+
+
+@receiver(m2m_changed, sender=AssetPermission.users.through)
+@receiver(m2m_changed, sender=AssetPermission.user_groups.through)
+@receiver(m2m_changed, sender=AssetPermission.assets.through)
+@receiver(m2m_changed, sender=AssetPermission.nodes.through)
+@receiver(m2m_changed, sender=AssetPermission.system_users.through)
+@receiver(m2m_changed, sender=Asset.nodes.through)
+@receiver(m2m_changed, sender=User.groups.through)
+def on_permission_related_m2m_changed(sender, action='', **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        expire_permission_check_cache()
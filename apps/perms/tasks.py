@@ -3,8 +3,32 @@ from __future__ import absolute_import, unicode_literals
 
 from celery import shared_task
 from common.utils import get_logger, encrypt_password
+from ops.celery.decorator import (
+    register_as_period_task, after_app_ready_start,
+    after_app_shutdown_clean_periodic
+)
+from orgs.utils import set_to_root_org
+from .models import AssetPermission
+from .utils import rebuild_permission_granted_index, \
+    rebuild_pending_permissions_index
 
 logger = get_logger(__file__)
 
 
+@shared_task
+def rebuild_permissions_granted_index(permissions_id):
+    set_to_root_org()
+    # 请求中可能已经同步重建过, 只重建还在等待的
+    rebuild_pending_permissions_index(permissions_id)
 
+
+@shared_task
+@register_as_period_task(interval=3600*24)
+@after_app_ready_start
+@after_app_shutdown_clean_periodic
+def rebuild_all_permissions_granted_index_period():
+    logger.info("Start rebuild all permissions granted index")
+    set_to_root_org()
+    permissions = AssetPermission.objects.all().prefetch_related('nodes')
+    for permission in permissions:
+        rebuild_permission_granted_index(permission)
@@ -2,12 +2,15 @@
 
 from __future__ import absolute_import, unicode_literals
 from collections import defaultdict
+from django.db import transaction
 from django.db.models import Q
+from django.core.cache import cache
 
 from common.utils import get_logger
 from common.tree import TreeNode
-from .models import AssetPermission
-from .hands import Node
+from orgs.utils import current_org
+from .models import AssetPermission, GrantedAssetIndex
+from .hands import Node, Asset, User, SystemUser, get_node_tree
 
 logger = get_logger(__file__)
 
@@ -19,7 +22,7 @@ class GenerateTree:
             "asset_instance": set("system_user")
         }
         """
-        self.__all_nodes = list(Node.objects.all())
+        self.tree = get_node_tree()
         self.nodes = defaultdict(dict)
 
     def add_asset(self, asset, system_users):
@@ -29,12 +32,15 @@ class GenerateTree:
             self.nodes[node][asset].update(system_users)
 
     def get_nodes(self):
+        # 把每个节点的资产汇总到所有祖先节点上, 避免两两比较节点
+        nodes_keys = {node.key for node in self.nodes}
+        assets_by_key = defaultdict(set)
+        for node, assets in self.nodes.items():
+            for key in node.get_ancestor_keys(with_self=True):
+                if key in nodes_keys:
+                    assets_by_key[key].update(assets.keys())
         for node in self.nodes:
-            assets = set(self.nodes.get(node).keys())
-            for n in self.nodes.keys():
-                if n.key.startswith(node.key + ':'):
-                    assets.update(set(self.nodes[n].keys()))
-            node.assets_amount = len(assets)
+            node.assets_amount = len(assets_by_key[node.key])
         return self.nodes
 
     def add_node(self, node):
@@ -44,10 +50,9 @@ class GenerateTree:
             self.nodes[node] = defaultdict(set)
         if node.is_root():
             return
-        for n in self.__all_nodes:
-            if n.key == node.parent_key:
-                self.add_node(n)
-                break
+        parent = self.tree.get_node(node.parent_key)
+        if parent is not None:
+            self.add_node(parent)
 
     def add_nodes(self, nodes):
         for node in nodes:
@@ -142,19 +147,79 @@ class AssetPermissionUtil:
         return assets
 
     def get_assets(self):
+        """
+        从授权资产索引中读取授权的资产, 节点已经在索引中展开
+        :return: {asset1: set(system_user1,)}
+        """
         if self._assets:
             return self._assets
-        assets = self.get_assets_direct()
-        nodes = self.get_nodes_direct()
-        for node, system_users in nodes.items():
-            _assets = node.get_all_assets().valid().prefetch_related('nodes')
-            for asset in _assets:
-                assets[asset].update(
-                    [s for s in system_users if s.protocol == asset.protocol]
-                )
+        assets = defaultdict(set)
+        self.ensure_granted_index()
+        perms_system_users = self.get_permissions_system_users()
+        index = GrantedAssetIndex.objects.filter(
+            permission_id__in=perms_system_users.keys()
+        ).values_list('asset_id', 'permission_id')
+        assets_perms = defaultdict(set)
+        for asset_id, perm_id in index:
+            assets_perms[asset_id].add(perm_id)
+
+        _assets = Asset.objects.filter(id__in=assets_perms.keys())\
+            .valid().prefetch_related('nodes')
+        for asset in _assets:
+            for perm_id in assets_perms[asset.id]:
+                assets[asset].update([
+                    s for s in perms_system_users[perm_id]
+                    if s.protocol == asset.protocol
+                ])
         self._assets = assets
         return self._assets
 
+    def ensure_granted_index(self):
+        """
+        重建索引的任务还没有执行时, 同步重建这些授权规则的索引
+        """
+        permissions_id = self.permissions.values_list('id', flat=True)
+        rebuild_pending_permissions_index(permissions_id)
+
+    def get_permissions_system_users(self):
+        """
+        :return: {perm.id: [system_user1, ]}
+        """
+        permissions = self.permissions.prefetch_related('system_users')
+        return {perm.id: list(perm.system_users.all()) for perm in permissions}
+
+    def get_assets_queryset(self):
+        """
+        授权资产的 queryset, 搜索、排序和分页都在数据库中完成,
+        需要再调用 set_assets_system_users_granted 设置授权的系统用户
+        """
+        self.ensure_granted_index()
+        return Asset.objects.filter(
+            granted_index__permission_id__in=self.permissions.values('id')
+        ).valid().distinct()
+
+    def set_assets_system_users_granted(self, assets):
+        """
+        只查询这些资产的授权索引, 设置 asset.system_users_granted
+        """
+        perms_system_users = self.get_permissions_system_users()
+        index = GrantedAssetIndex.objects.filter(
+            permission_id__in=perms_system_users.keys(),
+            asset_id__in=[asset.id for asset in assets]
+        ).values_list('asset_id', 'permission_id')
+        assets_perms = defaultdict(set)
+        for asset_id, perm_id in index:
+            assets_perms[asset_id].add(perm_id)
+        for asset in assets:
+            system_users = set()
+            for perm_id in assets_perms[asset.id]:
+                system_users.update([
+                    s for s in perms_system_users[perm_id]
+                    if s.protocol == asset.protocol
+                ])
+            asset.system_users_granted = list(system_users)
+        return assets
+
     def get_nodes_with_assets(self):
         """
         返回节点并且包含资产
@@ -175,6 +240,256 @@ class AssetPermissionUtil:
         return system_users
 
 
+def get_permission_assets_id(permission):
+    """
+    授权规则授权的所有资产id, 节点授权展开成节点下的所有资产
+    """
+    assets_id = set(permission.assets.all().values_list('id', flat=True))
+    for node in permission.nodes.all():
+        assets_id.update(node.get_all_assets().values_list('id', flat=True))
+    return assets_id
+
+
+def rebuild_permission_granted_index(permission):
+    """
+    对比授权规则现在的资产和索引中的资产，只增删有变化的部分
+    """
+    with transaction.atomic():
+        # 锁住授权规则, 任务和请求中同时重建时依次执行
+        locked = AssetPermission.objects.select_for_update()\
+            .filter(id=permission.id).values_list('id', flat=True)
+        if not list(locked):
+            return
+        assets_id = get_permission_assets_id(permission)
+        indexed = GrantedAssetIndex.objects.filter(permission=permission)
+        indexed_assets_id = set(indexed.values_list('asset_id', flat=True))
+        to_remove = indexed_assets_id - assets_id
+        to_add = assets_id - indexed_assets_id
+        if to_remove:
+            indexed.filter(asset_id__in=to_remove).delete()
+        GrantedAssetIndex.objects.bulk_create([
+            GrantedAssetIndex(permission=permission, asset_id=asset_id)
+            for asset_id in to_add
+        ], batch_size=1000)
+    logger.debug("Rebuild permission `{}` granted index: +{} -{}".format(
+        permission, len(to_add), len(to_remove)
+    ))
+
+
+PERMISSION_INDEX_PENDING_KEY = '_PERMS_GRANTED_INDEX_PENDING'
+
+
+def mark_permissions_index_pending(permissions_id):
+    """
+    记录等待重建索引的授权规则, celery 任务延迟或者没有运行时, 读取时同步重建
+    """
+    permissions_id = [str(i) for i in permissions_id]
+    if permissions_id:
+        cache.get_master_client().sadd(PERMISSION_INDEX_PENDING_KEY, *permissions_id)
+
+
+def rebuild_pending_permissions_index(permissions_id):
+    """
+    只重建这些授权规则中等待重建的, 先移出集合, 失败时放回
+    """
+    permissions_id = [str(i) for i in permissions_id]
+    if not permissions_id:
+        return
+    client = cache.get_master_client()
+    pipe = client.pipeline()
+    for perm_id in permissions_id:
+        pipe.sismember(PERMISSION_INDEX_PENDING_KEY, perm_id)
+    pending = [i for i, v in zip(permissions_id, pipe.execute()) if v]
+    if not pending:
+        return
+    client.srem(PERMISSION_INDEX_PENDING_KEY, *pending)
+    permissions = AssetPermission.objects.filter(id__in=pending)\
+        .prefetch_related('nodes')
+    try:
+        for permission in permissions:
+            rebuild_permission_granted_index(permission)
+    except Exception:
+        client.sadd(PERMISSION_INDEX_PENDING_KEY, *pending)
+        raise
+
+
+def get_nodes_related_permissions_id(nodes_key):
+    """
+    节点的资产变化时, 授权了这些节点或其祖先节点的授权规则都需要重建索引
+    """
+    ancestor_keys = set()
+    for key in nodes_key:
+        node = Node(key=key)
+        ancestor_keys.update(node.get_ancestor_keys(with_self=True))
+    if not ancestor_keys:
+        return set()
+    permissions_id = AssetPermission.objects.filter(
+        nodes__key__in=ancestor_keys
+    ).values_list('id', flat=True).distinct()
+    return set(permissions_id)
+
+
+PERMISSION_CHECK_VERSION_KEY = '_PERMS_CHECK_VERSION'
+PERMISSION_CHECK_CACHE_KEY = '_PERMS_CHECK_{}_{}_{}_{}'
+PERMISSION_CHECK_CACHE_TTL = 60
+
+
+def get_permission_check_version():
+    version = cache.get(PERMISSION_CHECK_VERSION_KEY)
+    if version is None:
+        version = 1
+        cache.set(PERMISSION_CHECK_VERSION_KEY, version, None)
+    return version
+
+
+def expire_permission_check_cache():
+    """
+    授权相关的数据变化时，增加版本号，之前的判断缓存全部失效
+    """
+    try:
+        cache.incr(PERMISSION_CHECK_VERSION_KEY)
+    except ValueError:
+        cache.set(PERMISSION_CHECK_VERSION_KEY, 1, None)
+
+
+def get_asset_ancestor_keys(asset):
+    keys = set()
+    for node in asset.get_nodes():
+        keys.update(node.get_ancestor_keys(with_self=True))
+    return keys
+
+
+def is_user_asset_permission_valid(user, asset, system_user):
+    """
+    只查询资产所在节点及其祖先节点上的授权规则，判断用户是否可以
+    使用系统用户登录资产, 一次查询完成
+    """
+    if not asset.is_active or system_user.protocol != asset.protocol:
+        return False
+    ancestor_keys = get_asset_ancestor_keys(asset)
+    return AssetPermission.objects.valid().filter(
+        Q(users=user) | Q(user_groups__in=user.groups.all()),
+        Q(assets=asset) | Q(nodes__key__in=ancestor_keys),
+        system_users=system_user,
+    ).exists()
+
+
+def check_user_asset_permission(user, asset, system_user):
+    version = get_permission_check_version()
+    key = PERMISSION_CHECK_CACHE_KEY.format(
+        version, user.id, asset.id, system_user.id
+    )
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    valid = is_user_asset_permission_valid(user, asset, system_user)
+    cache.set(key, valid, PERMISSION_CHECK_CACHE_TTL)
+    return valid
+
+
+def check_user_asset_permission_bulk(items):
+    """
+    批量验证
+    :param items: [(user_id, asset_id, system_user_id), ...]
+    :return: {(user_id, asset_id, system_user_id): True/False}
+    """
+    items = [tuple(str(i) for i in item) for item in items]
+    version = get_permission_check_version()
+    keys = {
+        PERMISSION_CHECK_CACHE_KEY.format(version, *item): item
+        for item in items
+    }
+    result = {}
+    for key, value in cache.get_many(keys.keys()).items():
+        result[keys[key]] = value
+    missed = [item for item in items if item not in result]
+    if not missed:
+        return result
+
+    users = User.objects.filter(id__in={i[0] for i in missed})\
+        .prefetch_related('groups')
+    assets = Asset.objects.filter(id__in={i[1] for i in missed})\
+        .prefetch_related('nodes')
+    system_users = SystemUser.objects.filter(id__in={i[2] for i in missed})
+    users = {str(u.id): u for u in users}
+    assets = {str(a.id): a for a in assets}
+    system_users = {str(s.id): s for s in system_users}
+
+    to_cache = {}
+    for item in missed:
+        user_id, asset_id, system_user_id = item
+        user = users.get(user_id)
+        asset = assets.get(asset_id)
+        system_user = system_users.get(system_user_id)
+        if not user or not asset or not system_user:
+            valid = False
+        else:
+            valid = is_user_asset_permission_valid(user, asset, system_user)
+        result[item] = valid
+        to_cache[PERMISSION_CHECK_CACHE_KEY.format(version, *item)] = valid
+    cache.set_many(to_cache, PERMISSION_CHECK_CACHE_TTL)
+    return result
+
+
+USER_GRANTED_TREE_CACHE_KEY = '_PERMS_USER_TREE_{}_{}_{}_{}_{}'
+USER_GRANTED_TREE_CACHE_TTL = 3600
+
+
+def get_user_granted_tree_cache_key(user, system_user_id, node_key=''):
+    return USER_GRANTED_TREE_CACHE_KEY.format(
+        get_permission_check_version(), current_org.id, user.id,
+        system_user_id or '', node_key
+    )
+
+
+def build_user_granted_tree(user, system_user_id=None):
+    """
+    预先计算用户授权树, 每个节点一个缓存:
+    {'children': [(node_key, assets_amount)], 'assets': [(asset_id, [system_user_id])]}
+    空 key 存放根节点, 展开节点时只读取这个节点的缓存
+    """
+    util = AssetPermissionUtil(user)
+    if system_user_id:
+        util.filter_permission_with_system_user(system_user=system_user_id)
+    nodes = util.get_nodes_with_assets()
+    nodes_keys = {node.key for node in nodes}
+    children = defaultdict(list)
+    for node in sorted(nodes, key=lambda x: x.value):
+        parent_key = '' if node.parent_key not in nodes_keys else node.parent_key
+        children[parent_key].append((node.key, node.assets_amount))
+
+    data = {'': {'children': children[''], 'assets': []}}
+    for node, assets in nodes.items():
+        assets = sorted(assets.items(), key=lambda x: x[0].hostname)
+        data[node.key] = {
+            'children': children[node.key],
+            'assets': [
+                (str(asset.id), [str(s.id) for s in system_users])
+                for asset, system_users in assets
+            ]
+        }
+    to_cache = {
+        get_user_granted_tree_cache_key(user, system_user_id, key): value
+        for key, value in data.items()
+    }
+    cache.set_many(to_cache, USER_GRANTED_TREE_CACHE_TTL)
+    return data
+
+
+def get_user_granted_tree_level(user, node_key='', system_user_id=None):
+    """
+    获取授权树中一个节点的下一层, 不传 node_key 返回根节点
+    :return: {'children': [...], 'assets': [...]} 或 None
+    """
+    key = get_user_granted_tree_cache_key(user, system_user_id, node_key)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    # 任何一层不在缓存中都重新构建, 各层的缓存可能被单独淘汰
+    data = build_user_granted_tree(user, system_user_id=system_user_id)
+    return data.get(node_key)
+
+
 def is_obj_attr_has(obj, val, attrs=("hostname", "ip", "comment")):
     if not attrs:
         vals = [val for val in obj.__dict__.values() if isinstance(val, (str, int))]
@@ -260,3 +575,21 @@ def parse_asset_to_tree_node(node, asset, system_users):
     }
     tree_node = TreeNode(**data)
     return tree_node
+
+
+def parse_more_to_tree_node(node, cursor, remain):
+    data = {
+        'id': '{}:more:{}'.format(node.key, cursor),
+        'name': '... ({})'.format(remain),
+        'title': '... ({})'.format(remain),
+        'pId': node.key,
+        'isParent': False,
+        'open': False,
+        'meta': {
+            'type': 'more',
+            'key': node.key,
+            'cursor': cursor,
+        }
+    }
+    tree_node = TreeNode(**data)
+    return tree_node
@@ -1,37 +1,88 @@
 # -*- coding: utf-8 -*-
 #
+import json
 import logging
 import os
 
 from django.shortcuts import get_object_or_404
 from django.core.files.storage import default_storage
-from django.http import HttpResponseNotFound
+from django.http import HttpResponseNotFound, HttpResponse, \
+    StreamingHttpResponse
+from django.urls import reverse
 from django.conf import settings
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.pagination import LimitOffsetPagination, CursorPagination
+from rest_framework.utils.urls import replace_query_param
 from rest_framework import viewsets
-from rest_framework.views import Response
+from rest_framework.views import Response, APIView
 from rest_framework_bulk import BulkModelViewSet
-import jms_storage
 
 
 from common.utils import is_uuid
-from common.permissions import IsOrgAdminOrAppUser
+from common.permissions import IsOrgAdminOrAppUser, IsOrgAdmin
 from ...hands import SystemUser
 from ...models import Terminal, Session
 from ...serializers import v1 as serializers
 from ...backends import get_command_storage, get_multi_command_storage, \
     SessionCommandSerializer
+from ...backends.replay import (
+    get_replay_object_store, get_replay_cache, STREAM_CHUNK_SIZE
+)
+from ...utils import (
+    enqueue_commands, bulk_save_commands, get_command_metrics,
+    parse_range_header,
+)
+from ...replay_format import get_index_path, read_window
+from ...tasks import (
+    schedule_save_queued_commands, convert_replay_to_seekable,
+)
 
-__all__ = ['SessionViewSet', 'SessionReplayViewSet', 'CommandViewSet']
+__all__ = [
+    'SessionViewSet', 'SessionReplayViewSet', 'CommandViewSet',
+    'CommandMetricsApi', 'SessionReplayStreamApi', 'ReplayCacheMetricsApi',
+    'SessionReplayWindowApi',
+]
 logger = logging.getLogger(__file__)
 
 
+class SessionCursorPagination(CursorPagination):
+    """
+    按 (date_start, id) 倒序的游标分页, 深翻页和第一页一样快
+    """
+    ordering = ('-date_start', '-id')
+    page_size = 100
+    page_size_query_param = 'limit'
+    max_page_size = 1000
+
+
 class SessionViewSet(BulkModelViewSet):
     queryset = Session.objects.all()
     serializer_class = serializers.SessionSerializer
     pagination_class = LimitOffsetPagination
     permission_classes = (IsOrgAdminOrAppUser,)
 
+    @property
+    def paginator(self):
+        # 传入 cursor 或者 ?pagination=cursor 时使用游标分页, 深翻页和第一页一样快,
+        # 其它情况和原来一样使用 limit/offset 分页, 兼容已有的客户端
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if 'cursor' in params or params.get('pagination') == 'cursor':
+                self._paginator = SessionCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def get_serializer(self, *args, **kwargs):
+        # 只为要序列化的会话批量查询命令数
+        if args and self.request.method == 'GET':
+            if kwargs.get('many'):
+                sessions = list(args[0])
+                args = (sessions,) + args[1:]
+            else:
+                sessions = [args[0]]
+            Session.set_sessions_command_amount(sessions)
+        return super().get_serializer(*args, **kwargs)
+
     def get_queryset(self):
         queryset = super().get_queryset()
         terminal_id = self.kwargs.get("terminal", None)
@@ -70,6 +121,8 @@ class CommandViewSet(viewsets.ViewSet):
     multi_command_storage = get_multi_command_storage()
     serializer_class = SessionCommandSerializer
     permission_classes = (IsOrgAdminOrAppUser,)
+    default_limit = 100
+    max_limit = 1000
 
     def get_queryset(self):
         self.command_store.filter(**dict(self.request.query_params))
@@ -77,8 +130,12 @@ class CommandViewSet(viewsets.ViewSet):
     def create(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data, many=True)
         if serializer.is_valid():
-            ok = self.command_store.bulk_save(serializer.validated_data)
-            if ok:
+            if settings.TERMINAL_COMMAND_ASYNC_SAVE and self.enqueue(serializer.validated_data):
+                return Response("ok", status=201)
+            saved, failed, unsaved = bulk_save_commands(
+                self.command_store, serializer.validated_data
+            )
+            if not failed and not unsaved:
                 return Response("ok", status=201)
             else:
                 return Response("Save error", status=500)
@@ -87,10 +144,55 @@ class CommandViewSet(viewsets.ViewSet):
             logger.error(msg)
             return Response({"msg": msg}, status=401)
 
+    @staticmethod
+    def enqueue(commands):
+        try:
+            enqueue_commands([dict(c) for c in commands])
+        except Exception as e:
+            logger.error("Enqueue commands error, save directly: {}".format(e))
+            return False
+        schedule_save_queued_commands()
+        return True
+
     def list(self, request, *args, **kwargs):
-        queryset = self.multi_command_storage.filter()
-        serializer = self.serializer_class(queryset, many=True)
-        return Response(serializer.data)
+        limit = request.query_params.get('limit')
+        cursor = request.query_params.get('cursor')
+        if limit is None and cursor is None:
+            queryset = self.multi_command_storage.filter()
+            serializer = self.serializer_class(queryset, many=True)
+            return Response(serializer.data)
+        return self.list_by_cursor(request, limit, cursor)
+
+    def list_by_cursor(self, request, limit, cursor):
+        """
+        按 (timestamp, id) 的游标分页, next 为下一页的链接
+        """
+        try:
+            limit = min(int(limit or self.default_limit), self.max_limit)
+        except ValueError:
+            return Response({"msg": "Invalid limit"}, status=400)
+        if limit <= 0:
+            return Response({"msg": "Invalid limit"}, status=400)
+        commands, next_cursor = self.multi_command_storage.filter_page(
+            limit=limit, cursor=cursor
+        )
+        next_url = None
+        if next_cursor:
+            next_url = replace_query_param(
+                request.build_absolute_uri(), 'cursor', next_cursor
+            )
+        serializer = self.serializer_class(commands, many=True)
+        return Response({"next": next_url, "results": serializer.data})
+
+
+class CommandMetricsApi(APIView):
+    """
+    命令入库队列的长度和吞吐量
+    """
+    permission_classes = (IsOrgAdmin,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(get_command_metrics())
 
 
 class SessionReplayViewSet(viewsets.ViewSet):
@@ -110,6 +212,8 @@ class SessionReplayViewSet(viewsets.ViewSet):
                 msg = "Failed save replay `{}`: {}".format(session_id, err)
                 logger.error(msg)
                 return Response({'msg': str(err)}, status=400)
+            if settings.TERMINAL_REPLAY_SEEKABLE:
+                convert_replay_to_seekable.delay(str(session.id))
             url = default_storage.url(name)
             return Response({'url': url}, status=201)
         else:
@@ -121,11 +225,7 @@ class SessionReplayViewSet(viewsets.ViewSet):
         session_id = kwargs.get('pk')
         session = get_object_or_404(Session, id=session_id)
 
-        tp = 'json'
-        if session.protocol in ('rdp', 'vnc'):
-            tp = 'guacamole'
-
-        data = {'type': tp, 'src': ''}
+        data = {'type': session.replay_type, 'src': ''}
 
         # 新版本和老版本的文件后缀不同
         session_path = session.get_rel_replay_path()  # 存在外部存储上的路径
@@ -139,21 +239,148 @@ class SessionReplayViewSet(viewsets.ViewSet):
                 data['src'] = url
                 return Response(data)
 
-        # 去定义的外部storage查找
-        configs = settings.TERMINAL_REPLAY_STORAGE
-        configs = {k: v for k, v in configs.items() if v['TYPE'] != 'server'}
-        if not configs:
+        # 外部存储的录像通过代理按范围读取, 不用等待下载完成
+        if get_replay_object_store() is None:
             return HttpResponseNotFound()
+        data['src'] = reverse(
+            'api-terminal:session-replay-stream', kwargs={'pk': session.id}
+        )
+        return Response(data)
 
-        target_path = os.path.join(default_storage.base_location, local_path)   # 保存到storage的路径
-        target_dir = os.path.dirname(target_path)
-        if not os.path.isdir(target_dir):
-            os.makedirs(target_dir, exist_ok=True)
-        storage = jms_storage.get_multi_object_storage(configs)
-        ok, err = storage.download(session_path, target_path)
-        if not ok:
-            logger.error("Failed download replay file: {}".format(err))
+
+def iter_file_range(path, start, end, chunk_size=STREAM_CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remain = end - start + 1
+        while remain > 0:
+            chunk = f.read(min(chunk_size, remain))
+            if not chunk:
+                break
+            remain -= len(chunk)
+            yield chunk
+
+
+class SessionReplayStreamApi(APIView):
+    """
+    代理外部存储的录像, 支持 Range 请求, 本地缓存命中时读取本地文件,
+    没有命中时直接按范围读取外部存储, 同时在后台线程下载到本机的缓存
+    """
+    permission_classes = (IsOrgAdminOrAppUser,)
+
+    def get(self, request, *args, **kwargs):
+        session = get_object_or_404(Session, id=kwargs.get('pk'))
+        path = session.get_rel_replay_path()
+
+        replay_cache = get_replay_cache()
+        local_path = replay_cache.get(path)
+        if local_path:
+            size = os.path.getsize(local_path)
+            return self.make_response(
+                request, size,
+                lambda start, end: iter_file_range(local_path, start, end)
+            )
+
+        store = get_replay_object_store()
+        location = store.locate(path) if store else None
+        if location is None:
             return HttpResponseNotFound()
-        data['src'] = default_storage.url(local_path)
-        return Response(data)
+        replay_cache.fill_async(path, store)
+        return self.make_response(
+            request, location[1],
+            lambda start, end: store.iter_range(path, start, end)
+        )
+
+    @staticmethod
+    def make_response(request, size, iter_range):
+        try:
+            byte_range = parse_range_header(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        if byte_range is None:
+            start, end, status = 0, size - 1, 200
+        else:
+            (start, end), status = byte_range, 206
+        response = StreamingHttpResponse(
+            iter_range(start, end) if size else iter(()), status=status,
+            content_type='application/octet-stream'
+        )
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Length'] = end - start + 1 if size else 0
+        if status == 206:
+            response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        return response
+
+
+class ReplayCacheMetricsApi(APIView):
+    """
+    录像缓存的命中率和淘汰情况
+    """
+    permission_classes = (IsOrgAdmin,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(get_replay_cache().get_metrics())
+
+
+def read_file_range(path, offset, stop):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(stop - offset)
+
+
+class SessionReplayWindowApi(APIView):
+    """
+    只返回一段时间的录像, 需要录像有时间索引
+    ?start=秒数&end=秒数, 时间为相对会话开始的秒数
+    """
+    permission_classes = (IsOrgAdminOrAppUser,)
+
+    def get(self, request, *args, **kwargs):
+        session = get_object_or_404(Session, id=kwargs.get('pk'))
+        try:
+            start = float(request.query_params.get('start', 0))
+            end = float(request.query_params.get('end', start + 60))
+        except ValueError:
+            return Response({"msg": "Invalid start or end"}, status=400)
+
+        reader = self.get_reader(session)
+        if reader is None:
+            return Response({"msg": "Replay has no index"}, status=404)
+        index, read_range = reader
+        data = read_window(index, read_range, start, end)
+        return Response({
+            'type': index.get('type', session.replay_type),
+            'start': start, 'end': end,
+            'duration': index.get('duration', 0),
+            'data': data,
+        })
+
+    @staticmethod
+    def get_reader(session):
+        """
+        返回 (索引, read_range), 录像或者索引不存在时返回 None
+        """
+        for path in (session.get_local_path(), session.get_local_path(version=1)):
+            index_path = get_index_path(path)
+            if not default_storage.exists(index_path):
+                continue
+            with default_storage.open(index_path) as f:
+                index = json.loads(f.read().decode())
+            local_path = default_storage.path(path)
+            return index, lambda offset, stop: read_file_range(local_path, offset, stop)
 
+        store = get_replay_object_store()
+        if store is None:
+            return None
+        path = session.get_rel_replay_path()
+        index_path = get_index_path(path)
+        location = store.locate(index_path)
+        if location is None:
+            return None
+        # 索引很小, 直接读取; 录像只读取覆盖这段时间的 member
+        index = json.loads(store.read_range(index_path, 0, location[1]).decode())
+        local_path = get_replay_cache().get(path)
+        if local_path:
+            return index, lambda offset, stop: read_file_range(local_path, offset, stop)
+        return index, lambda offset, stop: store.read_range(path, offset, stop)
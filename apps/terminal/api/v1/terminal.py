@@ -14,7 +14,7 @@ from rest_framework.permissions import AllowAny
 
 from common.utils import get_object_or_none
 from common.permissions import IsAppUser, IsOrgAdminOrAppUser, IsSuperUser
-from ...models import Terminal, Status, Session
+from ...models import Terminal, Status, Session, Task
 from ...serializers import v1 as serializers
 
 __all__ = [
@@ -102,9 +102,17 @@ class StatusViewSet(viewsets.ModelViewSet):
     def create(self, request, *args, **kwargs):
         self.handle_status(request)
         self.handle_sessions()
-        tasks = self.request.user.terminal.task_set.filter(is_finished=False)
-        serializer = self.task_serializer_class(tasks, many=True)
-        return Response(serializer.data, status=201)
+        return Response(self.get_tasks_data(), status=201)
+
+    def get_tasks_data(self):
+        terminal = self.request.user.terminal
+        key = Task.TERMINAL_TASKS_CACHE_KEY.format(terminal.id)
+        data = cache.get(key)
+        if data is None:
+            tasks = terminal.task_set.filter(is_finished=False)
+            data = list(self.task_serializer_class(tasks, many=True).data)
+            cache.set(key, data, 3600)
+        return data
 
     def handle_status(self, request):
         request.user.terminal.is_alive = True
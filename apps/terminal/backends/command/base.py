@@ -13,10 +13,20 @@ class CommandBase(object):
     def bulk_save(self, commands):
         pass
 
+    def ping(self):
+        """
+        存储是否可用, 批量保存失败时用来区分存储故障和个别命令的错误
+        """
+        return True
+
     @abc.abstractmethod
     def filter(self, date_from=None, date_to=None,
                user=None, asset=None, system_user=None,
-               input=None, session=None):
+               input=None, session=None, limit=None, offset=0, after=None):
+        """
+        结果按 (timestamp, id) 倒序, 传入 limit 时只返回 offset 开始的 limit 条,
+        after 为 (timestamp, id) 时只返回排在它之后的命令, 用于游标分页
+        """
         pass
 
     @abc.abstractmethod
@@ -25,3 +35,15 @@ class CommandBase(object):
               input=None, session=None):
         pass
 
+
+    def count_by_sessions(self, sessions_id):
+        """
+        批量统计会话的命令数, 返回 {session_id: count}, 没有命令的会话不在结果中
+        子类应该用一次聚合查询实现
+        """
+        counts = {}
+        for session_id in sessions_id:
+            count = self.count(session=session_id)
+            if count:
+                counts[session_id] = count
+        return counts
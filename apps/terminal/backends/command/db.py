@@ -1,9 +1,10 @@
 # ~*~ coding: utf-8 ~*~
 import datetime
 
-from django.db import transaction
+from django.db import transaction, connection
+from django.db.models import Q, Count
 from django.utils import timezone
-from django.db.utils import OperationalError
+from django.db.utils import OperationalError, DatabaseError
 
 from .base import CommandBase
 
@@ -11,24 +12,43 @@ from .base import CommandBase
 class CommandStore(CommandBase):
 
     def __init__(self, params):
-        from terminal.models import Command
+        from terminal.models import Command, CommandToken
         self.model = Command
+        self.token_model = CommandToken
 
     def save(self, command):
         """
         保存命令到数据库
         """
+        with transaction.atomic():
+            instance = self.model.objects.create(
+                user=command["user"], asset=command["asset"],
+                system_user=command["system_user"], input=command["input"],
+                output=command["output"], session=command["session"],
+                org_id=command["org_id"], timestamp=command["timestamp"]
+            )
+            self.save_tokens([instance])
+
+    def ping(self):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except DatabaseError:
+            return False
 
-        self.model.objects.create(
-            user=command["user"], asset=command["asset"],
-            system_user=command["system_user"], input=command["input"],
-            output=command["output"], session=command["session"],
-            org_id=command["org_id"], timestamp=command["timestamp"]
-        )
+    def save_tokens(self, commands):
+        """
+        写入命令的搜索索引, 需要和命令在同一个事务中
+        """
+        tokens = self.token_model.from_commands(commands)
+        self.token_model.objects.bulk_create(tokens, batch_size=5000)
 
     def bulk_save(self, commands):
         """
         批量保存命令到数据库, command的顺序和save中一致
+        多条命令保存失败时返回 False, 由调用方二分找出出错的命令,
+        不再逐条保存
         """
         _commands = []
         for c in commands:
@@ -37,24 +57,26 @@ class CommandStore(CommandBase):
                 input=c["input"], output=c["output"], session=c["session"],
                 org_id=c["org_id"], timestamp=c["timestamp"]
             ))
-        error = False
         try:
             with transaction.atomic():
                 self.model.objects.bulk_create(_commands)
+                self.save_tokens(_commands)
+            return True
         except OperationalError:
-            error = True
+            if len(_commands) > 1:
+                return False
         except:
             return False
 
-        if not error:
-            return True
-        for command in _commands:
-            try:
-                with transaction.atomic():
-                    command.save()
-            except OperationalError:
-                command.output = str(command.output.encode())
+        # 单条命令出错, 可能是数据库不支持 4 字节的 utf8 字符
+        command = _commands[0]
+        command.output = str(command.output.encode())
+        try:
+            with transaction.atomic():
                 command.save()
+                self.save_tokens([command])
+        except DatabaseError:
+            return False
         return True
 
     @staticmethod
@@ -77,33 +99,83 @@ class CommandStore(CommandBase):
             filter_kwargs['asset'] = asset
         if system_user:
             filter_kwargs['system_user'] = system_user
-        if input:
-            filter_kwargs['input__icontains'] = input
         if session:
             filter_kwargs['session'] = session
 
         return filter_kwargs
 
+    def search_input(self, queryset, input, filter_kwargs):
+        """
+        通过倒排索引搜索命令输入, 每个词都要匹配, 以 * 结尾的词按前缀匹配
+        升级前的命令还没有补建完索引时, 更早的命令仍然使用 like 搜索
+        """
+        terms = self.token_model.parse_query(input)
+        if not terms:
+            # 只有符号时没有可用的词, 仍然使用 like
+            return queryset.filter(input__icontains=input)
+        date_from = filter_kwargs['timestamp__gte']
+        point = self.token_model.get_backfill_point()
+        indexed = Q(timestamp__gte=max(date_from, point))
+        for token, is_prefix in terms:
+            lookup = 'token__startswith' if is_prefix else 'token'
+            commands_id = self.token_model.objects.filter(**{
+                lookup: token,
+                'timestamp__gte': max(date_from, point),
+                'timestamp__lte': filter_kwargs['timestamp__lte'],
+            }).values('command_id')
+            indexed &= Q(id__in=commands_id)
+        if date_from >= point:
+            return queryset.filter(indexed)
+        legacy = Q(timestamp__lt=point)
+        for word in input.split():
+            legacy &= Q(input__icontains=word.rstrip('*'))
+        return queryset.filter(indexed | legacy)
+
+    def get_queryset(self, date_from=None, date_to=None,
+                     user=None, asset=None, system_user=None,
+                     input=None, session=None):
+        filter_kwargs = self.make_filter_kwargs(
+            date_from=date_from, date_to=date_to, user=user,
+            asset=asset, system_user=system_user, session=session,
+        )
+        queryset = self.model.objects.filter(**filter_kwargs)
+        if input:
+            queryset = self.search_input(queryset, input, filter_kwargs)
+        return queryset
+
     def filter(self, date_from=None, date_to=None,
                user=None, asset=None, system_user=None,
-               input=None, session=None):
-        filter_kwargs = self.make_filter_kwargs(
+               input=None, session=None, limit=None, offset=0, after=None):
+        queryset = self.get_queryset(
             date_from=date_from, date_to=date_to, user=user,
             asset=asset, system_user=system_user, input=input,
             session=session,
         )
-        queryset = self.model.objects.filter(**filter_kwargs)
+        if after is not None:
+            # 游标分页, 走 timestamp 索引的范围查询, 不再跳过 offset 行
+            timestamp, id = after
+            queryset = queryset.filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=id)
+            )
+        queryset = queryset.order_by('-timestamp', '-id')
+        if limit is not None:
+            queryset = queryset[offset:offset+limit]
         return queryset
 
     def count(self, date_from=None, date_to=None,
               user=None, asset=None, system_user=None,
               input=None, session=None):
-        filter_kwargs = self.make_filter_kwargs(
+        queryset = self.get_queryset(
             date_from=date_from, date_to=date_to, user=user,
             asset=asset, system_user=system_user, input=input,
             session=session,
         )
-        count = self.model.objects.filter(**filter_kwargs).count()
-        return count
-
-
+        return queryset.count()
+
+    def count_by_sessions(self, sessions_id):
+        sessions_id = [str(i) for i in sessions_id]
+        if not sessions_id:
+            return {}
+        queryset = self.model.objects.filter(session__in=sessions_id)\
+            .values('session').annotate(count=Count('id')).order_by()
+        return {item['session']: item['count'] for item in queryset}
@@ -7,16 +7,80 @@ from .models import AbstractSessionCommand
 
 
 class CommandStore(ESStorage, CommandBase):
+    # 不分页时最多返回的条数, 即 es 默认的 index.max_result_window
+    max_result_window = 10000
+    # 动态映射时字符串字段的 keyword 子字段, 用于聚合
+    session_keyword_field = 'session.keyword'
+
     def __init__(self, params):
         super().__init__(params)
 
+    @staticmethod
+    def make_match_exact(user=None, asset=None, system_user=None,
+                         input=None, session=None):
+        match = {}
+        exact = {}
+
+        if user:
+            exact["user"] = user
+        if asset:
+            exact["asset"] = asset
+        if system_user:
+            exact["system_user"] = system_user
+
+        if session:
+            match["session"] = session
+        if input:
+            match["input"] = input
+        return match, exact
+
     def filter(self, date_from=None, date_to=None,
                user=None, asset=None, system_user=None,
-               input=None, session=None):
-
-        data = super().filter(date_from=date_from, date_to=date_to,
-                              user=user, asset=asset, system_user=system_user,
-                              input=input, session=session)
-        return AbstractSessionCommand.from_multi_dict(
-            [item["_source"] for item in data["hits"] if item]
+               input=None, session=None, limit=None, offset=0, after=None):
+        match, exact = self.make_match_exact(
+            user=user, asset=asset, system_user=system_user,
+            input=input, session=session,
+        )
+        body = self.get_query_body(match, exact, date_from, date_to)
+        body["sort"] = [
+            {"timestamp": {"order": "desc"}},
+            {"_id": {"order": "desc"}},
+        ]
+        if after is not None:
+            # search_after 不受 max_result_window 限制, 深翻页和第一页一样快
+            body["search_after"] = list(after)
+            offset = 0
+        if limit is None:
+            size, offset = self.max_result_window, 0
+        else:
+            size = limit
+        data = self.es.search(
+            index=self.index, doc_type=self.doc_type, body=body,
+            size=size, from_=offset,
         )
+        commands = []
+        for item in data["hits"]["hits"]:
+            if not item:
+                continue
+            command = AbstractSessionCommand.from_dict(item["_source"])
+            command.id = item["_id"]
+            commands.append(command)
+        return commands
+
+    def count_by_sessions(self, sessions_id):
+        sessions_id = [str(i) for i in sessions_id]
+        if not sessions_id:
+            return {}
+        body = {
+            "size": 0,
+            "query": {"bool": {"filter": [
+                {"terms": {self.session_keyword_field: sessions_id}}
+            ]}},
+            "aggs": {"sessions": {"terms": {
+                "field": self.session_keyword_field,
+                "size": len(sessions_id),
+            }}},
+        }
+        data = self.es.search(index=self.index, doc_type=self.doc_type, body=body)
+        buckets = data["aggregations"]["sessions"]["buckets"]
+        return {bucket["key"]: bucket["doc_count"] for bucket in buckets}
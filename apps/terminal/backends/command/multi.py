@@ -1,25 +1,169 @@
 # -*- coding: utf-8 -*-
 #
+import base64
+import heapq
+import itertools
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
+from django.db import connections
+
+from orgs.utils import get_current_org, set_current_org
 from .base import CommandBase
 
 
+class MultiCommandQuerySet:
+    """
+    多个存储的查询结果, 切片时才查询, 每个存储只取到切片结束位置的条数,
+    可以直接交给 Paginator 分页
+    """
+    def __init__(self, store, filter_kwargs):
+        self.store = store
+        self.filter_kwargs = filter_kwargs
+        self._count = None
+        self._result_cache = None
+
+    def _fetch_all(self):
+        if self._result_cache is None:
+            self._result_cache = self.store.filter_merged(**self.filter_kwargs)
+        return self._result_cache
+
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if self._count is None:
+            self._count = self.store.count(**self.filter_kwargs)
+        return self._count
+
+    def __len__(self):
+        return len(self._fetch_all())
+
+    def __iter__(self):
+        return iter(self._fetch_all())
+
+    def __bool__(self):
+        return bool(self[:1])
+
+    def __getitem__(self, k):
+        if self._result_cache is not None:
+            return self._result_cache[k]
+        if isinstance(k, int):
+            return self[k:k+1][0]
+        if k.step or k.stop is None:
+            return self._fetch_all()[k]
+        start = k.start or 0
+        return self.store.filter_merged(
+            limit=max(k.stop - start, 0), offset=start, **self.filter_kwargs
+        )
+
+
+def encode_cursor(positions):
+    """
+    positions: {存储序号: [timestamp, id]}, 编码为不透明的游标
+    """
+    data = json.dumps(positions, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    游标无效时返回 None, 从第一页开始
+    """
+    if not cursor:
+        return None
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(positions, dict):
+        return None
+    return positions
+
+
 class CommandStore(CommandBase):
     def __init__(self, storage_list):
-        self.storage_list = storage_list
+        self.storage_list = list(storage_list)
+
+    def map_storage(self, func):
+        """
+        并发查询各个存储, 线程中使用调用方的组织, 结束后关闭线程的数据库连接
+        """
+        if len(self.storage_list) <= 1:
+            return [func(storage) for storage in self.storage_list]
+        org = get_current_org()
+
+        def run(storage):
+            set_current_org(org)
+            try:
+                return func(storage)
+            finally:
+                connections.close_all()
 
-    def filter(self, **kwargs):
-        queryset = []
+        with ThreadPoolExecutor(max_workers=len(self.storage_list)) as executor:
+            return list(executor.map(run, self.storage_list))
 
-        for storage in self.storage_list:
-            queryset.extend(storage.filter(**kwargs))
-        return sorted(queryset, key=lambda command: command.timestamp, reverse=True)
+    def filter_merged(self, limit=None, offset=0, **kwargs):
+        """
+        各个存储都按 timestamp 倒序取前 offset+limit 条, 再多路归并
+        """
+        stop = None if limit is None else offset + limit
+        results = self.map_storage(
+            lambda storage: list(storage.filter(limit=stop, **kwargs))
+        )
+        merged = heapq.merge(
+            *results, key=lambda command: command.timestamp, reverse=True
+        )
+        return list(itertools.islice(merged, offset, stop))
+
+    def filter_page(self, limit, cursor=None, **kwargs):
+        """
+        游标分页, 返回 (commands, next_cursor), 没有下一页时 next_cursor 为 None
+        游标中记录每个存储已经返回的最后一条命令的 (timestamp, id),
+        各存储的 id 不能互相比较, 所以分开记录
+        """
+        positions = decode_cursor(cursor) or {}
+
+        def filter_storage(storage):
+            index = str(self.storage_list.index(storage))
+            after = positions.get(index)
+            commands = storage.filter(
+                limit=limit, after=tuple(after) if after else None, **kwargs
+            )
+            return [(index, command) for command in commands]
+
+        results = self.map_storage(filter_storage)
+        merged = heapq.merge(
+            *results, key=lambda item: (item[1].timestamp, str(item[1].id)),
+            reverse=True
+        )
+        commands = []
+        for index, command in itertools.islice(merged, limit):
+            positions[index] = [command.timestamp, str(command.id)]
+            commands.append(command)
+        # 本页取满且还有剩余的命令时才有下一页
+        if len(commands) < limit or next(merged, None) is None:
+            return commands, None
+        return commands, encode_cursor(positions)
+
+    def filter(self, limit=None, offset=0, **kwargs):
+        if limit is not None:
+            return self.filter_merged(limit=limit, offset=offset, **kwargs)
+        return MultiCommandQuerySet(self, kwargs)
 
     def count(self, **kwargs):
-        amount = 0
-        for storage in self.storage_list:
-            amount += storage.count(**kwargs)
-        return amount
+        return sum(self.map_storage(lambda storage: storage.count(**kwargs)))
+
+    def count_by_sessions(self, sessions_id):
+        sessions_id = list(sessions_id)
+        results = self.map_storage(
+            lambda storage: storage.count_by_sessions(sessions_id)
+        )
+        counts = defaultdict(int)
+        for result in results:
+            for session_id, count in result.items():
+                counts[session_id] += count
+        return dict(counts)
 
     def save(self, command):
         pass
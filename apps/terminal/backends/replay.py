@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import time
+import uuid
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+import jms_storage
+
+from ..const import (
+    REPLAY_OBJECT_CACHE_KEY, REPLAY_CACHE_METRICS_KEY,
+)
+
+logger = logging.getLogger(__file__)
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+# 下载锁超过这个时间认为下载进程已经退出
+DOWNLOAD_TIMEOUT = 600
+
+
+def get_object_size(storage, path):
+    """
+    返回对象的大小, 不存在时返回 None
+    jms_storage 只提供整个文件下载, 这里直接使用各存储的 client
+    """
+    tp = storage.type
+    if tp == 's3':
+        try:
+            data = storage.client.head_object(Bucket=storage.bucket, Key=path)
+        except Exception:
+            return None
+        return data['ContentLength']
+    elif tp == 'oss':
+        try:
+            return storage.client.head_object(path).content_length
+        except Exception:
+            return None
+    elif tp == 'azure':
+        try:
+            blob = storage.client.get_blob_properties(storage.container_name, path)
+        except Exception:
+            return None
+        return blob.properties.content_length
+    elif tp == 'ceph':
+        key = storage.client.get_key(path)
+        return key.size if key else None
+    raise ValueError("Storage not support range read: {}".format(tp))
+
+
+def read_object_range(storage, path, start, end):
+    """
+    读取对象 [start, end] 之间的字节, 包含 end
+    """
+    tp = storage.type
+    if tp == 's3':
+        data = storage.client.get_object(
+            Bucket=storage.bucket, Key=path,
+            Range='bytes={}-{}'.format(start, end)
+        )
+        return data['Body'].read()
+    elif tp == 'oss':
+        return storage.client.get_object(path, byte_range=(start, end)).read()
+    elif tp == 'azure':
+        blob = storage.client.get_blob_to_bytes(
+            storage.container_name, path, start_range=start, end_range=end
+        )
+        return blob.content
+    elif tp == 'ceph':
+        key = storage.client.get_key(path)
+        return key.get_contents_as_string(
+            headers={'Range': 'bytes={}-{}'.format(start, end)}
+        )
+    raise ValueError("Storage not support range read: {}".format(tp))
+
+
+class ReplayObjectStore:
+    """
+    外部录像存储, 支持按范围读取, 不需要先下载整个录像
+    """
+    locate_cache_timeout = 600
+
+    def __init__(self, configs):
+        self.storage_list = [
+            jms_storage.get_object_storage(config)
+            for config in configs.values()
+        ]
+
+    def locate(self, path):
+        """
+        查找录像所在的存储, 返回 (存储序号, 大小), 找不到时返回 None
+        """
+        key = REPLAY_OBJECT_CACHE_KEY.format(path)
+        location = cache.get(key)
+        if location is not None:
+            return location
+        for index, storage in enumerate(self.storage_list):
+            try:
+                size = get_object_size(storage, path)
+            except Exception as e:
+                logger.error("Get replay size error: {}".format(e))
+                continue
+            if size is not None:
+                location = (index, size)
+                cache.set(key, location, self.locate_cache_timeout)
+                return location
+        return None
+
+    def iter_range(self, path, start, end, chunk_size=STREAM_CHUNK_SIZE):
+        location = self.locate(path)
+        if location is None:
+            return
+        storage = self.storage_list[location[0]]
+        while start <= end:
+            stop = min(start + chunk_size - 1, end)
+            yield read_object_range(storage, path, start, stop)
+            start = stop + 1
+
+    def read_range(self, path, offset, stop):
+        """
+        读取 [offset, stop) 的字节
+        """
+        return b''.join(self.iter_range(path, offset, stop - 1))
+
+    def download(self, path, target):
+        location = self.locate(path)
+        if location is None:
+            return False, "Replay not found: {}".format(path)
+        storage = self.storage_list[location[0]]
+        return storage.download(path, target)
+
+
+def get_replay_object_store():
+    configs = settings.TERMINAL_REPLAY_STORAGE
+    configs = {k: v for k, v in configs.items() if v['TYPE'] != 'server'}
+    if not configs:
+        return None
+    return ReplayObjectStore(configs)
+
+
+class ReplayCache:
+    """
+    外部存储录像的本地缓存, 总大小超过限制时按最近访问时间淘汰
+    访问时更新文件的 mtime, 用 mtime 作为 LRU 的依据
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    @staticmethod
+    def get_redis_client():
+        return cache.get_master_client()
+
+    def incr_metrics(self, **values):
+        pipe = self.get_redis_client().pipeline()
+        for k, v in values.items():
+            pipe.hincrby(REPLAY_CACHE_METRICS_KEY, k, v)
+        pipe.execute()
+
+    def get_path(self, path):
+        return os.path.join(self.cache_dir, path)
+
+    def get(self, path):
+        """
+        命中时返回本地文件路径
+        """
+        local_path = self.get_path(path)
+        try:
+            os.utime(local_path)
+        except OSError:
+            self.incr_metrics(misses=1)
+            return None
+        self.incr_metrics(hits=1)
+        return local_path
+
+    def put(self, path, store):
+        """
+        从外部存储下载到缓存, 先写到临时文件, 完成后再改名, 避免读到不完整的文件
+        """
+        local_path = self.get_path(path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(local_path, uuid.uuid4().hex)
+        ok, err = store.download(path, tmp_path)
+        if not ok:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None, err
+        os.replace(tmp_path, local_path)
+        self.incr_metrics(downloads=1, download_bytes=os.path.getsize(local_path))
+        self.evict()
+        return local_path, None
+
+    def fill_async(self, path, store):
+        """
+        在后台线程把录像下载到本机的缓存, 不阻塞请求.
+        缓存在每台 web 服务器本地, 所以在 web 进程中下载,
+        同一台机器上同一个录像同时只有一个下载, 拿不到锁时直接返回
+        """
+        local_path = self.get_path(path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        lock_path = local_path + '.lock'
+        if self.is_lock_stale(lock_path, DOWNLOAD_TIMEOUT):
+            self.remove_file(lock_path)
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.close(fd)
+
+        def download():
+            try:
+                if os.path.exists(local_path):
+                    return
+                _, err = self.put(path, store)
+                if err:
+                    logger.error("Download replay to cache failed: {}".format(err))
+            except Exception as e:
+                logger.error("Download replay to cache error: {}".format(e))
+            finally:
+                self.remove_file(lock_path)
+
+        threading.Thread(target=download, daemon=True).start()
+        return True
+
+    @staticmethod
+    def is_lock_stale(lock_path, timeout):
+        try:
+            return time.time() - os.path.getmtime(lock_path) > timeout
+        except OSError:
+            return False
+
+    @staticmethod
+    def remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def list_files(self):
+        files = []
+        for root, dirs, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.tmp') or name.endswith('.lock'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        files = self.list_files()
+        total = sum(f[1] for f in files)
+        evicted = evicted_bytes = 0
+        if total > self.max_size:
+            for mtime, size, path in sorted(files):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+                evicted_bytes += size
+                if total <= self.max_size:
+                    break
+        pipe = self.get_redis_client().pipeline()
+        if evicted:
+            pipe.hincrby(REPLAY_CACHE_METRICS_KEY, 'evictions', evicted)
+            pipe.hincrby(REPLAY_CACHE_METRICS_KEY, 'evicted_bytes', evicted_bytes)
+            logger.info("Evict {} replay cache files, {} bytes".format(
+                evicted, evicted_bytes
+            ))
+        pipe.hset(REPLAY_CACHE_METRICS_KEY, 'size', total)
+        pipe.hset(REPLAY_CACHE_METRICS_KEY, 'date_evicted', int(time.time()))
+        pipe.execute()
+        return evicted
+
+    def get_metrics(self):
+        values = self.get_redis_client().hgetall(REPLAY_CACHE_METRICS_KEY)
+        values = {k.decode(): int(v) for k, v in values.items()}
+        hits = values.get('hits', 0)
+        misses = values.get('misses', 0)
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / total, 4) if total else 0,
+            'downloads': values.get('downloads', 0),
+            'download_bytes': values.get('download_bytes', 0),
+            'evictions': values.get('evictions', 0),
+            'evicted_bytes': values.get('evicted_bytes', 0),
+            'size': values.get('size', 0),
+            'max_size': self.max_size,
+        }
+
+
+def get_replay_cache():
+    return ReplayCache(
+        settings.TERMINAL_REPLAY_CACHE_DIR,
+        settings.TERMINAL_REPLAY_CACHE_SIZE * 1024 * 1024,
+    )
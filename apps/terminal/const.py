@@ -5,3 +5,12 @@ ASSETS_CACHE_KEY = "terminal__session__assets"
 USERS_CACHE_KEY = "terminal__session__users"
 SYSTEM_USER_CACHE_KEY = "terminal__session__system_users"
 
+COMMAND_QUEUE_KEY = "terminal__command__queue"
+COMMAND_METRICS_KEY = "terminal__command__metrics"
+COMMAND_DEAD_LETTER_KEY = "terminal__command__dead_letter"
+COMMAND_DEAD_LETTER_MAX = 10000
+COMMAND_SAVE_SCHEDULED_KEY = "terminal__command__save__scheduled"
+COMMAND_TOKEN_BACKFILL_LOCK_KEY = "terminal__command__token__backfill__lock"
+
+REPLAY_OBJECT_CACHE_KEY = "terminal__replay__object__{}"
+REPLAY_CACHE_METRICS_KEY = "terminal__replay__cache__metrics"
@@ -0,0 +1,29 @@
+# Generated by Django 2.1.7 on 2019-05-09 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminal', '0014_auto_20181226_1441'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommandToken',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('token', models.CharField(max_length=64, verbose_name='Token')),
+                ('command_id', models.UUIDField(verbose_name='Command')),
+                ('timestamp', models.IntegerField(db_index=True)),
+            ],
+            options={
+                'db_table': 'terminal_command_token',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='commandtoken',
+            index_together={('token', 'timestamp')},
+        ),
+    ]
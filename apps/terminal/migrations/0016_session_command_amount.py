@@ -0,0 +1,18 @@
+# Generated by Django 2.1.7 on 2019-05-09 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminal', '0015_commandtoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='command_amount',
+            field=models.IntegerField(null=True, verbose_name='Command amount'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.1.7 on 2019-05-10 10:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terminal', '0016_session_command_amount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('org_id', models.CharField(blank=True, default='', max_length=36, verbose_name='Organization')),
+                ('date', models.DateField(verbose_name='Date')),
+                ('sessions_amount', models.IntegerField(default=0)),
+                ('users_amount', models.IntegerField(default=0)),
+                ('assets_amount', models.IntegerField(default=0)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'terminal_session_daily_rollup',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='sessiondailyrollup',
+            unique_together={('org_id', 'date')},
+        ),
+    ]
@@ -1,9 +1,13 @@
 from __future__ import unicode_literals
 
 import os
+import re
+import time
 import uuid
+import datetime
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, Min
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
 from django.conf import settings
@@ -12,6 +16,7 @@ from django.core.cache import cache
 
 from users.models import User
 from orgs.mixins import OrgModelMixin
+from orgs.utils import current_org
 from common.utils import get_command_storage_setting, get_replay_storage_setting
 from .backends import get_multi_command_storage
 from .backends.command.models import AbstractSessionCommand
@@ -164,9 +169,15 @@ class Session(OrgModelMixin):
     date_last_active = models.DateTimeField(verbose_name=_("Date last active"), default=timezone.now)
     date_start = models.DateTimeField(verbose_name=_("Date start"), db_index=True, default=timezone.now)
     date_end = models.DateTimeField(verbose_name=_("Date end"), null=True)
+    # 会话结束后统计一次, 之前为空
+    command_amount = models.IntegerField(null=True, verbose_name=_("Command amount"))
 
     upload_to = 'replay'
-    ACTIVE_CACHE_KEY_PREFIX = 'SESSION_ACTIVE_{}'
+    # 心跳上报的会话, 分数为最后上报的时间
+    ACTIVE_SESSIONS_KEY = 'SESSION_ACTIVE_SET'
+    # 第一次上报心跳的时间, redis 清空后重新计算
+    ACTIVE_SESSIONS_SINCE_KEY = 'SESSION_ACTIVE_SET_SINCE'
+    ACTIVE_TIMEOUT = 5*60
 
     def get_rel_replay_path(self, version=2):
         """
@@ -188,6 +199,12 @@ class Session(OrgModelMixin):
             local_path = rel_path
         return local_path
 
+    @property
+    def replay_type(self):
+        if self.protocol in ('rdp', 'vnc'):
+            return 'guacamole'
+        return 'json'
+
     def save_to_storage(self, f):
         local_path = self.get_local_path()
         try:
@@ -198,8 +215,44 @@ class Session(OrgModelMixin):
 
     @classmethod
     def set_sessions_active(cls, sessions_id):
-        data = {cls.ACTIVE_CACHE_KEY_PREFIX.format(i): i for i in sessions_id}
-        cache.set_many(data, timeout=5*60)
+        if not sessions_id:
+            return
+        now = time.time()
+        client = cache.get_master_client()
+        pipe = client.pipeline()
+        pipe.zadd(cls.ACTIVE_SESSIONS_KEY, **{str(i): now for i in sessions_id})
+        pipe.setnx(cls.ACTIVE_SESSIONS_SINCE_KEY, now)
+        pipe.execute()
+
+    @classmethod
+    def is_active_sessions_tracked(cls):
+        """
+        心跳集合存在超过超时时间后, 不在集合中的会话才能认为已经断开,
+        升级后或者 redis 清空后的第一个超时时间内返回 False
+        """
+        client = cache.get_master_client()
+        since = client.get(cls.ACTIVE_SESSIONS_SINCE_KEY)
+        if not since:
+            return False
+        return time.time() - float(since) >= cls.ACTIVE_TIMEOUT
+
+    @classmethod
+    def get_active_sessions_id(cls):
+        """
+        超时时间内上报过心跳的会话, 一次范围查询
+        """
+        client = cache.get_master_client()
+        sessions_id = client.zrangebyscore(
+            cls.ACTIVE_SESSIONS_KEY, time.time() - cls.ACTIVE_TIMEOUT, '+inf'
+        )
+        return {i.decode() for i in sessions_id}
+
+    @classmethod
+    def clean_expired_active_sessions(cls):
+        client = cache.get_master_client()
+        client.zremrangebyscore(
+            cls.ACTIVE_SESSIONS_KEY, '-inf', time.time() - cls.ACTIVE_TIMEOUT
+        )
 
     @classmethod
     def get_active_sessions(cls):
@@ -207,14 +260,23 @@ class Session(OrgModelMixin):
 
     def is_active(self):
         if self.protocol in ['ssh', 'telnet']:
-            key = self.ACTIVE_CACHE_KEY_PREFIX.format(self.id)
-            return bool(cache.get(key))
+            client = cache.get_master_client()
+            score = client.zscore(self.ACTIVE_SESSIONS_KEY, str(self.id))
+            return bool(score) and score >= time.time() - self.ACTIVE_TIMEOUT
         return True
 
-    @property
-    def command_amount(self):
+    @classmethod
+    def set_sessions_command_amount(cls, sessions):
+        """
+        没有保存命令数的会话 (未结束或者还没统计), 批量查询后设置到实例上
+        """
+        sessions = [s for s in sessions if s.command_amount is None]
+        if not sessions:
+            return
         command_store = get_multi_command_storage()
-        return command_store.count(session=str(self.id))
+        counts = command_store.count_by_sessions([str(s.id) for s in sessions])
+        for session in sessions:
+            session.command_amount = counts.get(str(session.id), 0)
 
     class Meta:
         db_table = "terminal_session"
@@ -236,6 +298,12 @@ class Task(models.Model):
     is_finished = models.BooleanField(default=False)
     date_created = models.DateTimeField(auto_now_add=True)
     date_finished = models.DateTimeField(null=True)
+    # 终端心跳时返回的未完成任务, 任务变化时删除
+    TERMINAL_TASKS_CACHE_KEY = 'TERMINAL_TASKS_{}'
+
+    @classmethod
+    def expire_terminal_tasks(cls, terminal_id):
+        cache.delete(cls.TERMINAL_TASKS_CACHE_KEY.format(terminal_id))
 
     class Meta:
         db_table = "terminal_task"
@@ -246,3 +314,174 @@ class Command(AbstractSessionCommand):
     class Meta:
         db_table = "terminal_command"
         ordering = ('-timestamp',)
+
+
+class CommandToken(models.Model):
+    """
+    命令输入的倒排索引, 在数据库中按词和前缀搜索命令, 避免全表 like 扫描
+    """
+    id = models.BigAutoField(primary_key=True)
+    token = models.CharField(max_length=64, verbose_name=_("Token"))
+    command_id = models.UUIDField(verbose_name=_("Command"))
+    timestamp = models.IntegerField(db_index=True)
+
+    TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+    BACKFILL_POINT_KEY = 'COMMAND_TOKEN_BACKFILL_POINT'
+
+    class Meta:
+        db_table = "terminal_command_token"
+        index_together = [('token', 'timestamp')]
+
+    @classmethod
+    def tokenize(cls, text):
+        tokens = []
+        for token in cls.TOKEN_PATTERN.findall(text.lower()):
+            token = token[:64]
+            if token not in tokens:
+                tokens.append(token)
+        return tokens
+
+    @classmethod
+    def parse_query(cls, text):
+        """
+        以 * 结尾的词按前缀搜索
+        :return: [(token, is_prefix), ]
+        """
+        terms = []
+        for word in text.split():
+            is_prefix = word.endswith('*')
+            tokens = cls.tokenize(word.rstrip('*'))
+            for i, token in enumerate(tokens):
+                terms.append((token, is_prefix and i == len(tokens) - 1))
+        return terms
+
+    @classmethod
+    def from_commands(cls, commands):
+        tokens = []
+        for command in commands:
+            for token in cls.tokenize(command.input):
+                tokens.append(cls(
+                    token=token, command_id=command.id,
+                    timestamp=command.timestamp
+                ))
+        return tokens
+
+    @classmethod
+    def get_backfill_point(cls):
+        """
+        升级前的命令没有索引, 从新到旧补建, 这个时间之后的命令都已经建立索引,
+        为 0 时说明已经全部完成. 缓存丢失时用最早的索引时间重新计算
+        """
+        point = cache.get(cls.BACKFILL_POINT_KEY)
+        if point is None:
+            point = cls.objects.aggregate(ts=Min('timestamp'))['ts']
+            if point is None:
+                point = int(time.time())
+            cls.set_backfill_point(point)
+        return point
+
+    @classmethod
+    def set_backfill_point(cls, point):
+        cache.set(cls.BACKFILL_POINT_KEY, point, None)
+
+    @classmethod
+    def backfill(cls, batch_size=5000):
+        """
+        为 backfill point 之前最新的一批命令建立索引, 按 timestamp 分批, 可以中断后继续
+        :return: 这一批的命令数, 全部完成时返回 0
+        """
+        point = cls.get_backfill_point()
+        if not point:
+            return 0
+        timestamps = Command.objects.filter(timestamp__lt=point)\
+            .order_by('-timestamp').values_list('timestamp', flat=True)
+        timestamps = list(timestamps[:batch_size])
+        if not timestamps:
+            cls.set_backfill_point(0)
+            return 0
+        # 同一秒的命令在同一批处理
+        start = timestamps[-1]
+        commands = Command.objects.filter(timestamp__gte=start, timestamp__lt=point)\
+            .only('id', 'input', 'timestamp')
+        indexed = set(cls.objects.filter(
+            timestamp__gte=start, timestamp__lt=point
+        ).values_list('command_id', flat=True).distinct())
+        commands = [c for c in commands if c.id not in indexed]
+        with transaction.atomic():
+            cls.objects.bulk_create(cls.from_commands(commands), batch_size=batch_size)
+        cls.set_backfill_point(start)
+        return len(timestamps)
+
+
+class SessionDailyRollup(models.Model):
+    """
+    每个组织每天的会话数, 用户数和资产数, 首页的统计图从这里读取
+    org_id 为空是默认组织, ROOT 是所有组织的汇总 (用户和资产跨组织去重)
+    """
+    ROOT_ORG_ID = 'ROOT'
+
+    id = models.BigAutoField(primary_key=True)
+    org_id = models.CharField(max_length=36, blank=True, default='', verbose_name=_("Organization"))
+    date = models.DateField(verbose_name=_("Date"))
+    sessions_amount = models.IntegerField(default=0)
+    users_amount = models.IntegerField(default=0)
+    assets_amount = models.IntegerField(default=0)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "terminal_session_daily_rollup"
+        unique_together = [('org_id', 'date')]
+
+    @classmethod
+    def get_current_org_id(cls):
+        if current_org.is_root():
+            return cls.ROOT_ORG_ID
+        if current_org.is_default():
+            return ''
+        return current_org.id
+
+    @staticmethod
+    def get_day_range(date):
+        tz = timezone.get_current_timezone()
+        start = timezone.make_aware(datetime.datetime.combine(date, datetime.time.min), tz)
+        return start, start + datetime.timedelta(days=1)
+
+    @classmethod
+    def refresh_date(cls, date):
+        """
+        重新统计一天的数据, 按组织分组一次查询, 所有组织汇总一次查询
+        """
+        start, end = cls.get_day_range(date)
+        queryset = Session.objects.filter(date_start__gte=start, date_start__lt=end)
+        aggregations = dict(
+            sessions_amount=Count('id'),
+            users_amount=Count('user', distinct=True),
+            assets_amount=Count('asset', distinct=True),
+        )
+        rows = list(queryset.values('org_id').annotate(**aggregations).order_by())
+        total = queryset.aggregate(**aggregations)
+        total['org_id'] = cls.ROOT_ORG_ID
+        if total['sessions_amount']:
+            rows.append(total)
+        orgs_id = [row['org_id'] for row in rows]
+        cls.objects.filter(date=date).exclude(org_id__in=orgs_id).delete()
+        for row in rows:
+            org_id = row.pop('org_id')
+            cls.objects.update_or_create(org_id=org_id, date=date, defaults=row)
+
+    @classmethod
+    def refresh(cls, days=30):
+        """
+        从最后统计的前一天开始重新统计, 之前的天数据不再变化
+        Session 需要在 root 组织下查询
+        """
+        today = timezone.localtime().date()
+        last = cls.objects.order_by('-date').values_list('date', flat=True).first()
+        if last is None:
+            start = today - datetime.timedelta(days=days)
+        else:
+            start = max(last - datetime.timedelta(days=1), today - datetime.timedelta(days=days))
+        date = start
+        while date <= today:
+            cls.refresh_date(date)
+            date += datetime.timedelta(days=1)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#
+"""
+可以按时间跳转的录像格式
+
+录像文件仍然是 gzip, 但由多个 gzip member 组成, 每个 member 是一段时间的录像,
+连在一起解压后和原来的录像内容一致, 不支持的播放器仍然可以整个下载播放.
+同目录下的 .idx 文件记录每个 member 的偏移, 长度和起止时间 (相对会话开始的秒数),
+按时间读取时只需要读取覆盖这段时间的 member.
+
+json 录像 (koko) 内容为 {"相对秒数": "输出", ...}
+guacamole 录像为 guacamole 指令, 时间来自 sync 指令 (毫秒)
+"""
+import gzip
+import json
+
+INDEX_VERSION = 1
+# 每个 member 解压后的大小
+CHUNK_SIZE = 256 * 1024
+
+
+def get_index_path(replay_path):
+    """
+    <id>.replay.gz 的索引为 <id>.replay.idx
+    """
+    if replay_path.endswith('.gz'):
+        replay_path = replay_path[:-len('.gz')]
+    return replay_path + '.idx'
+
+
+def iter_json_entries(text):
+    """
+    返回按时间排序的 (秒数, 输出)
+    """
+    data = json.loads(text)
+    entries = []
+    for k, v in data.items():
+        try:
+            entries.append((float(k), k, v))
+        except ValueError:
+            continue
+    entries.sort(key=lambda x: x[0])
+    for t, k, v in entries:
+        yield t, json.dumps(k) + ':' + json.dumps(v)
+
+
+def split_json_replay(text, chunk_size=CHUNK_SIZE):
+    """
+    返回 [(start, end, 文本)], 所有文本连起来仍然是一个合法的 json 对象
+    """
+    chunks = []
+    pieces, size, start, end = [], 0, None, None
+    for t, piece in iter_json_entries(text):
+        if pieces and size >= chunk_size:
+            chunks.append([start, end, pieces])
+            pieces, size, start = [], 0, None
+        if start is None:
+            start = t
+        end = t
+        pieces.append(piece)
+        size += len(piece)
+    if pieces or not chunks:
+        chunks.append([start or 0, end or 0, pieces])
+
+    result = []
+    for i, (start, end, pieces) in enumerate(chunks):
+        text = ('{' if i == 0 else ',') + ','.join(pieces)
+        if i == len(chunks) - 1:
+            text += '}'
+        result.append((start, end, text))
+    return result
+
+
+def parse_json_chunk(text):
+    text = text.lstrip('{,').rstrip('}')
+    if not text:
+        return {}
+    return json.loads('{' + text + '}')
+
+
+def iter_guacamole_instructions(text):
+    """
+    返回 (opcode, args, 原始文本), 每个元素的格式为 长度.值, 长度按字符计算
+    被中断的会话最后一条指令可能不完整, 只返回到最后一条完整的指令
+    """
+    pos, n = 0, len(text)
+    while pos < n:
+        while pos < n and text[pos].isspace():
+            pos += 1
+        if pos >= n:
+            break
+        start = pos
+        elements = []
+        while True:
+            dot = text.find('.', pos)
+            if dot < 0:
+                return
+            length = int(text[pos:dot])
+            pos = dot + 1 + length
+            if pos >= n:
+                return
+            elements.append(text[dot+1:pos])
+            sep = text[pos]
+            pos += 1
+            if sep == ';':
+                break
+        yield elements[0], elements[1:], text[start:pos]
+
+
+def split_guacamole_replay(text, chunk_size=CHUNK_SIZE):
+    """
+    在 sync 指令前切分, 返回 [(start, end, 文本)]
+    """
+    chunks = []
+    pieces, size = [], 0
+    first = start = end = None
+    for opcode, args, raw in iter_guacamole_instructions(text):
+        if opcode == 'sync' and args:
+            ts = int(args[0])
+            if first is None:
+                first = ts
+            t = (ts - first) / 1000
+            if pieces and size >= chunk_size:
+                chunks.append((start, end, ''.join(pieces)))
+                pieces, size, start = [], 0, end
+            if start is None:
+                start = t
+            end = t
+        pieces.append(raw)
+        size += len(raw)
+    if pieces or not chunks:
+        chunks.append((start or 0, end or 0, ''.join(pieces)))
+    return chunks
+
+
+def write_chunks(f, chunks, tp):
+    """
+    每段写为一个 gzip member, 返回索引
+    """
+    index = {'version': INDEX_VERSION, 'type': tp, 'chunks': []}
+    offset = 0
+    for start, end, text in chunks:
+        data = gzip.compress(text.encode('utf-8'))
+        f.write(data)
+        index['chunks'].append({
+            'offset': offset, 'length': len(data),
+            'start': start, 'end': end,
+        })
+        offset += len(data)
+    index['duration'] = index['chunks'][-1]['end'] if index['chunks'] else 0
+    return index
+
+
+def convert_replay(src, dst, tp='json', chunk_size=CHUNK_SIZE):
+    """
+    src 为原来的 gzip 录像 (文件对象), 写入 dst, 返回索引
+    """
+    with gzip.GzipFile(fileobj=src) as f:
+        text = f.read().decode('utf-8', errors='replace')
+    if tp == 'guacamole':
+        chunks = split_guacamole_replay(text, chunk_size)
+    else:
+        chunks = split_json_replay(text, chunk_size)
+    return write_chunks(dst, chunks, tp)
+
+
+def get_window_chunks(index, start, end):
+    return [
+        c for c in index['chunks']
+        if c['end'] >= start and c['start'] <= end
+    ]
+
+
+def read_window(index, read_range, start, end):
+    """
+    读取覆盖 [start, end] 秒的录像
+    read_range(offset, stop) 读取录像文件 [offset, stop) 的字节
+    json 录像返回 {秒数: 输出}, guacamole 录像返回指令文本
+    """
+    chunks = get_window_chunks(index, start, end)
+    tp = index.get('type', 'json')
+    if not chunks:
+        return {} if tp == 'json' else ''
+    # 覆盖的 member 是连续的, 一次读取
+    first, last = chunks[0], chunks[-1]
+    data = read_range(first['offset'], last['offset'] + last['length'])
+    texts = []
+    for c in chunks:
+        member = data[c['offset']-first['offset']:c['offset']-first['offset']+c['length']]
+        texts.append(gzip.decompress(member).decode('utf-8', errors='replace'))
+    if tp == 'guacamole':
+        return ''.join(texts)
+    result = {}
+    for text in texts:
+        result.update(parse_json_chunk(text))
+    return result
@@ -1,3 +1,34 @@
 # -*- coding: utf-8 -*-
 #
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
+from common.utils import get_logger
+from .models import Session, Task
+from .tasks import update_sessions_command_amount
+
+
+logger = get_logger(__file__)
+# 终端可能在会话结束后才上传最后的命令
+SESSION_COMMAND_AMOUNT_DELAY = 30
+
+
+@receiver(post_save, sender=Session)
+def on_session_finished_update_command_amount(sender, instance=None, **kwargs):
+    if not instance.is_finished or instance.command_amount is not None:
+        return
+    session_id = str(instance.id)
+    logger.debug("Session finished, update command amount: {}".format(session_id))
+    transaction.on_commit(lambda: update_sessions_command_amount.apply_async(
+        args=([session_id],), countdown=SESSION_COMMAND_AMOUNT_DELAY
+    ))
+
+
+@receiver(post_save, sender=Task)
+@receiver(post_delete, sender=Task)
+def on_task_changed_expire_terminal_tasks(sender, instance=None, **kwargs):
+    if not instance.terminal_id:
+        return
+    terminal_id = instance.terminal_id
+    transaction.on_commit(lambda: Task.expire_terminal_tasks(terminal_id))
@@ -1,22 +1,41 @@
 # -*- coding: utf-8 -*-
 #
 
+import os
+import re
+import json
+import time
 import datetime
 
 from celery import shared_task
 from celery.utils.log import get_task_logger
 from django.utils import timezone
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files.storage import default_storage
 
 
 from ops.celery.decorator import (
     register_as_period_task, after_app_ready_start, after_app_shutdown_clean_periodic
 )
-from .models import Status, Session, Command
+from orgs.utils import set_to_root_org
+from .models import Status, Session, Command, CommandToken, SessionDailyRollup
+from .backends import get_command_storage, get_multi_command_storage
+from .replay_format import convert_replay, get_index_path
+from .const import COMMAND_SAVE_SCHEDULED_KEY, COMMAND_TOKEN_BACKFILL_LOCK_KEY
+from .utils import (
+    dequeue_commands, requeue_commands, bulk_save_commands,
+    dead_letter_commands, incr_command_metrics,
+)
 
 
 CACHE_REFRESH_INTERVAL = 10
+DAY_SECONDS = 3600 * 24
+DELETE_BATCH_SIZE = 10000
+ORPHAN_SESSION_BATCH_SIZE = 1000
+# 每次补建索引最多运行的秒数, 下个周期继续
+COMMAND_TOKEN_BACKFILL_SECONDS = 300
+REPLAY_DATE_DIR_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
 RUNNING = False
 logger = get_task_logger(__name__)
 
@@ -32,16 +51,128 @@ def delete_terminal_status_period():
 
 @shared_task
 @register_as_period_task(interval=600)
-@after_app_ready_start
 @after_app_shutdown_clean_periodic
 def clean_orphan_session():
-    active_sessions = Session.objects.filter(is_finished=False)
-    for session in active_sessions:
-        if session.is_active():
+    """
+    心跳超时的会话批量设置为结束, 只有 ssh 和 telnet 会话上报心跳
+    """
+    set_to_root_org()
+    # 心跳集合还不完整时不能判断会话是否断开, 否则会结束正在进行的会话
+    if not Session.is_active_sessions_tracked():
+        logger.debug("Active sessions set is not ready, skip")
+        return
+    now = timezone.now()
+    active_sessions_id = Session.get_active_sessions_id()
+    # 刚开始的会话可能还没有上报心跳
+    sessions_id = Session.objects.filter(
+        is_finished=False, protocol__in=['ssh', 'telnet'],
+        date_start__lt=now - datetime.timedelta(seconds=Session.ACTIVE_TIMEOUT),
+    ).values_list('id', flat=True)
+    orphan_sessions_id = [
+        str(i) for i in sessions_id if str(i) not in active_sessions_id
+    ]
+    for i in range(0, len(orphan_sessions_id), ORPHAN_SESSION_BATCH_SIZE):
+        Session.objects.filter(
+            id__in=orphan_sessions_id[i:i+ORPHAN_SESSION_BATCH_SIZE],
+            is_finished=False,
+        ).update(is_finished=True, date_end=now)
+    Session.clean_expired_active_sessions()
+    if orphan_sessions_id:
+        logger.info("Finish {} orphan sessions".format(len(orphan_sessions_id)))
+        # update 不会触发 post_save, 在这里统计命令数
+        update_sessions_command_amount.delay(orphan_sessions_id)
+
+
+@shared_task
+@register_as_period_task(interval=600)
+@after_app_ready_start
+@after_app_shutdown_clean_periodic
+def refresh_session_daily_rollup_period():
+    set_to_root_org()
+    SessionDailyRollup.refresh()
+
+
+@shared_task
+@register_as_period_task(interval=600)
+@after_app_shutdown_clean_periodic
+def backfill_command_tokens_period():
+    """
+    为升级前的命令补建搜索索引, 从新到旧分批处理, 完成之前更早的命令使用 like 搜索
+    """
+    set_to_root_org()
+    if CommandToken.get_backfill_point() == 0:
+        return
+    if not cache.add(COMMAND_TOKEN_BACKFILL_LOCK_KEY, 1, COMMAND_TOKEN_BACKFILL_SECONDS * 2):
+        return
+    deadline = time.time() + COMMAND_TOKEN_BACKFILL_SECONDS
+    total = 0
+    try:
+        while time.time() < deadline:
+            count = CommandToken.backfill()
+            if not count:
+                break
+            total += count
+    finally:
+        cache.delete(COMMAND_TOKEN_BACKFILL_LOCK_KEY)
+    if total:
+        logger.info("Build search index for {} commands".format(total))
+
+
+def delete_in_batches(queryset, batch_size=DELETE_BATCH_SIZE):
+    """
+    按主键分批删除, 每批一个小事务, 避免一次删除大量数据撑大 undo log
+    """
+    model = queryset.model
+    deleted = 0
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        model.objects.filter(pk__in=pks).delete()
+        deleted += len(pks)
+    return deleted
+
+
+def clean_expired_commands(timestamp):
+    """
+    命令按天分段删除, 每段都走 timestamp 索引
+    """
+    first = Command.objects.filter(timestamp__lt=timestamp)\
+        .order_by('timestamp').values_list('timestamp', flat=True).first()
+    if first is None:
+        return 0
+    deleted = 0
+    for start in range(first - first % DAY_SECONDS, timestamp, DAY_SECONDS):
+        end = min(start + DAY_SECONDS, timestamp)
+        deleted += delete_in_batches(Command.objects.filter(
+            timestamp__gte=start, timestamp__lt=end
+        ))
+        delete_in_batches(CommandToken.objects.filter(
+            timestamp__gte=start, timestamp__lt=end
+        ))
+    return deleted
+
+
+def clean_expired_replays(date):
+    """
+    录像按 session 开始日期存放在 replay/YYYY-MM-DD 目录中, 直接删除过期的日期目录
+    只处理 replay 目录, 不会删除存储根目录下的其它文件
+    """
+    date = date.strftime('%Y-%m-%d')
+    root = Session.upload_to
+    try:
+        dirs, _ = default_storage.listdir(root)
+    except (OSError, NotImplementedError):
+        return
+    for d in dirs:
+        if not REPLAY_DATE_DIR_PATTERN.match(d) or d >= date:
             continue
-        session.is_finished = True
-        session.date_end = timezone.now()
-        session.save()
+        path = os.path.join(root, d)
+        _, files = default_storage.listdir(path)
+        for f in files:
+            default_storage.delete(os.path.join(path, f))
+        default_storage.delete(path)
+        logger.info("Clean replay dir: {}".format(path))
 
 
 @shared_task
@@ -50,21 +181,111 @@ def clean_orphan_session():
 @after_app_shutdown_clean_periodic
 def clean_expired_session_period():
     logger.info("Start clean expired session record, commands and replay")
+    set_to_root_org()
     days = settings.TERMINAL_SESSION_KEEP_DURATION
     dt = timezone.now() - timezone.timedelta(days=days)
-    expired_sessions = Session.objects.filter(date_start__lt=dt)
-    for session in expired_sessions:
-        logger.info("Clean session: {}".format(session.id))
-        Command.objects.filter(session=str(session.id)).delete()
-        # 删除录像文件
-        session_path = session.get_rel_replay_path()
-        local_path = session.get_local_path()
-        local_path_v1 = session.get_local_path(version=1)
-
-        # 去default storage中查找
-        for _local_path in (local_path, local_path_v1, session_path):
-            if default_storage.exists(_local_path):
-                default_storage.delete(_local_path)
-        # 删除session记录
-        session.delete()
+    # 按整天清理, 和录像的日期目录保持一致
+    dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    commands_deleted = clean_expired_commands(int(dt.timestamp()))
+    clean_expired_replays(dt)
+    sessions_deleted = delete_in_batches(
+        Session.objects.filter(date_start__lt=dt)
+    )
+    logger.info("Clean {} sessions, {} commands".format(
+        sessions_deleted, commands_deleted
+    ))
+
+
+@shared_task
+def save_queued_commands():
+    """
+    批量取出队列中的命令保存, 直到队列为空
+    """
+    cache.delete(COMMAND_SAVE_SCHEDULED_KEY)
+    storage = get_command_storage()
+    batch_size = settings.TERMINAL_COMMAND_SAVE_BATCH_SIZE
+    while True:
+        commands = dequeue_commands(batch_size)
+        if not commands:
+            break
+        start = time.time()
+        saved, failed, unsaved = bulk_save_commands(storage, commands)
+        if failed:
+            logger.error("Save {} commands failed, move to dead letter queue".format(len(failed)))
+            dead_letter_commands(failed)
+        incr_command_metrics(
+            saved=saved, failed=len(failed), seconds=time.time() - start
+        )
+        if unsaved:
+            # 存储不可用, 没有保存的命令放回队列, 等下次任务重试
+            requeue_commands(unsaved)
+            logger.error("Command storage unavailable, requeue {}".format(len(unsaved)))
+            break
+        if len(commands) < batch_size:
+            break
+
+
+def schedule_save_queued_commands():
+    # 同一时间只调度一个任务, 任务开始时清除标记
+    if cache.add(COMMAND_SAVE_SCHEDULED_KEY, 1, 10):
+        save_queued_commands.delay()
+
+
+@shared_task
+@register_as_period_task(interval=60)
+@after_app_ready_start
+@after_app_shutdown_clean_periodic
+def save_queued_commands_period():
+    save_queued_commands()
+
+
+@shared_task
+def update_sessions_command_amount(sessions_id):
+    """
+    会话结束后统计命令数保存到会话中, 先保存队列中还没入库的命令
+    """
+    set_to_root_org()
+    save_queued_commands()
+    counts = get_multi_command_storage().count_by_sessions(sessions_id)
+    for session_id in sessions_id:
+        Session.objects.filter(id=session_id).update(
+            command_amount=counts.get(str(session_id), 0)
+        )
 
+
+def convert_local_replay(session):
+    """
+    本地存储的录像转换为可以按时间跳转的格式, 返回是否转换, 已经转换的跳过
+    """
+    for path in (session.get_local_path(), session.get_local_path(version=1)):
+        if default_storage.exists(path):
+            break
+    else:
+        return False
+    index_path = get_index_path(path)
+    if default_storage.exists(index_path):
+        return False
+    try:
+        local_path = default_storage.path(path)
+    except NotImplementedError:
+        return False
+    tmp_path = local_path + '.tmp'
+    with open(local_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        index = convert_replay(src, dst, tp=session.replay_type)
+    # 先替换录像再写索引, 没有索引时按整个文件读取
+    os.replace(tmp_path, local_path)
+    with open(default_storage.path(index_path), 'w') as f:
+        json.dump(index, f)
+    return True
+
+
+@shared_task
+def convert_replay_to_seekable(session_id):
+    set_to_root_org()
+    session = Session.objects.filter(id=session_id).first()
+    if not session:
+        return
+    try:
+        convert_local_replay(session)
+    except (OSError, ValueError) as e:
+        logger.error("Convert replay {} error: {}".format(session_id, e))
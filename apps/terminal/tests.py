@@ -1,3 +1,17 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from .replay_format import iter_guacamole_instructions, split_guacamole_replay
+
+
+class GuacamoleReplayTests(SimpleTestCase):
+    def test_truncated_replay(self):
+        text = '4.sync,4.1000;4.size,1.0,4.1024,3.768;'
+        instructions = list(iter_guacamole_instructions(text + '4.sync,4.20'))
+        self.assertEqual(
+            [(opcode, args) for opcode, args, raw in instructions],
+            [('sync', ['1000']), ('size', ['0', '1024', '768'])],
+        )
+        # 只保留最后一条完整的指令之前的内容
+        for tail in ('4', '4.sy', '4.sync,', '4.sync,4.20'):
+            chunks = split_guacamole_replay(text + tail)
+            self.assertEqual(''.join(c[2] for c in chunks), text)
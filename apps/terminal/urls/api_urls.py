@@ -22,6 +22,13 @@ urlpatterns = [
     path('sessions/<uuid:pk>/replay/',
          api.SessionReplayViewSet.as_view({'get': 'retrieve', 'post': 'create'}),
          name='session-replay'),
+    path('sessions/<uuid:pk>/replay/stream/', api.SessionReplayStreamApi.as_view(),
+         name='session-replay-stream'),
+    path('sessions/<uuid:pk>/replay/window/', api.SessionReplayWindowApi.as_view(),
+         name='session-replay-window'),
+    path('replay/cache/metrics/', api.ReplayCacheMetricsApi.as_view(),
+         name='replay-cache-metrics'),
+    path('command/metrics/', api.CommandMetricsApi.as_view(), name='command-metrics'),
     path('tasks/kill-session/', api.KillSessionAPI.as_view(), name='kill-session'),
     path('terminal/<uuid:terminal>/access-key/', api.TerminalTokenApi.as_view(),
          name='terminal-access-key'),
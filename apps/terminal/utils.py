@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
 #
+import json
+import logging
+
 from django.core.cache import cache
 
 from assets.models import Asset, SystemUser
 from users.models import User
 
-from .const import USERS_CACHE_KEY, ASSETS_CACHE_KEY, SYSTEM_USER_CACHE_KEY
+from .const import (
+    USERS_CACHE_KEY, ASSETS_CACHE_KEY, SYSTEM_USER_CACHE_KEY,
+    COMMAND_QUEUE_KEY, COMMAND_METRICS_KEY, COMMAND_DEAD_LETTER_KEY,
+    COMMAND_DEAD_LETTER_MAX,
+)
+
+logger = logging.getLogger(__file__)
 
 
 def get_session_asset_list():
@@ -32,4 +41,159 @@ def get_system_user_list_from_cache():
     return cache.get(SYSTEM_USER_CACHE_KEY)
 
 
-
+def try_bulk_save(storage, commands):
+    try:
+        return storage.bulk_save(commands)
+    except Exception as e:
+        logger.error("Bulk save commands error: {}".format(e))
+        return False
+
+
+def bulk_save_commands(storage, commands):
+    """
+    批量保存命令, 出错时二分查找出错的命令, 其他命令仍然批量保存.
+    保存失败后先检查存储是否可用, 不可用时停止, 剩下的命令按原来的顺序返回
+    :return: (saved_amount, failed_commands, unsaved_commands)
+    """
+    saved, failed = 0, []
+    # 栈顶是最前面的一段, 保持命令的顺序
+    stack = [commands] if commands else []
+    while stack:
+        batch = stack.pop()
+        if try_bulk_save(storage, batch):
+            saved += len(batch)
+            continue
+        if not storage.ping():
+            unsaved = list(batch)
+            for rest in reversed(stack):
+                unsaved.extend(rest)
+            return saved, failed, unsaved
+        if len(batch) == 1:
+            failed.extend(batch)
+            continue
+        middle = len(batch) // 2
+        stack.append(batch[middle:])
+        stack.append(batch[:middle])
+    return saved, failed, []
+
+
+def get_redis_client():
+    return cache.get_master_client()
+
+
+def enqueue_commands(commands):
+    """
+    命令放入 redis 队列, 由 celery 批量保存, 上传命令的请求不再等待数据库
+    """
+    if not commands:
+        return 0
+    client = get_redis_client()
+    values = [json.dumps(command) for command in commands]
+    pipe = client.pipeline()
+    pipe.rpush(COMMAND_QUEUE_KEY, *values)
+    pipe.hincrby(COMMAND_METRICS_KEY, 'enqueued', len(values))
+    pipe.execute()
+    return len(values)
+
+
+def dequeue_commands(count):
+    """
+    原子的取出队列前 count 条命令
+    """
+    client = get_redis_client()
+    pipe = client.pipeline()
+    pipe.lrange(COMMAND_QUEUE_KEY, 0, count - 1)
+    pipe.ltrim(COMMAND_QUEUE_KEY, count, -1)
+    values, _ = pipe.execute()
+    return [json.loads(value) for value in values]
+
+
+def requeue_commands(commands):
+    """
+    存储不可用时放回队列头部, 保持原来的顺序, 稍后重试
+    """
+    if not commands:
+        return
+    client = get_redis_client()
+    values = [json.dumps(c) for c in reversed(commands)]
+    client.lpush(COMMAND_QUEUE_KEY, *values)
+
+
+def dead_letter_commands(commands):
+    """
+    存储可用但是保存失败的命令, 放到死信队列供排查, 不再重试
+    """
+    if not commands:
+        return
+    client = get_redis_client()
+    pipe = client.pipeline()
+    pipe.rpush(COMMAND_DEAD_LETTER_KEY, *[json.dumps(c) for c in commands])
+    pipe.ltrim(COMMAND_DEAD_LETTER_KEY, -COMMAND_DEAD_LETTER_MAX, -1)
+    pipe.execute()
+
+
+def incr_command_metrics(saved=0, failed=0, seconds=0.0):
+    client = get_redis_client()
+    pipe = client.pipeline()
+    if saved:
+        pipe.hincrby(COMMAND_METRICS_KEY, 'saved', saved)
+    if failed:
+        pipe.hincrby(COMMAND_METRICS_KEY, 'failed', failed)
+    if seconds:
+        pipe.hincrby(COMMAND_METRICS_KEY, 'batches', 1)
+        pipe.hincrbyfloat(COMMAND_METRICS_KEY, 'seconds', seconds)
+        pipe.hset(COMMAND_METRICS_KEY, 'last_batch_size', saved + failed)
+        pipe.hset(COMMAND_METRICS_KEY, 'last_batch_seconds', seconds)
+    pipe.execute()
+
+
+def get_command_metrics():
+    client = get_redis_client()
+    pipe = client.pipeline()
+    pipe.hgetall(COMMAND_METRICS_KEY)
+    pipe.llen(COMMAND_QUEUE_KEY)
+    pipe.llen(COMMAND_DEAD_LETTER_KEY)
+    values, queue_length, dead_letter_length = pipe.execute()
+    values = {k.decode(): float(v) for k, v in values.items()}
+    seconds = values.get('seconds', 0)
+    last_seconds = values.get('last_batch_seconds', 0)
+    last_size = values.get('last_batch_size', 0)
+    return {
+        'queue_length': queue_length,
+        'dead_letter_length': dead_letter_length,
+        'enqueued': int(values.get('enqueued', 0)),
+        'saved': int(values.get('saved', 0)),
+        'failed': int(values.get('failed', 0)),
+        'batches': int(values.get('batches', 0)),
+        'rows_per_second': round(values.get('saved', 0) / seconds, 2) if seconds else 0,
+        'last_batch_size': int(last_size),
+        'last_batch_rows_per_second': round(last_size / last_seconds, 2) if last_seconds else 0,
+    }
+
+
+def parse_range_header(header, size):
+    """
+    解析 HTTP Range 头, 只支持单个范围, 返回 (start, end), 包含 end
+    没有或者不支持时返回 None, 范围无法满足时抛出 ValueError
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[len('bytes='):].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not start:
+            # bytes=-500 表示最后 500 个字节
+            length = int(end)
+            if length <= 0:
+                raise ValueError("Range not satisfiable")
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(start)
+            end = int(end) if end else size - 1
+    except ValueError:
+        raise ValueError("Range not satisfiable")
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, end
@@ -25,8 +25,13 @@ class CommandListView(DatetimeSearchMixin, AdminUserRequiredMixin, ListView):
     paginate_by = settings.DISPLAY_PER_PAGE
     command = user = asset = system_user = ""
     date_from = date_to = None
+    cursor = next_cursor = None
+    cursor_mode = True
 
     def get_queryset(self):
+        self.cursor = self.request.GET.get('cursor')
+        # 默认使用游标分页, 传入 page 时才使用按页码的分页
+        self.cursor_mode = self.request.GET.get('page') is None
         self.command = self.request.GET.get('command', '')
         self.user = self.request.GET.get("user", '')
         self.asset = self.request.GET.get('asset', '')
@@ -42,9 +47,29 @@ class CommandListView(DatetimeSearchMixin, AdminUserRequiredMixin, ListView):
             filter_kwargs['system_user'] = self.system_user
         if self.command:
             filter_kwargs['input'] = self.command
+        if self.cursor_mode:
+            # 游标分页, 不统计总数, 深翻页和第一页一样快
+            self.paginate_by = None
+            queryset, self.next_cursor = common_storage.filter_page(
+                limit=settings.DISPLAY_PER_PAGE, cursor=self.cursor or None,
+                **filter_kwargs
+            )
+            return queryset
         queryset = common_storage.filter(**filter_kwargs)
         return queryset
 
+    def get_next_query(self):
+        if not self.next_cursor:
+            return ''
+        query = self.request.GET.copy()
+        query['cursor'] = self.next_cursor
+        return query.urlencode()
+
+    def get_first_query(self):
+        query = self.request.GET.copy()
+        query.pop('cursor', None)
+        return query.urlencode()
+
     def get_context_data(self, **kwargs):
         context = {
             'app': _('Terminal'),
@@ -58,6 +83,10 @@ class CommandListView(DatetimeSearchMixin, AdminUserRequiredMixin, ListView):
             'user': self.user,
             'asset': self.asset,
             'system_user': self.system_user,
+            'cursor': self.cursor,
+            'cursor_mode': self.cursor_mode,
+            'next_query': self.get_next_query(),
+            'first_query': self.get_first_query(),
         }
         kwargs.update(context)
         return super().get_context_data(**kwargs)
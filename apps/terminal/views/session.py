@@ -61,7 +61,12 @@ class SessionListView(AdminUserRequiredMixin, DatetimeSearchMixin, ListView):
             'system_user': self.system_user,
         }
         kwargs.update(context)
-        return super().get_context_data(**kwargs)
+        context = super().get_context_data(**kwargs)
+        # 只为当前页的会话批量查询命令数
+        sessions = list(context[self.context_object_name])
+        Session.set_sessions_command_amount(sessions)
+        context[self.context_object_name] = sessions
+        return context
 
 
 class SessionOnlineListView(SessionListView):
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 对比命令过滤逐条规则匹配和合并后的匹配器的性能
+# 数据在一个事务中生成，结束后回滚，不会污染数据库
+#
+# python benchmark_cmd_filter.py --rules 200 --commands 10000
+#
+
+import os
+import sys
+import time
+import random
+import argparse
+
+import django
+
+if os.path.exists('../apps'):
+    sys.path.insert(0, '../apps')
+elif os.path.exists('./apps'):
+    sys.path.insert(0, './apps')
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jumpserver.settings")
+django.setup()
+
+from django.db import transaction
+from assets.models import SystemUser, CommandFilter, CommandFilterRule
+from assets.cmd_filter_matcher import CommandFilterMatcher, \
+    get_command_filter_matcher
+from orgs.utils import set_to_root_org
+
+WORDS = [
+    'ls', 'cat', 'rm', 'reboot', 'shutdown', 'passwd', 'useradd', 'echo',
+    'dd', 'mkfs', 'chmod', 'chown', 'kill', 'top', 'vim', 'systemctl',
+    'iptables', 'mount', 'curl', 'wget',
+]
+
+
+class Rollback(Exception):
+    pass
+
+
+def legacy_is_command_can_run(system_user, command):
+    for rule in system_user.cmd_filter_rules:
+        action, matched_cmd = rule.match(command)
+        if action == rule.ACTION_ALLOW:
+            return True, None
+        elif action == rule.ACTION_DENY:
+            return False, matched_cmd
+    return True, None
+
+
+def generate_rules(system_user, count):
+    cmd_filter = CommandFilter.objects.create(name='bench-filter')
+    rules = []
+    for i in range(count):
+        if i % 5 == 0:
+            tp, content = 'regex', r'{}\s+-\w*{}'.format(
+                random.choice(WORDS), random.choice('abcdefrx')
+            )
+        else:
+            tp = 'command'
+            content = '\r\n'.join(
+                '{}-{}'.format(random.choice(WORDS), i) for _ in range(3)
+            )
+        rules.append(CommandFilterRule(
+            filter=cmd_filter, type=tp, content=content,
+            priority=random.randint(1, 100), action=random.randint(0, 1),
+        ))
+    CommandFilterRule.objects.bulk_create(rules)
+    system_user.cmd_filters.add(cmd_filter)
+
+
+def generate_commands(count):
+    commands = []
+    for i in range(count):
+        args = ' '.join(random.choice(WORDS + ['-rf', '/tmp', '-x', 'a'])
+                        for _ in range(random.randint(0, 4)))
+        commands.append('{} {}'.format(random.choice(WORDS), args))
+    return commands
+
+
+def run(rules_count, commands_count):
+    set_to_root_org()
+    system_user = SystemUser.objects.create(
+        name='bench-system-user', username='bench'
+    )
+    generate_rules(system_user, rules_count)
+    commands = generate_commands(commands_count)
+
+    start = time.time()
+    legacy = [legacy_is_command_can_run(system_user, c) for c in commands]
+    legacy_time = time.time() - start
+
+    # 已经取出规则后只比较匹配的时间
+    rules = list(system_user.cmd_filter_rules)
+    loop_matcher = CommandFilterMatcher(rules)
+    loop_matcher.pattern = None
+    start = time.time()
+    loop = [loop_matcher.is_command_can_run(c) for c in commands]
+    loop_time = time.time() - start
+
+    matcher = get_command_filter_matcher(system_user)
+    start = time.time()
+    merged = [matcher.is_command_can_run(c) for c in commands]
+    merged_time = time.time() - start
+
+    assert legacy == loop == merged, "Match result not equal"
+    print("{} rules, {} commands, merged: {}".format(
+        rules_count, commands_count, matcher.pattern is not None
+    ))
+    print("{:<28}{:>10}".format('method', 'time(s)'))
+    print("{:<28}{:>10.3f}".format('query + loop (current)', legacy_time))
+    print("{:<28}{:>10.3f}".format('cached rules + loop', loop_time))
+    print("{:<28}{:>10.3f}".format('cached merged matcher', merged_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Command filter benchmark')
+    parser.add_argument('--rules', type=int, default=200)
+    parser.add_argument('--commands', type=int, default=10000)
+    args = parser.parse_args()
+    try:
+        with transaction.atomic():
+            run(args.rules, args.commands)
+            raise Rollback()
+    except Rollback:
+        print("Benchmark data rolled back")
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 对比命令搜索 like 全表扫描和倒排索引的性能
+# 数据写在 2000 年的时间段中, 结束后按时间范围删除
+#
+# python benchmark_command_search.py --count 10000000
+#
+
+import os
+import sys
+import time
+import random
+import datetime
+import argparse
+
+import django
+
+if os.path.exists('../apps'):
+    sys.path.insert(0, '../apps')
+elif os.path.exists('./apps'):
+    sys.path.insert(0, './apps')
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jumpserver.settings")
+django.setup()
+
+from django.utils import timezone
+from terminal.models import Command, CommandToken
+from terminal.backends.command.db import CommandStore
+from orgs.utils import set_to_root_org
+
+START_TIMESTAMP = 946684800  # 2000-01-01
+TEMPLATES = [
+    'ls -la /var/log/{word}', 'cd /home/{word}', 'tail -f /var/log/{word}/access.log',
+    'ps aux | grep {word}', 'systemctl restart {word}', 'docker logs {word}',
+    'kubectl get pods -n {word}', 'cat /etc/{word}.conf', 'vim {word}.py',
+    'mysql -u{word} -p', 'rm -rf /tmp/{word}', 'git pull origin {word}',
+]
+WORDS = [
+    'nginx', 'redis', 'mysql', 'jumpserver', 'coco', 'guacamole', 'kafka',
+    'zookeeper', 'prometheus', 'grafana', 'elastic', 'logstash', 'master',
+    'develop', 'release', 'admin', 'deploy', 'backup', 'cron', 'sshd',
+]
+QUERIES = ['nginx', 'restart', 'grep kafka', 'prom*', 'access log', 'rm tmp']
+
+
+def generate(count, chunk):
+    store = CommandStore({})
+    for i in range(0, count, chunk):
+        commands = []
+        for j in range(i, min(i + chunk, count)):
+            template = random.choice(TEMPLATES)
+            commands.append({
+                'user': 'benchmark', 'asset': 'benchmark', 'system_user': 'benchmark',
+                'input': template.format(word=random.choice(WORDS)),
+                'output': '', 'session': 'benchmark', 'org_id': '',
+                'timestamp': START_TIMESTAMP + j,
+            })
+        store.bulk_save(commands)
+        if (i // chunk) % 100 == 0:
+            print("Generated {}".format(i + len(commands)))
+
+
+def clean(count, chunk):
+    end = START_TIMESTAMP + count
+    for ts in range(START_TIMESTAMP, end, chunk):
+        Command.objects.filter(timestamp__gte=ts, timestamp__lt=ts + chunk).delete()
+        CommandToken.objects.filter(timestamp__gte=ts, timestamp__lt=ts + chunk).delete()
+
+
+def timeit(func):
+    start = time.time()
+    result = func()
+    return result, time.time() - start
+
+
+def run(count, chunk, keep):
+    set_to_root_org()
+    store = CommandStore({})
+    if not Command.objects.filter(session='benchmark').exists():
+        generate(count, chunk)
+    date_from = datetime.datetime.fromtimestamp(START_TIMESTAMP, tz=timezone.utc)
+    date_to = datetime.datetime.fromtimestamp(START_TIMESTAMP + count, tz=timezone.utc)
+    timestamp_range = dict(timestamp__gte=START_TIMESTAMP, timestamp__lte=START_TIMESTAMP + count)
+
+    print("{:<16}{:>12}{:>12}{:>12}{:>12}".format(
+        'query', 'like count', 'like page', 'index count', 'index page'
+    ))
+    for query in QUERIES:
+        like = Command.objects.filter(input__icontains=query.rstrip('*'), **timestamp_range)
+        _, like_count = timeit(lambda: like.count())
+        _, like_page = timeit(lambda: list(like.order_by('-timestamp')[:25]))
+        kwargs = dict(input=query, date_from=date_from, date_to=date_to)
+        _, index_count = timeit(lambda: store.count(**kwargs))
+        _, index_page = timeit(lambda: list(store.filter(limit=25, **kwargs)))
+        print("{:<16}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}".format(
+            query, like_count, like_page, index_count, index_page
+        ))
+    if not keep:
+        clean(count, chunk)
+        print("Benchmark data deleted")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Command search benchmark')
+    parser.add_argument('--count', type=int, default=10000000)
+    parser.add_argument('--chunk', type=int, default=5000)
+    parser.add_argument('--keep', action='store_true', help='Keep data for next run')
+    args = parser.parse_args()
+    run(args.count, args.chunk, args.keep)
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 对比节点树旧的正则查询和新的 key 范围查询的性能
+# 数据在一个事务中生成，结束后回滚，不会污染数据库
+#
+# python benchmark_node_tree.py --nodes 20000 --assets 100000
+#
+
+import os
+import sys
+import time
+import random
+import argparse
+
+import django
+
+if os.path.exists('../apps'):
+    sys.path.insert(0, '../apps')
+elif os.path.exists('./apps'):
+    sys.path.insert(0, './apps')
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jumpserver.settings")
+django.setup()
+
+from django.db import transaction
+from assets.models import Node, Asset
+from orgs.utils import set_to_root_org
+
+
+class Rollback(Exception):
+    pass
+
+
+def legacy_get_children(node):
+    pattern = r'^{0}:[0-9]+$'.format(node.key)
+    return Node.objects.filter(key__regex=pattern)
+
+
+def legacy_get_all_children(node):
+    pattern = r'^{0}:'.format(node.key)
+    return Node.objects.filter(key__regex=pattern)
+
+
+def legacy_get_all_assets(node):
+    pattern = r'^{0}$|^{0}:'.format(node.key)
+    return Asset.objects.filter(nodes__key__regex=pattern).distinct()
+
+
+def generate_tree(root_key, count, branch):
+    nodes = [Node(key=root_key, value='bench', level=1)]
+    parents = [root_key]
+    while len(nodes) < count:
+        next_parents = []
+        for parent_key in parents:
+            for i in range(random.randint(1, branch)):
+                key = '{}:{}'.format(parent_key, i)
+                nodes.append(Node(key=key, value='bench-' + key,
+                                  level=Node.compute_level(key)))
+                next_parents.append(key)
+                if len(nodes) >= count:
+                    break
+            if len(nodes) >= count:
+                break
+        parents = next_parents
+    Node.objects.bulk_create(nodes, batch_size=2000)
+    return list(Node.objects.filter(Node.subtree_key_q(root_key)))
+
+
+def generate_assets(nodes, count):
+    assets = [
+        Asset(ip='10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255),
+              hostname='bench-asset-{}'.format(i), created_by='Benchmark')
+        for i in range(count)
+    ]
+    Asset.objects.bulk_create(assets, batch_size=2000)
+    assets_id = Asset.objects.filter(created_by='Benchmark')\
+        .values_list('id', flat=True)
+    through = Asset.nodes.through
+    relations = [
+        through(asset_id=asset_id, node_id=random.choice(nodes).id)
+        for asset_id in assets_id
+    ]
+    through.objects.bulk_create(relations, batch_size=5000)
+
+
+def timeit(func, nodes):
+    start = time.time()
+    for node in nodes:
+        list(func(node).values_list('id', flat=True))
+    return time.time() - start
+
+
+def run(nodes_count, assets_count, samples, branch):
+    set_to_root_org()
+    roots = Node.objects.filter(level=1).values_list('key', flat=True)
+    root_key = str(max([int(k) for k in roots] or [0]) + 1000)
+
+    start = time.time()
+    nodes = generate_tree(root_key, nodes_count, branch)
+    generate_assets(nodes, assets_count)
+    print("Generate {} nodes, {} assets: {:.2f}s".format(
+        len(nodes), assets_count, time.time() - start
+    ))
+
+    # 每一层都抽样, 越靠近根节点子树越大
+    by_level = {}
+    for node in nodes:
+        by_level.setdefault(node.level, []).append(node)
+    sample_nodes = []
+    for level_nodes in by_level.values():
+        sample_nodes.extend(random.sample(level_nodes, min(samples, len(level_nodes))))
+
+    cases = [
+        ('children', legacy_get_children, lambda n: n.get_children()),
+        ('all children', legacy_get_all_children, lambda n: n.get_all_children()),
+        ('all assets', legacy_get_all_assets, lambda n: n.get_all_assets()),
+    ]
+    print("{:<16}{:>12}{:>12}{:>10}".format('method', 'regex(s)', 'range(s)', 'speedup'))
+    for name, legacy, current in cases:
+        legacy_time = timeit(legacy, sample_nodes)
+        current_time = timeit(current, sample_nodes)
+        print("{:<16}{:>12.3f}{:>12.3f}{:>9.1f}x".format(
+            name, legacy_time, current_time,
+            legacy_time / current_time if current_time else 0
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Node tree query benchmark')
+    parser.add_argument('--nodes', type=int, default=20000)
+    parser.add_argument('--assets', type=int, default=100000)
+    parser.add_argument('--samples', type=int, default=20, help='Sample nodes per level')
+    parser.add_argument('--branch', type=int, default=8, help='Max children per node')
+    args = parser.parse_args()
+    try:
+        with transaction.atomic():
+            run(args.nodes, args.assets, args.samples, args.branch)
+            raise Rollback()
+    except Rollback:
+        print("Benchmark data rolled back")
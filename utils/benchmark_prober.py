@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 对比 ansible ping 和直接 ssh 认证测试可连接性的耗时
+# 默认在本机启动一个 paramiko 实现的 sshd 替身, 所有测试资产都指向它,
+# 也可以用 --sshd 指定一个真实的 sshd. 数据在一个事务中生成, 结束后回滚
+#
+# python benchmark_prober.py --assets 1000
+# python benchmark_prober.py --assets 1000 --sshd 127.0.0.1:22 --username test --password test
+#
+# ansible 使用 pipelining, 替身执行命令时直接在本机运行, 需要本机有 /usr/bin/python
+# --skip-ansible 只测试直接 ssh 认证
+#
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import subprocess
+
+os.environ.setdefault('ANSIBLE_PIPELINING', 'True')
+
+import django
+import paramiko
+
+if os.path.exists('../apps'):
+    sys.path.insert(0, '../apps')
+elif os.path.exists('./apps'):
+    sys.path.insert(0, './apps')
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jumpserver.settings")
+django.setup()
+
+from django.db import transaction
+from assets.models import Asset, AdminUser
+from assets.prober import probe_assets
+from assets import const
+from ops.utils import update_or_create_ansible_task
+from orgs.utils import set_to_root_org
+
+
+class Rollback(Exception):
+    pass
+
+
+class StandInServer(paramiko.ServerInterface):
+    """
+    只支持密码认证和 exec, exec 的命令在本机执行
+    """
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+
+    def check_auth_password(self, username, password):
+        if username == self.username and password == self.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        t = threading.Thread(target=run_command, args=(channel, command))
+        t.daemon = True
+        t.start()
+        return True
+
+
+def pump(src, write, close=None):
+    while True:
+        data = src()
+        if not data:
+            break
+        write(data)
+    if close:
+        close()
+
+
+def run_command(channel, command):
+    proc = subprocess.Popen(
+        command.decode(), shell=True, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    threads = [
+        threading.Thread(target=pump, args=(
+            lambda: channel.recv(32768), proc.stdin.write, proc.stdin.close
+        )),
+        threading.Thread(target=pump, args=(
+            lambda: proc.stdout.read1(32768), channel.sendall
+        )),
+        threading.Thread(target=pump, args=(
+            lambda: proc.stderr.read1(32768), channel.sendall_stderr
+        )),
+    ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads[1:]:
+        t.join()
+    channel.send_exit_status(proc.wait())
+    channel.close()
+
+
+def handle_client(sock, host_key, username, password):
+    transport = paramiko.Transport(sock)
+    transport.add_server_key(host_key)
+    try:
+        transport.start_server(server=StandInServer(username, password))
+    except (paramiko.SSHException, EOFError):
+        transport.close()
+
+
+def start_stand_in_sshd(username, password):
+    host_key = paramiko.ECDSAKey.generate()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1024)
+
+    def serve():
+        while True:
+            sock, addr = server.accept()
+            t = threading.Thread(
+                target=handle_client, args=(sock, host_key, username, password)
+            )
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=serve)
+    t.daemon = True
+    t.start()
+    return server.getsockname()
+
+
+def generate_assets(count, ip, port, username, password):
+    admin_user = AdminUser.objects.create(name='bench-admin-user', username=username)
+    admin_user.set_auth(password=password)
+    assets = [
+        Asset(hostname='bench-asset-{}'.format(i), ip=ip, port=port,
+              admin_user=admin_user, created_by='bench')
+        for i in range(count)
+    ]
+    Asset.objects.bulk_create(assets)
+    return list(Asset.objects.filter(created_by='bench').select_related('admin_user'))
+
+
+def run_ansible_ping(assets):
+    task, created = update_or_create_ansible_task(
+        task_name='bench-ansible-ping', hosts=assets,
+        tasks=const.TEST_ADMIN_USER_CONN_TASKS, pattern='all',
+        options=const.TASK_OPTIONS, run_as_admin=True, created_by='bench',
+    )
+    # 分片会派发给其它 worker, 它们看不到未提交的数据
+    return task.run(sharded=False)[1]
+
+
+def run(count, ip, port, username, password, skip_ansible):
+    set_to_root_org()
+    assets = generate_assets(count, ip, port, username, password)
+    rows = []
+
+    start = time.time()
+    summary = probe_assets(assets)
+    rows.append(('native ssh probe', time.time() - start, summary))
+
+    if not skip_ansible:
+        start = time.time()
+        summary = run_ansible_ping(assets)
+        rows.append(('ansible ping', time.time() - start, summary))
+
+    print("{} assets => {}:{}".format(count, ip, port))
+    print("{:<20}{:>10}{:>12}{:>12}".format('method', 'time(s)', 'reachable', 'unreachable'))
+    for name, used, summary in rows:
+        print("{:<20}{:>10.2f}{:>12}{:>12}".format(
+            name, used, len(summary.get('contacted', {})), len(summary.get('dark', {}))
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Connectivity prober benchmark')
+    parser.add_argument('--assets', type=int, default=1000)
+    parser.add_argument('--sshd', help='host:port of a real sshd')
+    parser.add_argument('--username', default='bench')
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--skip-ansible', action='store_true')
+    args = parser.parse_args()
+
+    if args.sshd:
+        _ip, _port = args.sshd.rsplit(':', 1)
+        _port = int(_port)
+    else:
+        _ip, _port = start_stand_in_sshd(args.username, args.password)
+    try:
+        with transaction.atomic():
+            run(args.assets, _ip, _port, args.username, args.password,
+                args.skip_ansible)
+            raise Rollback()
+    except Rollback:
+        print("Benchmark data rolled back")
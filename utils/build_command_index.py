@@ -0,0 +1,47 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 为升级前的命令记录补建搜索索引 (terminal_command_token)
+# 周期任务 backfill_command_tokens_period 也会在后台补建, 这个脚本用于一次补建完成
+# 从新到旧按 timestamp 分批处理, 中断后可以继续, 已经建立索引的命令会跳过
+#
+# python build_command_index.py --batch 5000
+#
+
+import os
+import sys
+import time
+import argparse
+
+import django
+
+if os.path.exists('../apps'):
+    sys.path.insert(0, '../apps')
+elif os.path.exists('./apps'):
+    sys.path.insert(0, './apps')
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jumpserver.settings")
+django.setup()
+
+from terminal.models import CommandToken
+from orgs.utils import set_to_root_org
+
+
+def build_index(batch_size):
+    set_to_root_org()
+    total = 0
+    while True:
+        count = CommandToken.backfill(batch_size=batch_size)
+        if not count:
+            break
+        total += count
+        point = CommandToken.get_backfill_point()
+        print("{}: {} commands".format(time.strftime('%Y-%m-%d %H:%M', time.localtime(point)), count))
+    print("Indexed {} commands".format(total))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build command search index')
+    parser.add_argument('--batch', type=int, default=5000, help='Commands per batch')
+    args = parser.parse_args()
+    build_index(args.batch)
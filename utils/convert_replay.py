@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# 把已经存在的录像转换为可以按时间跳转的格式 (分段 gzip + .idx 索引)
+# 转换后的录像仍然是合法的 gzip, 旧的播放器可以正常播放
+# 可以重复执行, 已经有索引的录像会跳过
+#
+# python convert_replay.py --days 30
+# python convert_replay.py --days 30 --external   # 同时转换外部存储中的录像
+#
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+
+import django
+
+if os.path.exists('../apps'):
+    sys.path.insert(0, '../apps')
+elif os.path.exists('./apps'):
+    sys.path.insert(0, './apps')
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jumpserver.settings")
+django.setup()
+
+from django.utils import timezone
+from terminal.models import Session
+from terminal.tasks import convert_local_replay
+from terminal.replay_format import convert_replay, get_index_path
+from terminal.backends.replay import get_replay_object_store
+from orgs.utils import set_to_root_org
+
+
+def convert_external_replay(store, session, tmp_dir):
+    path = session.get_rel_replay_path()
+    index_path = get_index_path(path)
+    if store.locate(index_path) is not None:
+        return False
+    location = store.locate(path)
+    if location is None:
+        return False
+    storage = store.storage_list[location[0]]
+    src_path = os.path.join(tmp_dir, 'src.gz')
+    dst_path = os.path.join(tmp_dir, 'dst.gz')
+    idx_path = os.path.join(tmp_dir, 'index.idx')
+    ok, err = storage.download(path, src_path)
+    if not ok:
+        print("Download {} failed: {}".format(path, err))
+        return False
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        index = convert_replay(src, dst, tp=session.replay_type)
+    with open(idx_path, 'w') as f:
+        json.dump(index, f)
+    # 先上传录像再上传索引
+    for src, target in ((dst_path, path), (idx_path, index_path)):
+        ok, err = storage.upload(src, target)
+        if not ok:
+            print("Upload {} failed: {}".format(target, err))
+            return False
+    return True
+
+
+def run(days, external):
+    set_to_root_org()
+    date_from = timezone.now() - timezone.timedelta(days=days)
+    sessions = Session.objects.filter(
+        is_finished=True, date_start__gte=date_from
+    ).order_by('date_start')
+    store = get_replay_object_store() if external else None
+    tmp_dir = tempfile.mkdtemp()
+    converted = 0
+    try:
+        for session in sessions.iterator():
+            try:
+                if convert_local_replay(session):
+                    converted += 1
+                elif store and convert_external_replay(store, session, tmp_dir):
+                    converted += 1
+            except (OSError, ValueError) as e:
+                print("Convert {} error: {}".format(session.id, e))
+    finally:
+        shutil.rmtree(tmp_dir)
+    print("Converted {} replays".format(converted))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert replays to seekable format')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--external', action='store_true',
+                        help='Also convert replays in external storage')
+    args = parser.parse_args()
+    run(args.days, args.external)